@@ -29,9 +29,58 @@ app.conf.beat_schedule = {
         'task': 'recipe.tasks.send_daily_notifications',
         'schedule': crontab(hour=1, minute=10),  
     },
+    'update-trending-scores': {
+        'task': 'recipe.tasks.update_trending_scores',
+        'schedule': crontab(minute='*/10'),
+    },
+    'rebuild-trending-scores': {
+        'task': 'recipe.tasks.update_trending_scores',
+        'schedule': crontab(hour=3, minute=40),
+        'kwargs': {'full': True},
+    },
+    'update-recipe-recommendations': {
+        'task': 'recipe.tasks.update_recipe_recommendations',
+        'schedule': crontab(minute=25),
+    },
+    'rebuild-recipe-recommendations': {
+        'task': 'recipe.tasks.update_recipe_recommendations',
+        'schedule': crontab(hour=4, minute=10),
+        'kwargs': {'full': True},
+    },
+    'reconcile-facet-counts': {
+        'task': 'recipe.tasks.reconcile_facet_counts',
+        'schedule': crontab(hour=4, minute=40),
+    },
+    'delete-expired-uploads': {
+        'task': 'recipe.tasks.delete_expired_uploads',
+        'schedule': crontab(minute=50),
+    },
+    'dispatch-outbox': {
+        'task': 'recipe.tasks.dispatch_outbox',
+        'schedule': 10.0,
+    },
+    'purge-outbox': {
+        'task': 'recipe.tasks.purge_outbox',
+        'schedule': crontab(hour=5, minute=40),
+    },
+    'collect-avatar-garbage': {
+        'task': 'users.tasks.collect_avatar_garbage',
+        'schedule': crontab(hour=5, minute=10),
+    },
 }
 
 
+if settings.RECIPE_LIKE_BUFFER:
+    app.conf.beat_schedule['flush-like-buffer'] = {
+        'task': 'recipe.tasks.flush_like_buffer',
+        'schedule': 5.0,
+    }
+
+# Email delivery runs on its own worker, see recipe.outbox.
+app.conf.task_routes = {
+    'recipe.tasks.dispatch_outbox': {'queue': 'outbox'},
+}
+
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Load task modules from all registered Django app configs.
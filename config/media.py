@@ -0,0 +1,133 @@
+"""
+Serving of uploaded media (MEDIA_ROOT under MEDIA_URL).
+
+RECIPE_MEDIA_SERVING picks how:
+
+- 'static': django.conf.urls.static, only while DEBUG is on.
+- 'python': serve() streams the file itself, answering Range and
+  If-Modified-Since requests.
+- 'x-accel-redirect': serve() only checks the path and sets headers; nginx
+  sends the file from an internal location at RECIPE_MEDIA_ACCEL_PREFIX.
+- 'x-sendfile': the same for Apache mod_xsendfile or lighttpd, which are
+  given the file's absolute path.
+
+Content-addressed files (see users.storage) never change, so they are
+cached for a year as immutable. Other files are revalidated on every use.
+"""
+import mimetypes
+import os
+import posixpath
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.urls import re_path
+from django.utils._os import safe_join
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+from django.views.static import was_modified_since
+
+from users.storage import is_content_name
+
+CHUNK_SIZE = 64 * 1024
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def get_range(header, size):
+    """
+    The (start, end) byte positions, end included, asked for by a Range
+    header. None to send the whole file: no header, or one this doesn't
+    handle, like several ranges. Raises ValueError if it can't be satisfied.
+    """
+    match = RANGE_RE.match(header or '')
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last:
+            return None
+        # A suffix range: the last `last` bytes.
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    if start > end or start >= size:
+        raise ValueError
+    return start, end
+
+
+def iter_range(file, start, length):
+    with file:
+        file.seek(start)
+        while length > 0:
+            data = file.read(min(length, CHUNK_SIZE))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def send_file(request, fullpath, statobj):
+    last_modified = http_date(statobj.st_mtime)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    try:
+        # A Range is only honoured for the copy the client already has part of.
+        byte_range = get_range(request.META.get('HTTP_RANGE'), statobj.st_size) \
+            if if_range in (None, last_modified) else None
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{statobj.st_size}'
+        return response
+    if byte_range is None:
+        return FileResponse(open(fullpath, 'rb'))
+    start, end = byte_range
+    response = StreamingHttpResponse(iter_range(open(fullpath, 'rb'), start, end - start + 1), status=206)
+    response['Content-Range'] = f'bytes {start}-{end}/{statobj.st_size}'
+    response['Content-Length'] = end - start + 1
+    return response
+
+
+@require_safe
+def serve(request, path):
+    path = posixpath.normpath(path).lstrip('/')
+    try:
+        fullpath = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404
+    try:
+        statobj = os.stat(fullpath)
+    except (FileNotFoundError, NotADirectoryError):
+        raise Http404
+    if not os.path.isfile(fullpath):
+        raise Http404
+    cache_control = IMMUTABLE_CACHE_CONTROL if is_content_name(path) else REVALIDATE_CACHE_CONTROL
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), statobj.st_mtime):
+        response = HttpResponseNotModified()
+        response['Cache-Control'] = cache_control
+        return response
+
+    mode = settings.RECIPE_MEDIA_SERVING
+    if mode == 'x-accel-redirect':
+        response = HttpResponse()
+        response['X-Accel-Redirect'] = quote(settings.RECIPE_MEDIA_ACCEL_PREFIX.rstrip('/') + '/' + path)
+    elif mode == 'x-sendfile':
+        response = HttpResponse()
+        response['X-Sendfile'] = fullpath
+    else:
+        response = send_file(request, fullpath, statobj)
+    content_type, encoding = mimetypes.guess_type(path)
+    response['Content-Type'] = content_type or 'application/octet-stream'
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Last-Modified'] = http_date(statobj.st_mtime)
+    response['Accept-Ranges'] = 'bytes'
+    response['Cache-Control'] = cache_control
+    return response
+
+
+def urlpatterns():
+    prefix = re.escape(settings.MEDIA_URL.lstrip('/'))
+    return [re_path(rf'^{prefix}(?P<path>.*)$', serve, name='media')]
@@ -23,6 +23,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     # Third-party apps
     'rest_framework',
@@ -56,8 +57,15 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [BASE_DIR / 'templates'],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # Compile each template once per process, also for Celery
+            # workers rendering emails.
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -125,6 +133,14 @@ USE_TZ = True
 STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 
+# Uploaded files. RECIPE_MEDIA_SERVING is 'static' (DEBUG only), 'python',
+# 'x-accel-redirect' or 'x-sendfile', see config.media. With nginx, an
+# internal location at RECIPE_MEDIA_ACCEL_PREFIX must alias MEDIA_ROOT.
+MEDIA_URL = '/media/'
+MEDIA_ROOT = config('MEDIA_ROOT', default=os.path.join(BASE_DIR, 'media'))
+RECIPE_MEDIA_SERVING = config('RECIPE_MEDIA_SERVING', default='static')
+RECIPE_MEDIA_ACCEL_PREFIX = config('RECIPE_MEDIA_ACCEL_PREFIX', default='/protected-media/')
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
@@ -139,13 +155,27 @@ CORS_ORIGIN_ALLOW_ALL = True
 ALLOWED_HOSTS = ['*']  
 
 
-# Email config
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# Email config. Mail is queued in the outbox table and delivered through
+# RECIPE_EMAIL_DELIVERY_BACKEND by the outbox worker, see recipe.outbox.
+EMAIL_BACKEND = 'recipe.outbox.EmailBackend'
+RECIPE_EMAIL_DELIVERY_BACKEND = config('RECIPE_EMAIL_DELIVERY_BACKEND',
+                                       default='django.core.mail.backends.smtp.EmailBackend')
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_USE_TLS = True
 EMAIL_PORT = 587
 EMAIL_HOST_USER = config('EMAIL_USER')
 EMAIL_HOST_PASSWORD = config('EMAIL_PASSWORD')
+DEFAULT_FROM_EMAIL = config('DEFAULT_FROM_EMAIL', default=EMAIL_HOST_USER)
+# Base URL of links in emails, which are built outside any request.
+RECIPE_SITE_URL = config('RECIPE_SITE_URL', default='http://localhost:8000')
+# Messages delivered per outbox batch, and per recipient domain a minute.
+RECIPE_OUTBOX_BATCH_SIZE = config('RECIPE_OUTBOX_BATCH_SIZE', default=100, cast=int)
+RECIPE_OUTBOX_DOMAIN_RATE = config('RECIPE_OUTBOX_DOMAIN_RATE', default=60, cast=int)
+# Seconds before the first retry of a failed message, doubled after each.
+RECIPE_OUTBOX_RETRY_DELAY = config('RECIPE_OUTBOX_RETRY_DELAY', default=60, cast=int)
+RECIPE_OUTBOX_MAX_ATTEMPTS = config('RECIPE_OUTBOX_MAX_ATTEMPTS', default=6, cast=int)
+# Days delivered and failed messages are kept.
+RECIPE_OUTBOX_RETENTION = config('RECIPE_OUTBOX_RETENTION', default=7, cast=int)
 
 
 REST_FRAMEWORK = {
@@ -157,6 +187,8 @@ REST_FRAMEWORK = {
         'django_filters.rest_framework.DjangoFilterBackend',
     ),
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
+    'DEFAULT_PAGINATION_CLASS': 'recipe.pagination.RecipeCursorPagination',
+    'PAGE_SIZE': 20,
 }
 
 SPECTACULAR_SETTINGS = {
@@ -204,6 +236,53 @@ CELERY_BROKER_URL = config('CELERYBROKERURL')
 CELERY_RESULT_BACKEND = config('CELERYRESULTBACKEND')
 
 
+# Cache (shares the Celery Redis instance unless CACHE_URL is set)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': config('CACHE_URL', default=CELERY_BROKER_URL),
+    }
+}
+
+# Lifetime of cached recipe responses in seconds, 0 disables the cache.
+# Entries are invalidated on writes; the timeout is only a safety net.
+RECIPE_CACHE_TIMEOUT = config('RECIPE_CACHE_TIMEOUT', default=60 * 15, cast=int)
+# Autocomplete suggestions are cached per typed prefix for a short while.
+RECIPE_AUTOCOMPLETE_CACHE_TIMEOUT = config('RECIPE_AUTOCOMPLETE_CACHE_TIMEOUT', default=60, cast=int)
+# Seconds a process keeps its in-memory copy of the categories, 0 disables
+# it. Changes are announced to every process over Redis pub/sub.
+RECIPE_CATEGORY_CACHE_TIMEOUT = config('RECIPE_CATEGORY_CACHE_TIMEOUT', default=60 * 10, cast=int)
+RECIPE_CATEGORY_CACHE_URL = config('RECIPE_CATEGORY_CACHE_URL', default=CACHES['default']['LOCATION'])
+# Buffer likes in Redis and write them to the database in batches, see
+# recipe.like_buffer. Needs the flush-like-buffer beat task.
+RECIPE_LIKE_BUFFER = config('RECIPE_LIKE_BUFFER', default=False, cast=bool)
+RECIPE_LIKE_BUFFER_URL = config('RECIPE_LIKE_BUFFER_URL', default=CACHES['default']['LOCATION'])
+RECIPE_LIKE_BUFFER_PREFIX = 'recipe:likes'
+# Largest number of recipes accepted by one batch create/update request.
+RECIPE_BATCH_MAX_SIZE = config('RECIPE_BATCH_MAX_SIZE', default=1000, cast=int)
+# Largest number of recipe ids accepted by one bookmark add/remove request.
+RECIPE_BOOKMARK_BATCH_MAX_SIZE = config('RECIPE_BOOKMARK_BATCH_MAX_SIZE', default=500, cast=int)
+# Like digests sent over one SMTP connection by one Celery task.
+RECIPE_DIGEST_BATCH_SIZE = config('RECIPE_DIGEST_BATCH_SIZE', default=200, cast=int)
+# Hours after which a like counts half as much in the trending feed.
+RECIPE_TRENDING_HALF_LIFE = config('RECIPE_TRENDING_HALF_LIFE', default=24, cast=float)
+# Seconds a row may be stamped before its transaction starts, or a host's
+# clock be ahead; incremental readers stay this far behind, see
+# recipe.visibility.
+RECIPE_COMMIT_LAG = config('RECIPE_COMMIT_LAG', default=60, cast=int)
+# Resumable picture and avatar uploads, see recipe.uploads: who receives the
+# chunks ('nginx' or 'python'), where nginx writes request bodies (on the
+# filesystem of RECIPE_UPLOAD_ROOT), where partial files are kept, the
+# largest file and chunk accepted in bytes, and the seconds an upload slot
+# stays valid.
+RECIPE_UPLOAD_RECEIVER = config('RECIPE_UPLOAD_RECEIVER', default='python')
+RECIPE_UPLOAD_INCOMING = config('RECIPE_UPLOAD_INCOMING', default=os.path.join(BASE_DIR, 'uploads', 'incoming'))
+RECIPE_UPLOAD_ROOT = config('RECIPE_UPLOAD_ROOT', default=os.path.join(BASE_DIR, 'uploads', 'slots'))
+RECIPE_UPLOAD_MAX_SIZE = config('RECIPE_UPLOAD_MAX_SIZE', default=20 * 1024 * 1024, cast=int)
+RECIPE_UPLOAD_CHUNK_SIZE = config('RECIPE_UPLOAD_CHUNK_SIZE', default=1024 * 1024, cast=int)
+RECIPE_UPLOAD_SLOT_MAX_AGE = config('RECIPE_UPLOAD_SLOT_MAX_AGE', default=60 * 60 * 24, cast=int)
+
+
 #loggging
 
 
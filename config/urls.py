@@ -4,6 +4,8 @@ from django.conf import settings
 from django.conf.urls.static import static
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 
+from . import media
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/user/', include('users.urls', namespace='users')),
@@ -13,8 +15,11 @@ urlpatterns = [
          include('django_rest_passwordreset.urls', namespace='password_reset')),
 ]
 
-# Media Assets
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Media Assets, see config.media
+if settings.RECIPE_MEDIA_SERVING == 'static':
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+else:
+    urlpatterns += media.urlpatterns()
 
 # Schema URLs
 urlpatterns += [
@@ -0,0 +1,72 @@
+import socketserver
+import threading
+from email import message_from_bytes
+
+import pytest
+from django.core.cache import cache
+
+
+@pytest.fixture(autouse=True)
+def isolated_cache(settings):
+    """
+    Give every test an empty local-memory cache instead of the shared Redis,
+    and an empty category registry.
+    """
+    from recipe import categories
+
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    categories.clear()
+
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough SMTP to accept mail from smtplib and keep it in memory.
+    """
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.connections += 1
+        self.reply('220 sink ESMTP')
+        while line := self.rfile.readline():
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 sink')
+            elif command == b'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while (line := self.rfile.readline()) not in (b'.\r\n', b''):
+                    lines.append(line)
+                with sink.lock:
+                    sink.messages.append(message_from_bytes(b''.join(lines)))
+                self.reply('250 OK')
+            elif command == b'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+@pytest.fixture
+def smtp_sink(settings):
+    """
+    A local SMTP server the smtp email backend is pointed at. It records
+    its connections and the messages it received.
+    """
+    sink = socketserver.ThreadingTCPServer(('127.0.0.1', 0), SMTPSinkHandler)
+    sink.daemon_threads = True
+    sink.lock = threading.Lock()
+    sink.connections = 0
+    sink.messages = []
+    thread = threading.Thread(target=sink.serve_forever, daemon=True)
+    thread.start()
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    settings.EMAIL_HOST, settings.EMAIL_PORT = sink.server_address
+    settings.EMAIL_USE_TLS = False
+    settings.EMAIL_HOST_USER = settings.EMAIL_HOST_PASSWORD = ''
+    yield sink
+    sink.shutdown()
+    sink.server_close()
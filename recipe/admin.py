@@ -1,7 +1,9 @@
 from django.contrib import admin
-from .models import RecipeCategory, Recipe, RecipeLike
+from .models import RecipeCategory, Recipe, RecipeLike, Ingredient, OutboxEmail
 
 # Register your models here.
 admin.site.register(RecipeCategory)
 admin.site.register(Recipe)
 admin.site.register(RecipeLike)
+admin.site.register(Ingredient)
+admin.site.register(OutboxEmail)
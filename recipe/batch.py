@@ -0,0 +1,144 @@
+"""
+Batch creation and update of recipes.
+
+Items are validated one by one, then written with bulk_create/bulk_update in
+transactions of WRITE_CHUNK_SIZE items. Categories are looked up once for the
+whole batch. Bulk writes send no model signals, so the work of the Recipe
+post_save receivers (ingredient index, facet counts, response cache) is
+done here for each chunk.
+"""
+import logging
+
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from . import cache, categories, facets
+from .ingredients import sync_recipe_ingredients
+from .models import Recipe, RecipeCategory
+from .serializers import RecipeBatchSerializer
+
+logger = logging.getLogger(__name__)
+
+WRITE_CHUNK_SIZE = 200
+
+
+def error_result(index, errors):
+    return {'index': index, 'status': 'error', 'errors': errors}
+
+
+def resolve_categories(names):
+    """
+    Map category names to RecipeCategory rows, creating the missing ones.
+    """
+    if not names:
+        return {}
+    found = categories.get_categories(names)
+    missing = names - set(found)
+    if missing:
+        # A concurrent batch may create the same names; theirs are fetched back.
+        RecipeCategory.objects.bulk_create(
+            [RecipeCategory(name=name) for name in sorted(missing)], ignore_conflicts=True)
+        categories.notify_changed()
+        found.update((category.name, category) for category in RecipeCategory.objects.filter(name__in=missing))
+    return found
+
+
+def validate_items(author, items):
+    """
+    Return (results, entries): an error result for every invalid item and an
+    (index, validated_data, recipe) entry for every valid one, where recipe
+    is the author's recipe to update or None for a new one.
+    """
+    results = {}
+    validated = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[index] = error_result(index, {'non_field_errors': ['Expected a recipe object.']})
+            continue
+        serializer = RecipeBatchSerializer(data=item, partial='id' in item)
+        if serializer.is_valid():
+            validated.append((index, serializer.validated_data))
+        else:
+            results[index] = error_result(index, serializer.errors)
+
+    update_ids = {data['id'] for _, data in validated if 'id' in data}
+    recipes = Recipe.objects.filter(author=author).in_bulk(update_ids) if update_ids else {}
+
+    entries = []
+    seen = set()
+    for index, data in validated:
+        recipe_id = data.pop('id', None)
+        if recipe_id is None:
+            entries.append((index, data, None))
+        elif recipe_id not in recipes:
+            results[index] = error_result(index, {'id': ['Recipe not found.']})
+        elif recipe_id in seen:
+            results[index] = error_result(index, {'id': ['Recipe is updated more than once in this batch.']})
+        else:
+            seen.add(recipe_id)
+            entries.append((index, data, recipes[recipe_id]))
+    return results, entries
+
+
+def write_chunk(author, entries, categories_by_name):
+    """
+    Write one chunk of validated entries in a single transaction and return
+    their results.
+    """
+    results = {}
+    created = []
+    updated = []
+    update_fields = {'updated_at'}
+    now = timezone.now()
+    for index, data, recipe in entries:
+        category = data.pop('category', None)
+        if category is not None:
+            data['category'] = categories_by_name[category['name']]
+        if recipe is None:
+            created.append((index, Recipe(author=author, **data)))
+        else:
+            for field, value in data.items():
+                setattr(recipe, field, value)
+            recipe.updated_at = now
+            update_fields.update(data)
+            updated.append((index, recipe))
+
+    with transaction.atomic():
+        facets.apply_deltas(facets.count_changes([recipe for _, recipe in created + updated]))
+        Recipe.objects.bulk_create([recipe for _, recipe in created])
+        if updated:
+            Recipe.objects.bulk_update([recipe for _, recipe in updated], sorted(update_fields))
+        reindexed = [recipe for _, recipe in created]
+        if 'ingredients' in update_fields:
+            reindexed += [recipe for _, recipe in updated]
+        sync_recipe_ingredients(reindexed)
+        cache.invalidate_recipes([recipe.pk for _, recipe in updated])
+
+    for index, recipe in created:
+        results[index] = {'index': index, 'status': 'created', 'id': recipe.pk}
+    for index, recipe in updated:
+        results[index] = {'index': index, 'status': 'updated', 'id': recipe.pk}
+    return results
+
+
+def save_recipe_batch(author, items, chunk_size=WRITE_CHUNK_SIZE):
+    """
+    Create or update `items` on behalf of `author` and return one result per
+    item, in the order of `items`. A chunk that fails to write reports an
+    error for each of its items without affecting the other chunks.
+    """
+    results, entries = validate_items(author, items)
+    categories_by_name = resolve_categories({data['category']['name'] for _, data, _ in entries if 'category' in data})
+
+    for start in range(0, len(entries), chunk_size):
+        chunk = entries[start:start + chunk_size]
+        try:
+            results.update(write_chunk(author, chunk, categories_by_name))
+        except DatabaseError as e:
+            logger.error(f'Recipe batch chunk failed: {e}')
+            for index, _, _ in chunk:
+                results[index] = error_result(index, {'non_field_errors': ['The recipe could not be saved.']})
+
+    if entries:
+        cache.invalidate_lists()
+    return [results[index] for index in range(len(items))]
@@ -0,0 +1,103 @@
+"""
+Response cache for the recipe read endpoints.
+
+Every cached entry records the version tokens of what it was built from: a
+global generation (bumped when new recipes or categories can show up in any
+list) plus one token per recipe it contains. Invalidating a recipe replaces
+its token, so every entry that embedded it becomes a miss on the next read
+without having to find or delete those entries.
+"""
+import hashlib
+import logging
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+GENERATION_KEY = 'recipe:generation'
+
+
+def recipe_version_key(recipe_id):
+    return f'recipe:{recipe_id}:version'
+
+
+def get_timeout():
+    return getattr(settings, 'RECIPE_CACHE_TIMEOUT', 60 * 15)
+
+
+def response_cache_key(request, scope):
+    """
+    Key on the endpoint, the full query string (filters, cursor, fields) and
+    the negotiated renderer. Authenticated responses are cached per user so
+    per-user data never leaks between users.
+    """
+    user = request.user
+    audience = f'user:{user.pk}' if user.is_authenticated else 'anon'
+    renderer = getattr(request, 'accepted_media_type', '')
+    raw = repr((request.get_host(), request.path, sorted(request.query_params.lists()), renderer))
+    digest = hashlib.md5(raw.encode('utf-8')).hexdigest()
+    return f'recipe:response:{scope}:{audience}:{digest}'
+
+
+def get_cached_data(key):
+    """
+    Return the cached payload for `key`, or None if missing or stale.
+    """
+    if not get_timeout():
+        return None
+    try:
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        current = cache.get_many(list(entry['versions']))
+    except Exception as e:
+        logger.warning(f'Recipe cache read failed: {e}')
+        return None
+    for version_key, token in entry['versions'].items():
+        if current.get(version_key) != token:
+            return None
+    return entry['data']
+
+
+def set_cached_data(key, data, recipe_ids, timeout=None):
+    if not get_timeout():
+        return
+    timeout = timeout or get_timeout()
+    version_keys = [GENERATION_KEY] + [recipe_version_key(recipe_id) for recipe_id in recipe_ids]
+    try:
+        versions = cache.get_many(version_keys)
+        missing = [version_key for version_key in version_keys if version_key not in versions]
+        if missing:
+            # add() keeps any token a concurrent invalidation just wrote.
+            for version_key in missing:
+                cache.add(version_key, uuid4().hex, None)
+            versions.update(cache.get_many(missing))
+        cache.set(key, {'data': data, 'versions': versions}, timeout)
+    except Exception as e:
+        logger.warning(f'Recipe cache write failed: {e}')
+
+
+def _bump(version_keys):
+    try:
+        cache.set_many({version_key: uuid4().hex for version_key in version_keys}, None)
+    except Exception as e:
+        logger.error(f'Recipe cache invalidation failed: {e}')
+
+
+def invalidate_recipes(recipe_ids):
+    """
+    Expire every cached response that contains one of `recipe_ids`.
+    """
+    version_keys = [recipe_version_key(recipe_id) for recipe_id in recipe_ids]
+    if version_keys:
+        transaction.on_commit(lambda: _bump(version_keys))
+
+
+def invalidate_lists():
+    """
+    Expire every cached response, e.g. when a recipe may enter a list.
+    """
+    transaction.on_commit(lambda: _bump([GENERATION_KEY]))
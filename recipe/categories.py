@@ -0,0 +1,159 @@
+"""
+Process-local registry of recipe categories.
+
+Categories are a handful of rows needed on every recipe write, so each
+process loads them once and keeps them in memory. Changes are announced on
+a Redis pub/sub channel after they commit; every process listens on a
+daemon thread and drops its copy when an announcement arrives.
+
+While the listener is not subscribed (at startup or after losing its
+connection) announcements could be missed, so the registry is not used and
+lookups go to the database. Copies also expire after
+RECIPE_CATEGORY_CACHE_TIMEOUT seconds as a safety net; 0 disables the
+registry. It is only filled outside of transactions, so it never holds a
+category that might still be rolled back.
+"""
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import RecipeCategory
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'recipe:categories:changed'
+DEFAULT_CATEGORY_NAME = 'Others'
+# Seconds between pings on the listener connection, and between reconnects.
+PING_INTERVAL = 30
+RECONNECT_DELAY = 5
+
+_lock = threading.Lock()
+_listening = threading.Event()
+_state = {'pid': None, 'generation': 0, 'registry': None, 'loaded_at': 0.0}
+
+
+@lru_cache(maxsize=None)
+def get_client(url):
+    return redis.Redis.from_url(url, health_check_interval=PING_INTERVAL)
+
+
+def get_redis():
+    return get_client(settings.RECIPE_CATEGORY_CACHE_URL)
+
+
+def clear():
+    """
+    Drop this process' copy of the categories.
+    """
+    with _lock:
+        _state['generation'] += 1
+        _state['registry'] = None
+
+
+def listen():
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CHANNEL)
+            # Anything may have changed while we were not subscribed.
+            clear()
+            _listening.set()
+            while True:
+                if pubsub.get_message(timeout=PING_INTERVAL) is not None:
+                    clear()
+        except Exception:
+            _listening.clear()
+            clear()
+            logger.warning('Category change listener disconnected, retrying.', exc_info=True)
+            time.sleep(RECONNECT_DELAY)
+
+
+def ensure_listener():
+    if _state['pid'] == os.getpid():
+        return
+    with _lock:
+        if _state['pid'] == os.getpid():
+            return
+        # First use in this process, or a fork of a process that had one.
+        _state['pid'] = os.getpid()
+        _state['generation'] += 1
+        _state['registry'] = None
+        _listening.clear()
+        threading.Thread(target=listen, name='recipe-category-listener', daemon=True).start()
+
+
+def get_registry():
+    """
+    Map category names to (id, name) rows, or None if the registry can't be
+    trusted right now.
+    """
+    timeout = settings.RECIPE_CATEGORY_CACHE_TIMEOUT
+    if not timeout:
+        return None
+    ensure_listener()
+    if not _listening.is_set():
+        return None
+    registry = _state['registry']
+    if registry is not None and time.monotonic() - _state['loaded_at'] < timeout:
+        return registry
+    if connection.in_atomic_block:
+        return None
+
+    generation = _state['generation']
+    registry = {name: (pk, name) for pk, name in RecipeCategory.objects.values_list('id', 'name')}
+    with _lock:
+        # Don't keep the rows if a change was announced while loading them.
+        if _state['generation'] == generation:
+            _state['registry'] = registry
+            _state['loaded_at'] = time.monotonic()
+    return registry
+
+
+def to_instance(row):
+    return RecipeCategory.from_db(connection.alias, ['id', 'name'], row)
+
+
+def get_categories(names):
+    """
+    Map the existing ones of `names` to RecipeCategory instances.
+    """
+    names = set(names)
+    registry = get_registry()
+    if registry is None:
+        return {category.name: category for category in RecipeCategory.objects.filter(name__in=names)}
+    return {name: to_instance(registry[name]) for name in names if name in registry}
+
+
+def get_or_create_category(name):
+    """
+    The category called `name`, created if needed. Costs no query when the
+    registry knows it.
+    """
+    category = get_categories([name]).get(name)
+    if category is None:
+        category = RecipeCategory.objects.get_or_create(name=name)[0]
+    return category
+
+
+def publish():
+    clear()
+    try:
+        get_redis().publish(CHANNEL, os.getpid())
+    except redis.RedisError:
+        # Other processes catch up when their copy expires.
+        logger.warning('Could not announce a category change.', exc_info=True)
+
+
+def notify_changed():
+    """
+    Announce that categories were created, renamed or deleted. Call it for
+    writes that bypass the RecipeCategory signals, such as bulk_create.
+    """
+    clear()
+    transaction.on_commit(publish)
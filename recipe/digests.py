@@ -0,0 +1,77 @@
+"""
+Daily digests of the likes each author's recipes received.
+
+get_like_digests() reads the likes of one day in a single query, a range
+scan of recipelike_created_idx grouped by recipe, and folds the rows into
+one digest per author. recipe.tasks.send_daily_notifications splits the
+digests into batches of RECIPE_DIGEST_BATCH_SIZE, sent in parallel by
+Celery workers, each batch over one connection of the email backend (which
+queues them in the outbox, see recipe.outbox).
+"""
+import logging
+import smtplib
+from datetime import date, datetime, time, timedelta
+
+from django.core.mail import EmailMessage, get_connection
+from django.db.models import Count
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .models import RecipeLike
+
+logger = logging.getLogger(__name__)
+
+SUBJECT = 'Your recipes were liked'
+
+
+def get_day_range(day=None):
+    """
+    The [start, end) datetimes of `day` (an ISO date, yesterday by default)
+    in the current time zone.
+    """
+    day = date.fromisoformat(day) if day else timezone.localdate() - timedelta(days=1)
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+    return start, end
+
+
+def get_like_digests(start, end):
+    """
+    One digest per author whose recipes were liked in [start, end), with
+    the recipes most liked first.
+    """
+    rows = (RecipeLike.objects.filter(created__gte=start, created__lt=end)
+            .values('recipe__author_id', 'recipe__author__email', 'recipe__author__username',
+                    'recipe_id', 'recipe__title')
+            .annotate(likes=Count('id'))
+            .order_by('recipe__author_id', '-likes', 'recipe_id'))
+    digests = []
+    for row in rows.iterator(chunk_size=2000):
+        if not digests or digests[-1]['author'] != row['recipe__author_id']:
+            digests.append({'author': row['recipe__author_id'], 'email': row['recipe__author__email'],
+                            'username': row['recipe__author__username'], 'day': start.date().isoformat(),
+                            'likes': 0, 'recipes': []})
+        digests[-1]['likes'] += row['likes']
+        digests[-1]['recipes'].append({'id': row['recipe_id'], 'title': row['recipe__title'],
+                                       'likes': row['likes']})
+    return digests
+
+
+def build_message(digest):
+    context = dict(digest, day=date.fromisoformat(digest['day']))
+    return EmailMessage(SUBJECT, render_to_string('recipe/like_digest.txt', context), to=[digest['email']])
+
+
+def send_digests(digests):
+    """
+    Send `digests` over a single SMTP connection. Returns the number sent;
+    refused recipients are logged and skipped, connection errors raise.
+    """
+    sent = 0
+    with get_connection() as connection:
+        for digest in digests:
+            try:
+                sent += connection.send_messages([build_message(digest)])
+            except (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError) as e:
+                logger.error(f"Failed to send the like digest of author {digest['author']}: {e}")
+    return sent
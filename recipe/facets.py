@@ -0,0 +1,148 @@
+"""
+Recipe counts per category, and per author and category, for browse facets.
+
+RecipeCategory.recipes_count and the AuthorCategoryCount rows are adjusted
+in the transaction of every recipe create, delete and category change, so
+facets read a few aggregate rows instead of grouping the recipe table.
+Every adjustment locks the category rows it touches first, and
+reconcile_category() recounts a category under the same lock, so a
+reconcile never loses an adjustment that commits alongside it. Writes made
+outside a transaction can still drift by one until the next reconcile.
+"""
+from collections import Counter
+
+from django.db import connection, transaction
+from django.db.models import Count
+
+from .models import AuthorCategoryCount, Recipe, RecipeCategory
+
+
+def get_key(recipe):
+    """
+    The (author_id, category_id) a recipe is counted under, or None if it
+    isn't saved or those fields weren't loaded.
+    """
+    if recipe.pk is None or {'author_id', 'category_id'} & recipe.get_deferred_fields():
+        return None
+    return recipe.author_id, recipe.category_id
+
+
+def count_changes(recipes):
+    """
+    Count deltas for saving `recipes`, whose `_facet_key` holds the key they
+    were loaded with (None for new recipes).
+    """
+    deltas = Counter()
+    for recipe in recipes:
+        old = getattr(recipe, '_facet_key', None)
+        new = (recipe.author_id, recipe.category_id)
+        if old != new:
+            if old is not None:
+                deltas[old] -= 1
+            deltas[new] += 1
+    return deltas
+
+
+def _tables():
+    quote = connection.ops.quote_name
+    field = AuthorCategoryCount._meta.get_field
+    return {
+        'category_table': quote(RecipeCategory._meta.db_table),
+        'category_id': quote(RecipeCategory._meta.get_field('id').column),
+        'category_count': quote(RecipeCategory._meta.get_field('recipes_count').column),
+        'count_table': quote(AuthorCategoryCount._meta.db_table),
+        'author': quote(field('author').column),
+        'category': quote(field('category').column),
+        'recipes_count': quote(field('recipes_count').column),
+    }
+
+
+def apply_deltas(deltas):
+    """
+    Add {(author_id, category_id): delta} to the category and author counts.
+    """
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    by_category = Counter()
+    for (_, category_id), delta in deltas.items():
+        by_category[category_id] += delta
+    added = [(key, delta) for key, delta in sorted(deltas.items()) if delta > 0]
+    removed = [(key, delta) for key, delta in sorted(deltas.items()) if delta < 0]
+    tables = _tables()
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Lock in id order so concurrent writes can't deadlock each other.
+        cursor.execute('''
+            UPDATE {category_table} SET {category_count} = GREATEST({category_count} + change.delta, 0)
+            FROM (
+                SELECT {category_table}.{category_id} AS id, change.delta
+                FROM {category_table} JOIN unnest(%s::bigint[], %s::int[]) AS change (id, delta)
+                    ON {category_table}.{category_id} = change.id
+                ORDER BY 1 FOR UPDATE OF {category_table}
+            ) AS change
+            WHERE {category_table}.{category_id} = change.id
+        '''.format(**tables), [list(by_category), list(by_category.values())])
+        if added:
+            cursor.execute('''
+                INSERT INTO {count_table} ({author}, {category}, {recipes_count})
+                SELECT change.author_id, change.category_id, change.delta
+                FROM unnest(%s::bigint[], %s::bigint[], %s::int[]) AS change (author_id, category_id, delta)
+                ON CONFLICT ({author}, {category})
+                DO UPDATE SET {recipes_count} = {count_table}.{recipes_count} + EXCLUDED.{recipes_count}
+            '''.format(**tables), [[key[0] for key, _ in added], [key[1] for key, _ in added],
+                                   [delta for _, delta in added]])
+        if removed:
+            # Rows of deleted authors may already be gone, never recreate them.
+            cursor.execute('''
+                UPDATE {count_table} SET {recipes_count} = GREATEST({recipes_count} + change.delta, 0)
+                FROM unnest(%s::bigint[], %s::bigint[], %s::int[]) AS change (author_id, category_id, delta)
+                WHERE {count_table}.{author} = change.author_id
+                  AND {count_table}.{category} = change.category_id
+            '''.format(**tables), [[key[0] for key, _ in removed], [key[1] for key, _ in removed],
+                                   [delta for _, delta in removed]])
+
+
+def reconcile_category(category_id):
+    """
+    Recount one category from the recipe table. Returns True if any count
+    had drifted.
+    """
+    with transaction.atomic():
+        category = RecipeCategory.objects.select_for_update().filter(pk=category_id).first()
+        if category is None:
+            return False
+        counts = dict(Recipe.objects.filter(category_id=category_id).order_by()
+                      .values_list('author').annotate(total=Count('id')))
+        stored = dict(AuthorCategoryCount.objects.filter(category_id=category_id)
+                      .values_list('author_id', 'recipes_count'))
+        total = sum(counts.values())
+        changed = category.recipes_count != total
+        if changed:
+            RecipeCategory.objects.filter(pk=category_id).update(recipes_count=total)
+
+        stale = [author_id for author_id, count in stored.items() if counts.get(author_id, 0) != count]
+        if stale:
+            changed = True
+            AuthorCategoryCount.objects.filter(category_id=category_id, author_id__in=stale).delete()
+            AuthorCategoryCount.objects.bulk_create([
+                AuthorCategoryCount(author_id=author_id, category_id=category_id, recipes_count=counts[author_id])
+                for author_id in stale if counts.get(author_id)
+            ])
+        missing = [author_id for author_id in counts if author_id not in stored]
+        if missing:
+            changed = True
+            AuthorCategoryCount.objects.bulk_create([
+                AuthorCategoryCount(author_id=author_id, category_id=category_id, recipes_count=counts[author_id])
+                for author_id in missing
+            ])
+        return changed
+
+
+def reconcile():
+    """
+    Recount every category, one transaction each. Returns the number of
+    categories that had drifted.
+    """
+    return sum(reconcile_category(category_id)
+               for category_id in RecipeCategory.objects.order_by('pk').values_list('pk', flat=True))
@@ -0,0 +1,132 @@
+"""
+Resized renditions of recipe pictures.
+
+Uploads are stored as sent. Once the upload has committed,
+recipe.tasks.process_recipe_picture reads the original and writes one
+rendition per width in RENDITION_WIDTHS (none wider than the original) in
+every format of RENDITION_FORMATS. Renditions are rotated upright and then
+encoded from the pixels alone, so EXIF (including GPS positions), ICC
+profiles and comments are not carried over.
+
+Renditions are named after a hash of their content like the pictures (see
+users.storage), so a name never changes meaning and can be cached for good.
+Recipe.picture_renditions records which picture the renditions were made
+from; serializers ignore the renditions of a replaced picture until the new
+ones are written.
+"""
+import io
+import logging
+
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import ExifTags, Image, ImageOps, UnidentifiedImageError
+
+from . import cache
+from .models import Recipe
+
+logger = logging.getLogger(__name__)
+
+RENDITION_DIR = 'renditions/recipes'
+RENDITION_WIDTHS = (320, 640, 1280)
+# format: (Pillow format, media type, save options)
+RENDITION_FORMATS = {
+    'webp': ('WEBP', 'image/webp', {'quality': 80, 'method': 4}),
+    'jpeg': ('JPEG', 'image/jpeg', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+# EXIF orientations that swap width and height.
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+
+
+def get_upright_size(image):
+    width, height = image.size
+    if image.getexif().get(ExifTags.Base.Orientation) in TRANSPOSED_ORIENTATIONS:
+        return height, width
+    return width, height
+
+
+def get_widths(width):
+    """
+    Rendition widths for a picture `width` pixels wide. Pictures narrower
+    than the largest width also get a rendition at their own width.
+    """
+    return [w for w in RENDITION_WIDTHS if w < width] + [min(width, RENDITION_WIDTHS[-1])]
+
+
+def encode(image, image_format, options):
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A') if image.mode == 'RGBA' else None)
+        image = background
+    output = io.BytesIO()
+    image.save(output, image_format, **options)
+    return output.getvalue()
+
+
+def render(image, width, height, storage, prefix):
+    """
+    Write the renditions of an upright `image` and return their descriptions.
+    """
+    # Decode large JPEGs at a reduced scale, still at least as big as needed.
+    largest = get_widths(width)[-1]
+    image.draft('RGB', (largest, largest))
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+
+    variants = []
+    for rendition_width in get_widths(width):
+        rendition_height = max(round(height * rendition_width / width), 1)
+        resized = image.resize((rendition_width, rendition_height), Image.LANCZOS, reducing_gap=3.0)
+        for extension, (image_format, media_type, options) in RENDITION_FORMATS.items():
+            name = storage.save(f'{prefix}/{rendition_width}.{extension}',
+                                ContentFile(encode(resized, image_format, options)))
+            variants.append({'name': name, 'type': media_type,
+                             'width': rendition_width, 'height': rendition_height})
+    return variants
+
+
+def process_picture(recipe_id):
+    """
+    Write the renditions of the recipe's current picture and record them.
+    Returns False if there was nothing to do or the picture can't be read.
+    """
+    recipe = Recipe.objects.filter(pk=recipe_id).only('id', 'picture', 'picture_renditions').first()
+    if recipe is None or not recipe.picture:
+        return False
+    name = recipe.picture.name
+    storage = recipe.picture.storage
+    try:
+        with storage.open(name, 'rb') as original:
+            data = original.read()
+    except FileNotFoundError:
+        logger.warning(f'Picture {name} of recipe {recipe_id} is missing')
+        return False
+    prefix = f'{RENDITION_DIR}/{recipe_id}'
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = get_upright_size(image)
+            variants = render(image, width, height, storage, prefix)
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        logger.warning(f'Could not process picture {name} of recipe {recipe_id}: {e}')
+        return False
+
+    # Skipped if the picture was replaced meanwhile; its own task records it.
+    updated = Recipe.objects.filter(pk=recipe_id, picture=name).update(
+        picture_width=width, picture_height=height,
+        picture_renditions={'source': name, 'variants': variants},
+        updated_at=timezone.now())
+    if updated:
+        cache.invalidate_recipes([recipe_id])
+        delete_replaced(storage, recipe.picture_renditions, variants)
+    return bool(updated)
+
+
+def delete_replaced(storage, renditions, variants):
+    """
+    Delete the files of the previous renditions that the new ones don't reuse.
+    """
+    kept = {variant['name'] for variant in variants}
+    for variant in renditions.get('variants', ()):
+        if variant['name'] not in kept:
+            storage.delete(variant['name'])
@@ -0,0 +1,131 @@
+"""
+Parsing of the free-form Recipe.ingredients text into normalized Ingredient
+rows, and syncing of the recipe/ingredient join table and of
+Ingredient.recipe_count, which the pantry endpoint reads to start from the
+rarest ingredients.
+"""
+import re
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Ingredient, Recipe, RecipeIngredient
+
+SEPARATORS = re.compile(r'[,;\n\r•]+')
+PARENTHESES = re.compile(r'\([^)]*\)')
+WORDS = re.compile(r'[^\W\d_]+')
+
+# Words that describe an amount or a preparation rather than the ingredient.
+IGNORED_WORDS = {
+    'a', 'an', 'and', 'of', 'or', 'to', 'for', 'taste', 'as', 'needed', 'about',
+    'cup', 'cups', 'tbsp', 'tablespoon', 'tablespoons', 'tsp', 'teaspoon', 'teaspoons',
+    'g', 'gm', 'gram', 'grams', 'kg', 'kilogram', 'kilograms', 'mg', 'ml', 'l', 'litre', 'litres',
+    'liter', 'liters', 'oz', 'ounce', 'ounces', 'lb', 'lbs', 'pound', 'pounds',
+    'pinch', 'dash', 'handful', 'piece', 'pieces', 'slice', 'slices', 'clove', 'cloves',
+    'can', 'cans', 'packet', 'packets', 'bunch', 'sprig', 'sprigs', 'stick', 'sticks',
+    'large', 'medium', 'small', 'fresh', 'freshly', 'chopped', 'diced', 'minced', 'sliced',
+    'grated', 'ground', 'finely', 'roughly', 'peeled', 'crushed', 'melted', 'softened',
+    'optional',
+}
+MAX_NAME_LENGTH = Ingredient._meta.get_field('name').max_length
+
+
+def singularize(word):
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'
+    if word.endswith('oes') and len(word) > 4:
+        return word[:-2]
+    if word.endswith('s') and not word.endswith(('ss', 'us', 'is')) and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def normalize_ingredient(text):
+    """
+    '2 cups Chopped Tomatoes (ripe)' -> 'tomato'. Returns None if nothing is left.
+    """
+    words = [word for word in WORDS.findall(PARENTHESES.sub(' ', text.lower()))
+             if word not in IGNORED_WORDS]
+    if not words:
+        return None
+    words[-1] = singularize(words[-1])
+    return ' '.join(words)[:MAX_NAME_LENGTH]
+
+
+def parse_ingredients(text):
+    """
+    Return the set of normalized ingredient names found in `text`.
+    """
+    names = (normalize_ingredient(part) for part in SEPARATORS.split(text or ''))
+    return {name for name in names if name}
+
+
+def get_ingredient_ids(names):
+    """
+    Map normalized names to Ingredient ids, creating missing rows.
+    """
+    if not names:
+        return {}
+    Ingredient.objects.bulk_create([Ingredient(name=name) for name in names], ignore_conflicts=True)
+    return dict(Ingredient.objects.filter(name__in=names).values_list('name', 'id'))
+
+
+def sync_recipe_ingredients(recipes):
+    """
+    Rebuild the ingredient links of `recipes` from their ingredients text
+    with a fixed number of queries per call, whatever the batch size.
+    """
+    parsed = {recipe.pk: parse_ingredients(recipe.ingredients) for recipe in recipes}
+    if not parsed:
+        return
+    ids = get_ingredient_ids(set().union(*parsed.values()))
+
+    with transaction.atomic():
+        links = RecipeIngredient.objects.filter(recipe_id__in=parsed)
+        deltas = Counter(ids[name] for names in parsed.values() for name in names)
+        deltas.subtract(links.values_list('ingredient_id', flat=True))
+        links.delete()
+        RecipeIngredient.objects.bulk_create([
+            RecipeIngredient(recipe_id=recipe_id, ingredient_id=ids[name])
+            for recipe_id, names in parsed.items() for name in names
+        ])
+        adjust_recipe_counts(deltas)
+        counts = {}
+        for recipe_id, names in parsed.items():
+            counts.setdefault(len(names), []).append(recipe_id)
+        for count, recipe_ids in counts.items():
+            Recipe.objects.filter(pk__in=recipe_ids).update(ingredient_count=count)
+
+
+def adjust_recipe_counts(deltas):
+    """
+    Add {ingredient_id: delta} to Ingredient.recipe_count, one query per
+    distinct delta.
+    """
+    by_delta = {}
+    for ingredient_id, delta in deltas.items():
+        if delta:
+            by_delta.setdefault(delta, []).append(ingredient_id)
+    for delta, ingredient_ids in by_delta.items():
+        Ingredient.objects.filter(pk__in=ingredient_ids).update(
+            recipe_count=Greatest(F('recipe_count') + delta, 0))
+
+
+def release_recipe_ingredients(recipe):
+    """
+    Uncount the ingredients of a recipe about to be deleted; its links go
+    with it.
+    """
+    ingredient_ids = recipe.ingredient_links.values_list('ingredient_id', flat=True)
+    adjust_recipe_counts({ingredient_id: -1 for ingredient_id in ingredient_ids})
+
+
+def recount_recipes():
+    """
+    Recompute Ingredient.recipe_count from the links.
+    """
+    counts = (RecipeIngredient.objects.filter(ingredient=OuterRef('pk')).order_by()
+              .values('ingredient').annotate(count=Count('*')).values('count'))
+    Ingredient.objects.update(recipe_count=Coalesce(Subquery(counts), 0))
@@ -0,0 +1,228 @@
+"""
+Write-behind buffer for likes, enabled with RECIPE_LIKE_BUFFER.
+
+Likes and unlikes are recorded in a Redis hash with one field per
+(user, recipe), so repeated taps collapse into the latest state, and are
+written to Postgres in large batches by recipe.tasks.flush_like_buffer.
+Every entry remembers how much it moved its recipe's buffered count delta;
+readers add that delta to Recipe.likes_count until the entry is flushed.
+
+Crash recovery: a flush renames the pending hash to a flushing hash and
+processes it in chunks. A chunk's entries and count deltas are only removed
+from Redis after its database transaction has committed. If a flush dies
+part way, the next one replays what is left of the flushing hash. Replays
+are harmless because the bulk insert ignores existing likes and the bulk
+delete ignores missing ones. Unflushed entries survive worker crashes but
+are only as durable as Redis itself, so run it with appendonly persistence
+when the buffer is enabled.
+"""
+from functools import lru_cache
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from . import cache
+from .models import Recipe, RecipeLike
+
+FLUSH_CHUNK_SIZE = 5000
+RECORD_RETRIES = 5
+
+# KEYS: pending, flushing, deltas, epoch
+# ARGV: entry field, recipe id, wanted state, database state, epoch seen
+RECORD_SCRIPT = """
+if (redis.call('GET', KEYS[4]) or '0') ~= ARGV[5] then
+    return -1
+end
+local state = ARGV[4]
+local contribution = 0
+local entry = redis.call('HGET', KEYS[1], ARGV[1])
+if entry then
+    local sep = string.find(entry, ':')
+    state = string.sub(entry, 1, sep - 1)
+    contribution = tonumber(string.sub(entry, sep + 1))
+else
+    local flushing = redis.call('HGET', KEYS[2], ARGV[1])
+    if flushing then
+        state = string.sub(flushing, 1, string.find(flushing, ':') - 1)
+    end
+end
+if state == ARGV[3] then
+    return 0
+end
+local step = 1
+if ARGV[3] == '0' then
+    step = -1
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3] .. ':' .. (contribution + step))
+redis.call('HINCRBY', KEYS[3], ARGV[2], step)
+return 1
+"""
+
+# KEYS: pending, flushing
+BEGIN_FLUSH_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return 1
+end
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('RENAME', KEYS[1], KEYS[2])
+return 1
+"""
+
+# KEYS: flushing, deltas, epoch
+# ARGV: number of fields, fields..., then (recipe id, contribution) pairs
+FINISH_CHUNK_SCRIPT = """
+local count = tonumber(ARGV[1])
+for i = 2, count + 1 do
+    redis.call('HDEL', KEYS[1], ARGV[i])
+end
+for i = count + 2, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[2], ARGV[i], -tonumber(ARGV[i + 1])) == 0 then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+    end
+end
+redis.call('INCR', KEYS[3])
+return 1
+"""
+
+
+def is_enabled():
+    return getattr(settings, 'RECIPE_LIKE_BUFFER', False)
+
+
+@lru_cache(maxsize=None)
+def get_client(url):
+    return redis.Redis.from_url(url)
+
+
+def get_redis():
+    return get_client(settings.RECIPE_LIKE_BUFFER_URL)
+
+
+def get_keys():
+    prefix = settings.RECIPE_LIKE_BUFFER_PREFIX
+    return {
+        'pending': f'{prefix}:pending',
+        'flushing': f'{prefix}:flushing',
+        'deltas': f'{prefix}:deltas',
+        'epoch': f'{prefix}:epoch',
+    }
+
+
+def entry_field(user_id, recipe_id):
+    return f'{user_id}:{recipe_id}'
+
+
+def parse_entry(value):
+    state, contribution = value.decode().split(':')
+    return state == '1', int(contribution)
+
+
+def record(user_id, recipe_id, liked):
+    """
+    Buffer a like (or an unlike with `liked=False`). Returns False if the
+    user's like state was already `liked`, raises Recipe.DoesNotExist for
+    unknown recipes.
+    """
+    client = get_redis()
+    keys = get_keys()
+    field = entry_field(user_id, recipe_id)
+    for _ in range(RECORD_RETRIES):
+        epoch = (client.get(keys['epoch']) or b'0').decode()
+        # Only consulted when neither hash has an entry for this pair.
+        in_database = (Recipe.objects.filter(pk=recipe_id)
+                       .values_list(Exists(RecipeLike.objects.filter(user_id=user_id, recipe=OuterRef('pk'))),
+                                    flat=True)
+                       .first())
+        if in_database is None:
+            raise Recipe.DoesNotExist
+        result = client.eval(
+            RECORD_SCRIPT, 4, keys['pending'], keys['flushing'], keys['deltas'], keys['epoch'],
+            field, recipe_id, int(liked), int(in_database), epoch)
+        # -1: a flush chunk committed in between, the database state is stale.
+        if result != -1:
+            if result:
+                cache.invalidate_recipes([recipe_id])
+            return bool(result)
+    raise RuntimeError('Like buffer is being flushed too often to record a like.')
+
+
+def get_count_deltas(recipe_ids):
+    """
+    Map recipe ids to the likes count change still waiting in the buffer.
+    """
+    recipe_ids = list(recipe_ids)
+    if not recipe_ids:
+        return {}
+    values = get_redis().hmget(get_keys()['deltas'], recipe_ids)
+    return {recipe_id: int(value) for recipe_id, value in zip(recipe_ids, values) if value}
+
+
+def get_buffered_states(user_id, recipe_ids):
+    """
+    Map recipe ids to the user's buffered like state, for buffered pairs only.
+    """
+    recipe_ids = list(recipe_ids)
+    if not recipe_ids:
+        return {}
+    keys = get_keys()
+    fields = [entry_field(user_id, recipe_id) for recipe_id in recipe_ids]
+    with get_redis().pipeline(transaction=False) as pipe:
+        pipe.hmget(keys['pending'], fields)
+        pipe.hmget(keys['flushing'], fields)
+        pending, flushing = pipe.execute()
+    states = {}
+    for recipe_id, value, flushing_value in zip(recipe_ids, pending, flushing):
+        value = value or flushing_value
+        if value:
+            states[recipe_id] = parse_entry(value)[0]
+    return states
+
+
+def flush_chunk(client, keys, entries):
+    likes = []
+    unlikes = []
+    contributions = {}
+    for field, value in entries:
+        user_id, recipe_id = map(int, field.decode().split(':'))
+        liked, contribution = parse_entry(value)
+        (likes if liked else unlikes).append((user_id, recipe_id))
+        contributions[recipe_id] = contributions.get(recipe_id, 0) + contribution
+
+    with transaction.atomic():
+        changed = RecipeLike.bulk_like(likes) + RecipeLike.bulk_unlike(unlikes)
+
+    args = [len(entries)] + [field for field, _ in entries]
+    for recipe_id, contribution in contributions.items():
+        args += [recipe_id, contribution]
+    client.eval(FINISH_CHUNK_SCRIPT, 3, keys['flushing'], keys['deltas'], keys['epoch'], *args)
+    cache.invalidate_recipes(set(changed) | set(contributions))
+
+
+def flush(chunk_size=FLUSH_CHUNK_SIZE):
+    """
+    Write the buffered likes to the database. Returns the number of entries
+    flushed, including entries left over by an interrupted flush.
+    """
+    client = get_redis()
+    keys = get_keys()
+    total = 0
+    # The first round finishes the leftovers of an interrupted flush, if any;
+    # entries buffered while this flush runs wait for the next one.
+    for _ in range(2):
+        if not client.eval(BEGIN_FLUSH_SCRIPT, 2, keys['pending'], keys['flushing']):
+            break
+        while True:
+            entries = []
+            for entry in client.hscan_iter(keys['flushing'], count=chunk_size):
+                entries.append(entry)
+                if len(entries) >= chunk_size:
+                    break
+            if not entries:
+                break
+            flush_chunk(client, keys, entries)
+            total += len(entries)
+    return total
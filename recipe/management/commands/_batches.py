@@ -0,0 +1,15 @@
+def iter_pk_batches(queryset, batch_size):
+    """
+    Yield lists of primary keys from `queryset` in ascending order, walking
+    the primary key index so each batch is a bounded range read.
+    """
+    last_pk = None
+    while True:
+        batch = queryset.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        ids = list(batch.values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+        last_pk = ids[-1]
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+
+from recipe.ingredients import recount_recipes, sync_recipe_ingredients
+from recipe.models import Recipe
+
+from ._batches import iter_pk_batches
+
+
+class Command(BaseCommand):
+    """
+    Parse the ingredients text of existing recipes into Ingredient links.
+    Recipes are kept in sync on every save afterwards.
+    """
+    help = 'Populate the recipe/ingredient index from Recipe.ingredients in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of recipes parsed per transaction.')
+        parser.add_argument('--missing-only', action='store_true',
+                            help='Only parse recipes that have no ingredient links yet.')
+
+    def handle(self, *args, **options):
+        queryset = Recipe.objects.all()
+        if options['missing_only']:
+            queryset = queryset.filter(ingredient_count=0)
+
+        total = 0
+        for ids in iter_pk_batches(queryset, options['batch_size']):
+            sync_recipe_ingredients(Recipe.objects.filter(pk__in=ids).only('id', 'ingredients'))
+            total += len(ids)
+        # Links deleted by hand weren't uncounted.
+        recount_recipes()
+
+        self.stdout.write(self.style.SUCCESS(f'Indexed ingredients of {total} recipes.'))
@@ -0,0 +1,63 @@
+import os
+import tempfile
+import time
+
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+from django.views import static
+
+from config import media
+from users.storage import ContentAddressedStorage
+
+
+class Command(BaseCommand):
+    """
+    Compare the throughput of config.media in each serving mode with the
+    static() view it replaces, in this process and on a temporary file. In
+    the proxy modes the proxy sends the file, so only Python's share of the
+    work is measured there.
+    """
+    help = 'Benchmark media serving: static() against config.media in each mode.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=256,
+                            help='Size of the served file in KiB.')
+        parser.add_argument('--requests', type=int, default=500,
+                            help='Number of requests per mode.')
+        parser.add_argument('--range', action='store_true',
+                            help='Ask for the first 64 KiB of the file only.')
+
+    def run(self, view, path, headers, count):
+        factory = RequestFactory()
+        sent = 0
+        started = time.perf_counter()
+        for _ in range(count):
+            response = view(factory.get(f'/media/{path}', **headers), path)
+            for chunk in response:
+                sent += len(chunk)
+            response.close()
+        return time.perf_counter() - started, sent
+
+    def handle(self, *args, **options):
+        count = options['requests']
+        headers = {'HTTP_RANGE': 'bytes=0-65535'} if options['range'] else {}
+        with tempfile.TemporaryDirectory() as root, override_settings(MEDIA_ROOT=root):
+            storage = ContentAddressedStorage(location=root)
+            path = storage.save('benchmark/picture.jpg', ContentFile(os.urandom(options['size'] * 1024)))
+            candidates = [
+                ('static()', 'static', lambda request, path: static.serve(request, path, document_root=root)),
+                ('python', 'python', media.serve),
+                ('x-accel-redirect', 'x-accel-redirect', media.serve),
+                ('x-sendfile', 'x-sendfile', media.serve),
+            ]
+            baseline = None
+            for label, mode, view in candidates:
+                with override_settings(RECIPE_MEDIA_SERVING=mode):
+                    self.run(view, path, headers, min(count, 10))
+                    elapsed, sent = self.run(view, path, headers, count)
+                rate = count / elapsed
+                baseline = baseline or rate
+                self.stdout.write(
+                    f'{label:<18}{rate:>10.0f} req/s{sent / elapsed / 2 ** 20:>10.1f} MiB/s from Python'
+                    f'{rate / baseline:>8.1f}x')
@@ -0,0 +1,41 @@
+from celery import group
+from django.core.management.base import BaseCommand
+
+from recipe.images import process_picture
+from recipe.models import Recipe
+from recipe.tasks import process_recipe_pictures
+
+from ._batches import iter_pk_batches
+
+
+class Command(BaseCommand):
+    """
+    (Re)build the picture renditions of existing recipes, see recipe.images.
+    New uploads are processed automatically.
+    """
+    help = 'Queue picture rendition jobs for existing recipes, one Celery task per batch.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=50,
+                            help='Number of recipes processed per task.')
+        parser.add_argument('--missing-only', action='store_true',
+                            help='Only process pictures that have never been processed.')
+        parser.add_argument('--sync', action='store_true',
+                            help='Process in this process instead of queueing Celery tasks.')
+
+    def handle(self, *args, **options):
+        queryset = Recipe.objects.exclude(picture='')
+        if options['missing_only']:
+            queryset = queryset.filter(picture_width__isnull=True)
+        batches = list(iter_pk_batches(queryset, options['batch_size']))
+        total = sum(len(ids) for ids in batches)
+
+        if options['sync']:
+            processed = sum(process_picture(recipe_id) for ids in batches for recipe_id in ids)
+            self.stdout.write(self.style.SUCCESS(f'Processed {processed} of {total} recipe pictures.'))
+            return
+
+        # The batches run in parallel on however many workers are available.
+        group(process_recipe_pictures.s(ids) for ids in batches).apply_async()
+        self.stdout.write(self.style.SUCCESS(
+            f'Queued {len(batches)} tasks for {total} recipe pictures.'))
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from recipe.models import Recipe, RecipeLike
+
+from ._batches import iter_pk_batches
+
+
+class Command(BaseCommand):
+    """
+    Backfill / repair the denormalized like and bookmark counters on Recipe.
+    """
+    help = 'Recompute Recipe.likes_count and Recipe.bookmarks_count from the source tables.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of recipes updated per transaction.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        likes = (RecipeLike.objects.filter(recipe=OuterRef('pk'))
+                 .order_by().values('recipe').annotate(total=Count('pk')).values('total'))
+        bookmarks = (Recipe.bookmarked_by.through.objects.filter(recipe=OuterRef('pk'))
+                     .order_by().values('recipe').annotate(total=Count('pk')).values('total'))
+
+        total = 0
+        for ids in iter_pk_batches(Recipe.objects.all(), batch_size):
+            with transaction.atomic():
+                Recipe.objects.filter(pk__in=ids).update(
+                    likes_count=Coalesce(Subquery(likes), 0),
+                    bookmarks_count=Coalesce(Subquery(bookmarks), 0),
+                )
+            total += len(ids)
+
+        self.stdout.write(self.style.SUCCESS(f'Reconciled counters for {total} recipes.'))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipe.models import Recipe, get_recipe_search_vector
+
+from ._batches import iter_pk_batches
+
+
+class Command(BaseCommand):
+    """
+    Rebuild Recipe.search_vector for existing rows. New and edited recipes are
+    kept up to date by the database trigger.
+    """
+    help = 'Recompute the full-text search vector of recipes in batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of recipes updated per transaction.')
+        parser.add_argument('--missing-only', action='store_true',
+                            help='Only index recipes that have no search vector yet.')
+
+    def handle(self, *args, **options):
+        queryset = Recipe.objects.all()
+        if options['missing_only']:
+            queryset = queryset.filter(search_vector__isnull=True)
+
+        total = 0
+        for ids in iter_pk_batches(queryset, options['batch_size']):
+            with transaction.atomic():
+                Recipe.objects.filter(pk__in=ids).update(search_vector=get_recipe_search_vector())
+            total += len(ids)
+
+        self.stdout.write(self.style.SUCCESS(f'Reindexed {total} recipes.'))
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.6 on 2026-10-18 17:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipe', '0003_recipelike'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='bookmarks_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.6 on 2026-10-18 17:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipe', '0008_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='trending_score',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(condition=models.Q(('trending_score__gt', 0)), fields=['-trending_score', '-id'], name='recipe_trending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(condition=models.Q(('trending_score__gt', 0)), fields=['category', '-trending_score', '-id'], name='recipe_category_trending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipelike',
+            index=models.Index(fields=['created'], name='recipelike_created_idx'),
+        ),
+    ]
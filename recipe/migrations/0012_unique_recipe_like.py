@@ -0,0 +1,48 @@
+# Generated by Django 4.2.6 on 2026-10-18 17:42
+
+from django.db import migrations, models, transaction
+from django.db.models import Count, Exists, OuterRef, Subquery
+
+BATCH_SIZE = 1000
+
+
+def dedupe_recipe_likes(apps, schema_editor):
+    """
+    Keep the oldest like of every (user, recipe) pair and recount the likes
+    of the affected recipes, one batch of duplicates per transaction.
+    """
+    RecipeLike = apps.get_model('recipe', 'RecipeLike')
+    Recipe = apps.get_model('recipe', 'Recipe')
+    likes = RecipeLike.objects.using(schema_editor.connection.alias)
+    recipes = Recipe.objects.using(schema_editor.connection.alias)
+
+    older = likes.filter(user_id=OuterRef('user_id'), recipe_id=OuterRef('recipe_id'), pk__lt=OuterRef('pk'))
+    duplicates = likes.filter(Exists(older)).order_by('pk')
+    counts = (likes.filter(recipe=OuterRef('pk'))
+              .order_by().values('recipe').annotate(total=Count('id')).values('total'))
+    while True:
+        batch = list(duplicates.values_list('pk', 'recipe_id')[:BATCH_SIZE])
+        if not batch:
+            return
+        with transaction.atomic(using=schema_editor.connection.alias):
+            likes.filter(pk__in=[pk for pk, _ in batch]).delete()
+            recipes.filter(pk__in={recipe_id for _, recipe_id in batch}).update(likes_count=Subquery(counts))
+
+
+class Migration(migrations.Migration):
+    # Every batch commits on its own so the like table is never locked for
+    # the whole cleanup; the dedupe is safe to re-run if adding the
+    # constraint fails because of a duplicate created in between.
+    atomic = False
+
+    dependencies = [
+        ('recipe', '0011_recipe_updated_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_recipe_likes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='recipelike',
+            constraint=models.UniqueConstraint(fields=('user', 'recipe'), name='unique_recipe_like'),
+        ),
+    ]
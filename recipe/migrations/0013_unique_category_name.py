@@ -0,0 +1,42 @@
+# Generated by Django 4.2.6 on 2026-10-18 17:56
+
+from django.db import migrations, models, transaction
+from django.db.models import Count, Min
+
+
+def merge_duplicate_categories(apps, schema_editor):
+    """
+    Move the recipes of every duplicated category name to its oldest row and
+    delete the other rows.
+    """
+    RecipeCategory = apps.get_model('recipe', 'RecipeCategory')
+    Recipe = apps.get_model('recipe', 'Recipe')
+    categories = RecipeCategory.objects.using(schema_editor.connection.alias)
+    recipes = Recipe.objects.using(schema_editor.connection.alias)
+
+    duplicated = (categories.order_by().values('name')
+                  .annotate(total=Count('id'), keep=Min('id')).filter(total__gt=1))
+    for row in duplicated:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            others = categories.filter(name=row['name']).exclude(pk=row['keep'])
+            recipes.filter(category__in=others).update(category_id=row['keep'])
+            others.delete()
+
+
+class Migration(migrations.Migration):
+    # The merge commits before the unique index is built, so the index build
+    # doesn't run into the merge's pending foreign key checks.
+    atomic = False
+
+    dependencies = [
+        ('recipe', '0012_unique_recipe_like'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_categories, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='recipecategory',
+            name='name',
+            field=models.CharField(max_length=100, unique=True, verbose_name='Category name'),
+        ),
+    ]
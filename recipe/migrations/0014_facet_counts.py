@@ -0,0 +1,37 @@
+# Generated by Django 4.2.6 on 2026-10-18 17:58
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('recipe', '0013_unique_category_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipecategory',
+            name='recipes_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.CreateModel(
+            name='AuthorCategoryCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipes_count', models.PositiveIntegerField(default=0)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='author_counts', to='recipe.recipecategory')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['category', '-recipes_count'], name='author_category_count_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='authorcategorycount',
+            constraint=models.UniqueConstraint(fields=('author', 'category'), name='unique_author_category_count'),
+        ),
+    ]
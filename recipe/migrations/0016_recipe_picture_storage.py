@@ -0,0 +1,19 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:15
+
+from django.db import migrations, models
+import recipe.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipe', '0015_picture_renditions'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='picture',
+            field=models.ImageField(storage=recipe.models.get_picture_storage, upload_to='uploads'),
+        ),
+    ]
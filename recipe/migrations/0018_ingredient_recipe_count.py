@@ -0,0 +1,27 @@
+# Generated by Django 4.2.6 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipe', '0017_outboxemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ingredient',
+            name='recipe_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunSQL(
+            '''
+            UPDATE recipe_ingredient SET recipe_count = counted.recipe_count
+            FROM (SELECT ingredient_id, COUNT(*) AS recipe_count FROM recipe_recipeingredient
+                  GROUP BY ingredient_id) counted
+            WHERE recipe_ingredient.id = counted.ingredient_id
+            ''',
+            migrations.RunSQL.noop,
+        ),
+    ]
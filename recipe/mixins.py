@@ -0,0 +1,172 @@
+import hashlib
+from calendar import timegm
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework import status
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from . import cache, like_buffer
+
+
+class SparseFieldsMixin:
+    """
+    Let clients choose the serialized fields with `?fields=a,b` or `?omit=c`.
+
+    Read requests only render the selected fields and the queryset is narrowed
+    with `.only()` so unused columns (and joins) are never read from the
+    database. `default_fields` is used when `?fields=` is absent.
+    """
+    default_fields = None
+
+    def get_requested_fields(self):
+        if not hasattr(self, '_requested_fields'):
+            available = self.get_serializer_class().Meta.fields
+            params = self.request.query_params
+            if params.get('fields'):
+                requested = set(params['fields'].split(','))
+                fields = [field for field in available if field in requested]
+            else:
+                fields = list(self.default_fields or available)
+            if params.get('omit'):
+                omitted = set(params['omit'].split(','))
+                fields = [field for field in fields if field not in omitted]
+            self._requested_fields = tuple(fields)
+        return self._requested_fields
+
+    def is_sparse_request(self):
+        request = getattr(self, 'request', None)
+        return request is not None and request.method in SAFE_METHODS
+
+    def get_serializer(self, *args, **kwargs):
+        if self.is_sparse_request():
+            kwargs.setdefault('fields', self.get_requested_fields())
+        return super().get_serializer(*args, **kwargs)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if not self.is_sparse_request():
+            return queryset
+        # Keep the columns the paginator orders on; skip annotations like a rank.
+        field_names = {field.name for field in queryset.model._meta.concrete_fields}
+        ordering = [field.lstrip('-') for field in getattr(self.paginator, 'ordering', ())]
+        return self.get_serializer_class().narrow_queryset(
+            queryset, self.get_requested_fields(),
+            extra_columns=[field for field in ordering if field in field_names])
+
+
+class CachedResponseMixin:
+    """
+    Serve GET responses from the recipe response cache.
+
+    List views depend on the recipes of the current page, detail views on the
+    looked-up recipe; see `recipe.cache` for how entries are invalidated.
+    """
+    cache_scope = None
+
+    def get_cache_dependencies(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        if lookup_url_kwarg in self.kwargs:
+            return [self.kwargs[lookup_url_kwarg]]
+        page = getattr(self.paginator, 'page', None)
+        if page is None:
+            return None
+        return [obj.pk for obj in page]
+
+    def get(self, request, *args, **kwargs):
+        key = cache.response_cache_key(request, self.cache_scope or type(self).__name__)
+        data = cache.get_cached_data(key)
+        if data is not None:
+            return Response(data, headers={'X-Cache': 'HIT'})
+
+        response = super().get(request, *args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            dependencies = self.get_cache_dependencies()
+            if dependencies is not None:
+                cache.set_cached_data(key, response.data, dependencies)
+        response['X-Cache'] = 'MISS'
+        return response
+
+
+class ConditionalGetMixin:
+    """
+    Answer GETs with 304 Not Modified when If-None-Match / If-Modified-Since
+    match, without serializing the body.
+
+    Views implement `get_validators()` returning `(etag_source, last_modified)`
+    from a cheap query; the ETag also covers the query string, renderer and user.
+    """
+
+    def get_validators(self):
+        return None, None
+
+    def get_etag(self, source):
+        request = self.request
+        user = request.user
+        raw = repr((source, request.get_full_path(), getattr(request, 'accepted_media_type', ''),
+                    user.pk if user.is_authenticated else None))
+        return quote_etag(hashlib.md5(raw.encode('utf-8')).hexdigest())
+
+    def get(self, request, *args, **kwargs):
+        source, last_modified = self.get_validators()
+        etag = self.get_etag(source) if source is not None else None
+        last_modified = timegm(last_modified.utctimetuple()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            if etag:
+                response['ETag'] = etag
+            if last_modified:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+
+class RecipeConditionalGetMixin(ConditionalGetMixin):
+    """
+    Validators for recipe detail and list views: a fingerprint of the
+    recipe rows (updated_at, counters and embedded names). Lists fingerprint
+    exactly the rows of the requested page, using the view's paginator.
+    """
+    fingerprint_fields = ('id', 'created_at', 'updated_at', 'likes_count', 'bookmarks_count',
+                          'category__name', 'author__username')
+
+    def get_validators(self):
+        queryset = self.filter_queryset(self.get_queryset()).values(*self.fingerprint_fields)
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        if lookup_url_kwarg in self.kwargs:
+            row = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]}).first()
+            if row is None:
+                return None, None
+            buffered = self.get_buffered_likes([row['id']])
+            if buffered:
+                # Buffered likes change the count without touching updated_at.
+                return tuple(row.values()) + (buffered,), None
+            return tuple(row.values()), row['updated_at']
+
+        if self.pagination_class is None:
+            return None, None
+        rows = self.pagination_class().paginate_queryset(queryset, self.request, view=self)
+        if rows is None:
+            return None, None
+        # A list has no safe Last-Modified: removing a row doesn't raise max(updated_at).
+        source = [tuple(row.values()) for row in rows]
+        buffered = self.get_buffered_likes([row['id'] for row in rows])
+        if buffered:
+            source.append(buffered)
+        return source, None
+
+    def get_buffered_likes(self, recipe_ids):
+        """
+        Like buffer state that the rendered recipes depend on: their pending
+        count changes and, for authenticated users, their own like state.
+        """
+        if not like_buffer.is_enabled():
+            return None
+        state = sorted(like_buffer.get_count_deltas(recipe_ids).items())
+        user = self.request.user
+        if user.is_authenticated:
+            state += sorted(like_buffer.get_buffered_states(user.pk, recipe_ids).items())
+        return state
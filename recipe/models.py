@@ -1,27 +1,71 @@
-from django.db import models
+import re
+
+from django.db import connection, models
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchQuery, SearchVector, SearchVectorField
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from users.storage import ContentAddressedStorage
+
+from . import cache
+
 
 class RecipeCategory(models.Model):
     """
     Recipe categories
     """
-    name = models.CharField(_('Category name'), max_length=100)
+    name = models.CharField(_('Category name'), max_length=100, unique=True)
+    # Number of recipes in the category, see recipe.facets.
+    recipes_count = models.PositiveIntegerField(default=0, editable=False)
 
     class Meta:
         verbose_name = _('Recipe Category')
         verbose_name_plural = _('Recipe Categories')
+        indexes = [
+            GinIndex(fields=['name'], name='category_name_trgm_idx', opclasses=['gin_trgm_ops']),
+        ]
 
     def __str__(self):
         return self.name
 
 
+SEARCH_CONFIG = 'english'
+
+
+def get_recipe_search_vector():
+    """
+    Weighted document for full-text search: title (A), description (B),
+    ingredients (C). The database trigger in migration 0006 mirrors this.
+    """
+    return (SearchVector('title', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('desc', weight='B', config=SEARCH_CONFIG)
+            + SearchVector('ingredients', weight='C', config=SEARCH_CONFIG))
+
+
+def get_recipe_search_query(text, max_terms=10):
+    """
+    Query matching every word of `text` as a prefix, or None if it has no words.
+    """
+    terms = re.findall(r'[^\W_]+', text)[:max_terms]
+    if not terms:
+        return None
+    return SearchQuery(' & '.join(f'{term}:*' for term in terms), search_type='raw', config=SEARCH_CONFIG)
+
+
 def get_default_recipe_category():
     """
     Returns a default recipe type.
     """
-    return RecipeCategory.objects.get_or_create(name='Others')[0]
+    from .categories import DEFAULT_CATEGORY_NAME, get_or_create_category
+
+    return get_or_create_category(DEFAULT_CATEGORY_NAME)
+
+
+def get_picture_storage():
+    return ContentAddressedStorage()
 
 
 class Recipe(models.Model):
@@ -32,7 +76,12 @@ class Recipe(models.Model):
         settings.AUTH_USER_MODEL, related_name="recipes", on_delete=models.CASCADE)
     category = models.ForeignKey(
         RecipeCategory, related_name="recipe_list", on_delete=models.SET(get_default_recipe_category))
-    picture = models.ImageField(upload_to='uploads')
+    # Stored under a hash of its content, see users.storage.
+    picture = models.ImageField(upload_to='uploads', storage=get_picture_storage)
+    # Size of the uploaded picture and its resized copies, see recipe.images.
+    picture_width = models.PositiveIntegerField(null=True, editable=False)
+    picture_height = models.PositiveIntegerField(null=True, editable=False)
+    picture_renditions = models.JSONField(default=dict, editable=False)
     title = models.CharField(max_length=200)
     desc = models.CharField(_('Short description'), max_length=200)
     cook_time = models.TimeField()
@@ -40,9 +89,33 @@ class Recipe(models.Model):
     procedure = models.TextField()
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    likes_count = models.PositiveIntegerField(default=0, editable=False)
+    bookmarks_count = models.PositiveIntegerField(default=0, editable=False)
+    # Number of distinct parsed ingredients, see recipe.ingredients.
+    ingredient_count = models.PositiveIntegerField(default=0, editable=False)
+    # Maintained by a database trigger, see get_recipe_search_vector().
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Time-decayed like score, maintained by recipe.trending.
+    trending_score = models.FloatField(default=0, editable=False)
 
     class Meta:
-        ordering = ('-created_at', )
+        ordering = ('-created_at', '-id')
+        indexes = [
+            # Keyset pagination: newest first, optionally narrowed by category/author.
+            models.Index(fields=['-created_at', '-id'], name='recipe_created_idx'),
+            models.Index(fields=['category', '-created_at', '-id'], name='recipe_category_created_idx'),
+            models.Index(fields=['author', '-created_at', '-id'], name='recipe_author_created_idx'),
+            # Incremental exports and change scans.
+            models.Index(fields=['updated_at', 'id'], name='recipe_updated_idx'),
+            GinIndex(fields=['search_vector'], name='recipe_search_vector_idx'),
+            # Typo-tolerant autocomplete (pg_trgm).
+            GinIndex(fields=['title'], name='recipe_title_trgm_idx', opclasses=['gin_trgm_ops']),
+            # Trending feed; only recipes with recent likes are indexed.
+            models.Index(fields=['-trending_score', '-id'], name='recipe_trending_idx',
+                         condition=models.Q(trending_score__gt=0)),
+            models.Index(fields=['category', '-trending_score', '-id'], name='recipe_category_trending_idx',
+                         condition=models.Q(trending_score__gt=0)),
+        ]
 
     def __str__(self):
         return self.title
@@ -53,6 +126,20 @@ class Recipe(models.Model):
     def get_total_number_of_bookmarks(self):
         return self.bookmarked_by.count()
 
+    @classmethod
+    def adjust_counter(cls, recipe_ids, field, delta):
+        """
+        Atomically add `delta` to a denormalized counter column. updated_at is
+        bumped too so validators and incremental readers see the change.
+        """
+        if not delta:
+            return
+        value = models.F(field) + delta
+        if delta < 0:
+            value = Greatest(value, 0)
+        cls.objects.filter(pk__in=recipe_ids).update(**{field: value, 'updated_at': timezone.now()})
+        cache.invalidate_recipes(recipe_ids)
+
 
 class RecipeLike(models.Model):
     """
@@ -63,5 +150,256 @@ class RecipeLike(models.Model):
     recipe = models.ForeignKey(Recipe, on_delete=models.CASCADE)
     created = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'recipe'], name='unique_recipe_like'),
+        ]
+        indexes = [
+            models.Index(fields=['created'], name='recipelike_created_idx'),
+        ]
+
     def __str__(self):
         return self.user.username
+
+    @classmethod
+    def _write_like(cls, sql, params, recipe_id):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            changed = cursor.fetchone() is not None
+        if changed:
+            cache.invalidate_recipes([recipe_id])
+        return changed
+
+    @classmethod
+    def _tables(cls):
+        quote = connection.ops.quote_name
+        field = cls._meta.get_field
+        recipe_field = Recipe._meta.get_field
+        return {
+            'like_table': quote(cls._meta.db_table),
+            'user': quote(field('user').column),
+            'recipe': quote(field('recipe').column),
+            'created': quote(field('created').column),
+            'recipe_table': quote(Recipe._meta.db_table),
+            'recipe_id': quote(recipe_field('id').column),
+            'likes_count': quote(recipe_field('likes_count').column),
+            'updated_at': quote(recipe_field('updated_at').column),
+        }
+
+    @classmethod
+    def like(cls, user_id, recipe_id):
+        """
+        Insert the like and count it on the recipe in a single statement.
+        Returns False if it already existed or the recipe does not exist;
+        concurrent calls never create more than one row. No signals are sent.
+        """
+        sql = '''
+            WITH inserted AS (
+                INSERT INTO {like_table} ({user}, {recipe}, {created})
+                SELECT %s, {recipe_id}, %s FROM {recipe_table} WHERE {recipe_id} = %s
+                ON CONFLICT ({user}, {recipe}) DO NOTHING
+                RETURNING {recipe}
+            )
+            UPDATE {recipe_table} SET {likes_count} = {likes_count} + 1, {updated_at} = %s
+            WHERE {recipe_id} IN (SELECT {recipe} FROM inserted)
+            RETURNING {recipe_id}
+        '''.format(**cls._tables())
+        now = timezone.now()
+        return cls._write_like(sql, [user_id, now, recipe_id, now], recipe_id)
+
+    @classmethod
+    def unlike(cls, user_id, recipe_id):
+        """
+        Delete the like and uncount it in a single statement. Returns False
+        if there was nothing to delete. No signals are sent.
+        """
+        sql = '''
+            WITH deleted AS (
+                DELETE FROM {like_table} WHERE {user} = %s AND {recipe} = %s
+                RETURNING {recipe}
+            )
+            UPDATE {recipe_table} SET {likes_count} = GREATEST({likes_count} - 1, 0), {updated_at} = %s
+            WHERE {recipe_id} IN (SELECT {recipe} FROM deleted)
+            RETURNING {recipe_id}
+        '''.format(**cls._tables())
+        return cls._write_like(sql, [user_id, recipe_id, timezone.now()], recipe_id)
+
+    @classmethod
+    def _write_likes(cls, sql, params):
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return [row[0] for row in cursor.fetchall()]
+
+    @classmethod
+    def bulk_like(cls, pairs):
+        """
+        like() for many (user_id, recipe_id) pairs in one statement. Pairs
+        already liked or pointing at deleted users or recipes are skipped.
+        Returns the ids of the recipes whose count changed.
+        """
+        tables = dict(cls._tables(), user_table=connection.ops.quote_name(
+            cls._meta.get_field('user').related_model._meta.db_table))
+        sql = '''
+            WITH inserted AS (
+                INSERT INTO {like_table} ({user}, {recipe}, {created})
+                SELECT pair.user_id, pair.recipe_id, %s
+                FROM unnest(%s::bigint[], %s::bigint[]) AS pair (user_id, recipe_id)
+                WHERE EXISTS (SELECT 1 FROM {recipe_table} WHERE {recipe_id} = pair.recipe_id)
+                  AND EXISTS (SELECT 1 FROM {user_table} WHERE id = pair.user_id)
+                ON CONFLICT ({user}, {recipe}) DO NOTHING
+                RETURNING {recipe}
+            ), counted AS (
+                SELECT {recipe} AS recipe_id, count(*) AS total FROM inserted GROUP BY {recipe}
+            )
+            UPDATE {recipe_table} SET {likes_count} = {likes_count} + counted.total, {updated_at} = %s
+            FROM counted WHERE {recipe_table}.{recipe_id} = counted.recipe_id
+            RETURNING {recipe_table}.{recipe_id}
+        '''.format(**tables)
+        if not pairs:
+            return []
+        user_ids, recipe_ids = map(list, zip(*pairs))
+        now = timezone.now()
+        return cls._write_likes(sql, [now, user_ids, recipe_ids, now])
+
+    @classmethod
+    def bulk_unlike(cls, pairs):
+        """
+        unlike() for many (user_id, recipe_id) pairs in one statement.
+        Returns the ids of the recipes whose count changed.
+        """
+        sql = '''
+            WITH deleted AS (
+                DELETE FROM {like_table}
+                USING unnest(%s::bigint[], %s::bigint[]) AS pair (user_id, recipe_id)
+                WHERE {like_table}.{user} = pair.user_id AND {like_table}.{recipe} = pair.recipe_id
+                RETURNING {like_table}.{recipe}
+            ), counted AS (
+                SELECT {recipe} AS recipe_id, count(*) AS total FROM deleted GROUP BY {recipe}
+            )
+            UPDATE {recipe_table} SET {likes_count} = GREATEST({likes_count} - counted.total, 0),
+                {updated_at} = %s
+            FROM counted WHERE {recipe_table}.{recipe_id} = counted.recipe_id
+            RETURNING {recipe_table}.{recipe_id}
+        '''.format(**cls._tables())
+        if not pairs:
+            return []
+        user_ids, recipe_ids = map(list, zip(*pairs))
+        return cls._write_likes(sql, [user_ids, recipe_ids, timezone.now()])
+
+
+class Ingredient(models.Model):
+    """
+    Normalized ingredient name parsed from Recipe.ingredients
+    """
+    name = models.CharField(_('Ingredient name'), max_length=100, unique=True)
+    # Number of recipes using it, see recipe.ingredients.
+    recipe_count = models.PositiveIntegerField(default=0, editable=False)
+
+    def __str__(self):
+        return self.name
+
+
+class RecipeIngredient(models.Model):
+    """
+    Recipe/ingredient link, indexed by ingredient for pantry lookups
+    """
+    recipe = models.ForeignKey(Recipe, related_name='ingredient_links', on_delete=models.CASCADE)
+    ingredient = models.ForeignKey(Ingredient, related_name='recipe_links', on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipe', 'ingredient'], name='unique_recipe_ingredient'),
+        ]
+        indexes = [
+            models.Index(fields=['ingredient', 'recipe'], name='ingredient_recipe_idx'),
+        ]
+
+    def __str__(self):
+        return self.ingredient.name
+
+
+class RecipeNeighbor(models.Model):
+    """
+    Precomputed "liked this also liked" neighbour, see recipe.recommendations
+    """
+    recipe = models.ForeignKey(Recipe, related_name='neighbor_links', on_delete=models.CASCADE)
+    neighbor = models.ForeignKey(Recipe, related_name='neighbor_of_links', on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['recipe', 'neighbor'], name='unique_recipe_neighbor'),
+        ]
+        indexes = [
+            models.Index(fields=['recipe', '-score'], name='recipe_neighbor_score_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.recipe_id} -> {self.neighbor_id}'
+
+
+class AuthorCategoryCount(models.Model):
+    """
+    Number of recipes an author has in a category, see recipe.facets
+    """
+    author = models.ForeignKey(settings.AUTH_USER_MODEL, related_name='+', on_delete=models.CASCADE)
+    category = models.ForeignKey(RecipeCategory, related_name='author_counts', on_delete=models.CASCADE)
+    recipes_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['author', 'category'], name='unique_author_category_count'),
+        ]
+        indexes = [
+            # Top authors of a category.
+            models.Index(fields=['category', '-recipes_count'], name='author_category_count_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.author_id} / {self.category_id}: {self.recipes_count}'
+
+
+class OutboxEmail(models.Model):
+    """
+    An email waiting to be delivered, or delivered recently, see recipe.outbox
+    """
+    PENDING = 'pending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((PENDING, 'Pending'), (SENT, 'Sent'), (FAILED, 'Failed'))
+
+    # Recipient domain the per-domain send rate applies to.
+    domain = models.CharField(max_length=255)
+    from_email = models.CharField(max_length=254, blank=True)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list)
+    bcc = models.JSONField(default=list)
+    reply_to = models.JSONField(default=list)
+    subject = models.TextField(blank=True)
+    body = models.TextField(blank=True)
+    # [content, mimetype] pairs of EmailMultiAlternatives.
+    alternatives = models.JSONField(default=list)
+    headers = models.JSONField(default=dict)
+    # Hash of the message, an identical message isn't queued while this one
+    # is pending.
+    dedupe_key = models.CharField(max_length=64)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Due messages, oldest first.
+            models.Index(fields=['next_attempt_at'], condition=models.Q(status='pending'),
+                         name='outbox_pending_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['dedupe_key'], condition=models.Q(status='pending'),
+                                    name='outbox_pending_dedupe_key'),
+        ]
+
+    def __str__(self):
+        return f'{self.subject} → {self.domain} ({self.status})'
@@ -0,0 +1,295 @@
+"""
+Transactional outbox for email.
+
+EMAIL_BACKEND is EmailBackend below, so send_mail() and EmailMessage.send()
+anywhere in the project only insert OutboxEmail rows, in the caller's
+transaction. recipe.tasks.dispatch_outbox, run by the dedicated outbox
+worker, delivers them through RECIPE_EMAIL_DELIVERY_BACKEND:
+
+- Due rows are claimed in batches with FOR UPDATE SKIP LOCKED and leased
+  for LEASE_SECONDS, so dispatchers never send the same row twice at once
+  and a crashed dispatcher's rows are picked up again.
+- Each worker process keeps one delivery connection open between batches.
+- Once RECIPE_OUTBOX_DOMAIN_RATE messages to one domain were attempted in a
+  minute, further messages to it are put off to the next minute. A message
+  counts once however many recipients of the domain it lists.
+- Temporary failures are retried after RECIPE_OUTBOX_RETRY_DELAY seconds,
+  doubled after each attempt, up to RECIPE_OUTBOX_MAX_ATTEMPTS attempts.
+  Permanent (5xx) failures aren't retried, nor are messages that can't be
+  built.
+- A message identical to one still pending (queued or being retried) isn't
+  queued again. Once that one is sent or given up on, it is.
+
+A message with recipients in several domains is queued once per domain,
+each copy listing the recipients of its domain only.
+"""
+import hashlib
+import json
+import logging
+import smtplib
+import time
+from datetime import timedelta
+from email.utils import parseaddr
+
+from django.conf import settings
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+LEASE_SECONDS = 60 * 5
+# Stop draining after this many seconds, the next run continues.
+TIME_BUDGET = 50
+RATE_WINDOW = 60
+
+_connection = None
+
+
+def get_domain(address):
+    return parseaddr(address)[1].rpartition('@')[2].lower()
+
+
+def split_by_domain(message):
+    """
+    OutboxEmail rows for `message`, one per recipient domain. Raises
+    ValueError (BadHeaderError included) if it can't be sent.
+    """
+    if message.attachments:
+        raise ValueError('The email outbox does not support attachments.')
+    # Rejected now, like any backend would, rather than by the dispatcher.
+    message.message()
+    recipients = {}
+    for field in ('to', 'cc', 'bcc'):
+        for address in getattr(message, field):
+            recipients.setdefault(get_domain(address), {'to': [], 'cc': [], 'bcc': []})[field].append(address)
+    alternatives = [list(alternative) for alternative in getattr(message, 'alternatives', [])]
+    rows = []
+    for domain, addresses in recipients.items():
+        fields = {
+            'from_email': message.from_email or '',
+            **addresses,
+            'reply_to': list(message.reply_to),
+            'subject': str(message.subject),
+            'body': str(message.body),
+            'alternatives': alternatives,
+            'headers': dict(message.extra_headers),
+        }
+        dedupe_key = hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+        rows.append(OutboxEmail(domain=domain, dedupe_key=dedupe_key, **fields))
+    return rows
+
+
+def insert_pending(rows):
+    """
+    Insert `rows` in a single statement, skipping those identical to a
+    pending message. Returns the dedupe keys of the rows inserted.
+    """
+    fields = [field for field in OutboxEmail._meta.concrete_fields if not field.primary_key]
+    quote = connection.ops.quote_name
+    placeholders = '({})'.format(', '.join(['%s'] * len(fields)))
+    sql = '''
+        INSERT INTO {table} ({columns}) VALUES {values}
+        ON CONFLICT ({dedupe_key}) WHERE {status} = '{pending}' DO NOTHING
+        RETURNING {dedupe_key}
+    '''.format(
+        table=quote(OutboxEmail._meta.db_table),
+        columns=', '.join(quote(field.column) for field in fields),
+        values=', '.join([placeholders] * len(rows)),
+        dedupe_key=quote(OutboxEmail._meta.get_field('dedupe_key').column),
+        status=quote(OutboxEmail._meta.get_field('status').column),
+        pending=OutboxEmail.PENDING,
+    )
+    params = [field.get_db_prep_save(field.pre_save(row, True), connection) for row in rows for field in fields]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [key for key, in cursor.fetchall()]
+
+
+def enqueue(messages):
+    """
+    Queue `messages` for delivery once the current transaction commits.
+    Returns the number of messages queued, not counting those identical to
+    a pending message.
+    """
+    rows_by_message = [split_by_domain(message) for message in messages]
+    rows = [row for message_rows in rows_by_message for row in message_rows]
+    if not rows:
+        return 0
+    inserted = set(insert_pending(rows))
+    if inserted:
+        transaction.on_commit(kick)
+    queued = 0
+    for message_rows in rows_by_message:
+        # A row inserted once only counts for the first message carrying it.
+        keys = {row.dedupe_key for row in message_rows} & inserted
+        inserted -= keys
+        queued += bool(keys)
+    return queued
+
+
+def kick():
+    # At most one dispatch queued by enqueue() every few seconds; beat runs
+    # it regularly anyway.
+    if cache.add('recipe:outbox:kick', 1, 5):
+        from .tasks import dispatch_outbox
+        dispatch_outbox.delay()
+
+
+class EmailBackend(BaseEmailBackend):
+    """
+    Email backend queueing messages in the outbox instead of sending them.
+    """
+    def send_messages(self, email_messages):
+        return enqueue(email_messages)
+
+
+def build_message(row):
+    return mail.EmailMultiAlternatives(
+        row.subject, row.body, row.from_email or None, row.to, row.bcc, cc=row.cc, reply_to=row.reply_to,
+        headers=row.headers, alternatives=[tuple(alternative) for alternative in row.alternatives])
+
+
+def get_connection():
+    """
+    The delivery connection of this process, opened if needed.
+    """
+    global _connection
+    if _connection is None:
+        _connection = mail.get_connection(settings.RECIPE_EMAIL_DELIVERY_BACKEND)
+    _connection.open()
+    return _connection
+
+
+def close_connection():
+    global _connection
+    if _connection is not None:
+        _connection.close()
+        _connection = None
+
+
+def deliver(message):
+    try:
+        get_connection().send_messages([message])
+    except smtplib.SMTPServerDisconnected:
+        # The kept connection may have been closed by the server while idle.
+        close_connection()
+        get_connection().send_messages([message])
+
+
+def is_connection_error(error):
+    return isinstance(error, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)) or \
+        not isinstance(error, smtplib.SMTPException)
+
+
+def is_permanent(error):
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in error.recipients.values())
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500
+
+
+def take_rate(domain, now):
+    """
+    Count a message to `domain` in the current window. False if the domain
+    has had its share.
+    """
+    window = int(now.timestamp() // RATE_WINDOW)
+    key = f'recipe:outbox:rate:{domain}:{window}'
+    cache.add(key, 0, RATE_WINDOW * 2)
+    return cache.incr(key) <= settings.RECIPE_OUTBOX_DOMAIN_RATE
+
+
+def claim(batch_size):
+    now = timezone.now()
+    with transaction.atomic():
+        rows = list(OutboxEmail.objects.select_for_update(skip_locked=True)
+                    .filter(status=OutboxEmail.PENDING, next_attempt_at__lte=now)
+                    .order_by('next_attempt_at')[:batch_size])
+        OutboxEmail.objects.filter(pk__in=[row.pk for row in rows]).update(
+            next_attempt_at=now + timedelta(seconds=LEASE_SECONDS))
+    return rows
+
+
+def record_failure(row, error, now, permanent):
+    attempts = row.attempts + 1
+    if permanent or attempts >= settings.RECIPE_OUTBOX_MAX_ATTEMPTS:
+        changes = {'status': OutboxEmail.FAILED}
+        logger.error(f'Gave up on outbox email {row.pk} to {row.domain}: {error}')
+    else:
+        delay = settings.RECIPE_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)
+        changes = {'next_attempt_at': now + timedelta(seconds=delay)}
+        logger.warning(f'Outbox email {row.pk} to {row.domain} failed, retrying in {delay}s: {error}')
+    OutboxEmail.objects.filter(pk=row.pk).update(attempts=attempts, last_error=str(error), **changes)
+
+
+def dispatch_batch(rows):
+    """
+    Deliver claimed rows. Returns the number sent, deferred and failed. If
+    the connection fails, the rows left keep their lease and are retried
+    once it runs out. Rows delivered are marked sent even if the batch is
+    cut short by an error.
+    """
+    sent, deferred = [], []
+    failed = 0
+    try:
+        for row in rows:
+            now = timezone.now()
+            if not take_rate(row.domain, now):
+                deferred.append(row.pk)
+                continue
+            try:
+                deliver(build_message(row))
+            except (smtplib.SMTPException, OSError) as e:
+                failed += 1
+                record_failure(row, e, now, is_permanent(e))
+                if is_connection_error(e):
+                    close_connection()
+                    break
+            except Exception as e:
+                # The message itself is broken (a header with a newline, an
+                # address that can't be encoded...), trying again won't help.
+                failed += 1
+                record_failure(row, e, now, True)
+            else:
+                sent.append(row.pk)
+    finally:
+        now = timezone.now()
+        if sent:
+            OutboxEmail.objects.filter(pk__in=sent).update(
+                status=OutboxEmail.SENT, sent_at=now, attempts=F('attempts') + 1, last_error='')
+        if deferred:
+            # Due again when the next rate window starts.
+            wait = RATE_WINDOW - now.timestamp() % RATE_WINDOW
+            OutboxEmail.objects.filter(pk__in=deferred).update(next_attempt_at=now + timedelta(seconds=wait))
+    return len(sent), len(deferred), failed
+
+
+def dispatch(batch_size=None):
+    """
+    Deliver due messages batch by batch until none are left or the time
+    budget is spent. Returns the number sent, deferred and failed.
+    """
+    batch_size = batch_size or settings.RECIPE_OUTBOX_BATCH_SIZE
+    started = time.monotonic()
+    totals = [0, 0, 0]
+    while True:
+        rows = claim(batch_size)
+        for i, count in enumerate(dispatch_batch(rows)):
+            totals[i] += count
+        if len(rows) < batch_size or time.monotonic() - started > TIME_BUDGET:
+            return tuple(totals)
+
+
+def purge(now=None):
+    """
+    Delete delivered and failed messages older than RECIPE_OUTBOX_RETENTION
+    days. Returns the number deleted.
+    """
+    cutoff = (now or timezone.now()) - timedelta(days=settings.RECIPE_OUTBOX_RETENTION)
+    deleted, _ = OutboxEmail.objects.exclude(status=OutboxEmail.PENDING).filter(created_at__lt=cutoff).delete()
+    return deleted
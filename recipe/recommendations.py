@@ -0,0 +1,224 @@
+"""
+Item-to-item collaborative filtering over likes and bookmarks.
+
+Interactions form a binary user x recipe matrix X (a like or a bookmark
+counts once). The similarity of two recipes is the cosine of their columns,
+co-occurrences / sqrt(fans_a * fans_b), computed with sparse products
+X[:, block].T @ X for a block of recipes at a time. The TOP_K best
+neighbours of every recipe are stored as RecipeNeighbor rows.
+
+Memory is bounded whatever the number of interactions:
+
+- At most MAX_FANS fans are loaded per recipe, the same sample of users for
+  every recipe (those with the smallest hash), so popular recipes are
+  compared on a consistent sample. X holds at most MAX_FANS entries per
+  recipe.
+- Blocks are sized from an upper bound of their co-occurrence entries, the
+  interactions of their fans, so a block's product holds at most
+  MAX_BLOCK_ENTRIES entries, or one row (one entry per recipe at most).
+  Each block is cut down to TOP_K neighbours per row before the next one.
+
+An incremental refresh starts from the recipes whose updated_at moved since
+the previous run (every like, unlike, bookmark and unbookmark bumps it
+through Recipe.adjust_counter) and recomputes them along with the recipes
+whose similarity to them may have changed. Changes are read up to
+recipe.visibility.get_visible_until(), so late commits aren't skipped.
+"""
+import itertools
+
+import numpy as np
+from django.core.cache import cache
+from django.db import connection, transaction
+from scipy import sparse
+
+from users.models import Profile
+
+from .models import Recipe, RecipeLike, RecipeNeighbor
+from .visibility import get_visible_until
+
+REFRESHED_AT_KEY = 'recipe:recommendations:refreshed_at'
+TOP_K = 20
+# Recipes need this many common fans to count as neighbours at all.
+MIN_SUPPORT = 2
+MAX_FANS = 2000
+# About 40 MB of float32 data and int32 indices per block.
+MAX_BLOCK_ENTRIES = 5_000_000
+BLOCK_SIZE = 500
+CHUNK_SIZE = 10000
+
+INTERACTIONS_SQL = '''
+    SELECT user_id, recipe_id FROM (
+        SELECT user_id, recipe_id,
+               row_number() OVER (PARTITION BY recipe_id ORDER BY md5(user_id::text), user_id) AS fan_rank
+        FROM (
+            SELECT {like_user} AS user_id, {like_recipe} AS recipe_id FROM {like_table}
+            UNION
+            SELECT {profile_table}.{profile_user}, {bookmark_table}.{bookmark_recipe}
+            FROM {bookmark_table}
+            JOIN {profile_table} ON {profile_table}.{profile_id} = {bookmark_table}.{bookmark_profile}
+        ) AS interactions
+    ) AS ranked
+    WHERE fan_rank <= %s
+'''
+
+
+def get_tables():
+    quote = connection.ops.quote_name
+    like_field = RecipeLike._meta.get_field
+    bookmarks = Profile.bookmarks.through._meta
+    return {
+        'like_table': quote(RecipeLike._meta.db_table),
+        'like_user': quote(like_field('user').column),
+        'like_recipe': quote(like_field('recipe').column),
+        'bookmark_table': quote(bookmarks.db_table),
+        'bookmark_profile': quote(bookmarks.get_field('profile').column),
+        'bookmark_recipe': quote(bookmarks.get_field('recipe').column),
+        'profile_table': quote(Profile._meta.db_table),
+        'profile_id': quote(Profile._meta.pk.column),
+        'profile_user': quote(Profile._meta.get_field('user').column),
+    }
+
+
+def iter_rows(cursor):
+    while rows := cursor.fetchmany(CHUNK_SIZE):
+        yield from rows
+
+
+def load_pairs(max_fans):
+    """
+    (user_id, recipe_id) interactions, at most `max_fans` per recipe, as an
+    (n, 2) array, streamed from a server-side cursor.
+    """
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(INTERACTIONS_SQL.format(**get_tables()), [max_fans])
+        return np.fromiter(itertools.chain.from_iterable(iter_rows(cursor)), dtype=np.int64).reshape(-1, 2)
+
+
+def load_interactions(max_fans=MAX_FANS):
+    """
+    Return the binary users x recipes CSR matrix and the recipe id of every
+    column.
+    """
+    pairs = load_pairs(max_fans)
+    user_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+    recipe_ids, columns = np.unique(pairs[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.float32), (rows, columns)),
+        shape=(len(user_ids), len(recipe_ids)))
+    return matrix, recipe_ids
+
+
+def get_row_costs(matrix, item_matrix):
+    """
+    An upper bound of the co-occurrence entries of every item's row: the
+    interactions of its fans, and at most one per item.
+    """
+    user_degrees = matrix.getnnz(axis=1)
+    return np.minimum(item_matrix @ user_degrees, matrix.shape[1]).astype(np.int64)
+
+
+def iter_blocks(items, costs, max_entries=MAX_BLOCK_ENTRIES):
+    """
+    Split `items` into consecutive blocks whose rows cost at most
+    `max_entries` together, or a single item.
+    """
+    totals = np.cumsum(costs[items])
+    start = 0
+    while start < len(items):
+        spent = totals[start - 1] if start else 0
+        end = max(int(np.searchsorted(totals, spent + max_entries, side='right')), start + 1)
+        yield items[start:end]
+        start = end
+
+
+def iter_neighbors(matrix, items, top_k=TOP_K, min_support=MIN_SUPPORT, max_entries=MAX_BLOCK_ENTRIES):
+    """
+    Yield (item, neighbor_items, scores) for every column index in `items`,
+    best neighbours first.
+    """
+    item_matrix = matrix.T.tocsr()
+    norms = np.sqrt(np.asarray(item_matrix.sum(axis=1)).ravel())
+    for block in iter_blocks(items, get_row_costs(matrix, item_matrix), max_entries):
+        cooccurrences = (item_matrix[block] @ matrix).tocsr()
+        for offset, item in enumerate(block):
+            row = slice(cooccurrences.indptr[offset], cooccurrences.indptr[offset + 1])
+            neighbors = cooccurrences.indices[row]
+            counts = cooccurrences.data[row]
+            keep = (neighbors != item) & (counts >= min_support)
+            neighbors, counts = neighbors[keep], counts[keep]
+            scores = counts / (norms[item] * norms[neighbors])
+            if len(scores) > top_k:
+                best = np.argpartition(-scores, top_k)[:top_k]
+                neighbors, scores = neighbors[best], scores[best]
+            order = np.argsort(-scores, kind='stable')
+            yield item, neighbors[order], scores[order]
+
+
+def affected_items(matrix, recipe_ids, changed):
+    """
+    Column indices whose neighbours may differ after `changed` recipes gained
+    or lost fans: the changed recipes, every recipe sharing a fan with them
+    and every recipe currently listing one of them as a neighbour.
+    """
+    columns = np.flatnonzero(np.isin(recipe_ids, changed))
+    fans = np.flatnonzero(matrix[:, columns].getnnz(axis=1))
+    linked = np.fromiter(
+        RecipeNeighbor.objects.filter(neighbor_id__in=changed.tolist())
+        .values_list('recipe_id', flat=True).distinct().iterator(chunk_size=CHUNK_SIZE),
+        dtype=np.int64)
+    return np.union1d(
+        np.union1d(columns, matrix[fans].indices),
+        np.flatnonzero(np.isin(recipe_ids, linked)))
+
+
+def save_neighbors(recipe_ids, results):
+    """
+    Replace the stored neighbours of `recipe_ids` with `results`.
+    """
+    with transaction.atomic():
+        RecipeNeighbor.objects.filter(recipe_id__in=recipe_ids).delete()
+        RecipeNeighbor.objects.bulk_create([
+            RecipeNeighbor(recipe_id=recipe_id, neighbor_id=neighbor_id, score=score)
+            for recipe_id, neighbors, scores in results
+            for neighbor_id, score in zip(neighbors, scores)
+        ])
+
+
+def update_recommendations(full=False, now=None):
+    """
+    Recompute the neighbours of every recipe, or with `full=False` only of the
+    recipes changed since the previous run. Returns the number of recipes
+    recomputed.
+    """
+    until = get_visible_until(now)
+    refreshed_at = None if full else cache.get(REFRESHED_AT_KEY)
+    matrix, recipe_ids = load_interactions()
+
+    if refreshed_at is None:
+        # Recipes that lost every interaction are not recomputed below.
+        (RecipeNeighbor.objects
+         .exclude(recipe__in=RecipeLike.objects.values('recipe'))
+         .exclude(recipe__in=Profile.bookmarks.through.objects.values('recipe'))
+         .delete())
+        items = np.arange(len(recipe_ids))
+    else:
+        changed = np.fromiter(
+            Recipe.objects.filter(updated_at__gt=refreshed_at, updated_at__lte=until)
+            .values_list('id', flat=True).iterator(chunk_size=CHUNK_SIZE),
+            dtype=np.int64)
+        # Changed recipes without any interaction left just lose their neighbours.
+        RecipeNeighbor.objects.filter(
+            recipe_id__in=np.setdiff1d(changed, recipe_ids).tolist()).delete()
+        items = affected_items(matrix, recipe_ids, changed)
+
+    batch = []
+    for item, neighbors, scores in iter_neighbors(matrix, items):
+        batch.append((int(recipe_ids[item]), recipe_ids[neighbors].tolist(), scores.tolist()))
+        if len(batch) >= BLOCK_SIZE:
+            save_neighbors([recipe_id for recipe_id, _, _ in batch], batch)
+            batch = []
+    if batch:
+        save_neighbors([recipe_id for recipe_id, _, _ in batch], batch)
+
+    cache.set(REFRESHED_AT_KEY, until, None)
+    return len(items)
@@ -1,5 +1,8 @@
 from rest_framework import serializers
 
+from users.models import Profile
+
+from . import categories, like_buffer, uploads
 from .models import Recipe, RecipeCategory, RecipeLike
 
 
@@ -7,21 +10,154 @@ class RecipeCategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = RecipeCategory
         fields = ('id', 'name')
+        # Recipes name an existing category or a new one, see RecipeSerializer.create.
+        extra_kwargs = {'name': {'validators': []}}
 
 
 class RecipeSerializer(serializers.ModelSerializer):
+    """
+    Pass `fields` to serialize only a subset of the declared fields.
+    """
     author = serializers.PrimaryKeyRelatedField(read_only=True)
     username = serializers.SerializerMethodField()
     category_name = serializers.SerializerMethodField()
     category = RecipeCategorySerializer()
-    total_number_of_likes = serializers.SerializerMethodField()
-    total_number_of_bookmarks = serializers.SerializerMethodField()
+    total_number_of_likes = serializers.IntegerField(source='likes_count', read_only=True)
+    total_number_of_bookmarks = serializers.IntegerField(source='bookmarks_count', read_only=True)
+    is_liked = serializers.SerializerMethodField()
+    is_bookmarked = serializers.SerializerMethodField()
+    picture_srcset = serializers.SerializerMethodField()
 
     class Meta:
         model = Recipe
-        fields = ('id', 'category', 'category_name', 'picture', 'title', 'desc',
-                  'cook_time', 'ingredients', 'procedure', 'author', 'username',
-                  'total_number_of_likes', 'total_number_of_bookmarks')
+        fields = ('id', 'category', 'category_name', 'picture', 'picture_width', 'picture_height',
+                  'picture_srcset', 'title', 'desc', 'cook_time', 'ingredients', 'procedure', 'author',
+                  'username', 'total_number_of_likes', 'total_number_of_bookmarks', 'is_liked', 'is_bookmarked')
+        # Compact representation used by list endpoints.
+        summary_fields = ('id', 'category_name', 'picture', 'picture_width', 'picture_height', 'picture_srcset',
+                          'title', 'username', 'total_number_of_likes', 'total_number_of_bookmarks',
+                          'is_liked', 'is_bookmarked')
+        # State of the requesting user, only rendered for authenticated requests.
+        viewer_fields = ('is_liked', 'is_bookmarked')
+        # Model columns read by each field, used to narrow querysets.
+        field_columns = {
+            'id': ('id',),
+            'category': ('category', 'category__id', 'category__name'),
+            'category_name': ('category', 'category__name'),
+            'picture': ('picture',),
+            'picture_width': ('picture_width',),
+            'picture_height': ('picture_height',),
+            'picture_srcset': ('picture', 'picture_renditions'),
+            'title': ('title',),
+            'desc': ('desc',),
+            'cook_time': ('cook_time',),
+            'ingredients': ('ingredients',),
+            'procedure': ('procedure',),
+            'author': ('author',),
+            'username': ('author', 'author__username'),
+            'total_number_of_likes': ('likes_count',),
+            'total_number_of_bookmarks': ('bookmarks_count',),
+            'is_liked': (),
+            'is_bookmarked': (),
+        }
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+        if self.get_viewer() is None:
+            # Anonymous responses stay identical for everyone (and cacheable).
+            for field_name in self.Meta.viewer_fields:
+                self.fields.pop(field_name, None)
+
+    @classmethod
+    def narrow_queryset(cls, queryset, fields, extra_columns=()):
+        """
+        Restrict `queryset` to the columns and joins needed to render `fields`.
+        """
+        columns = {'id', *extra_columns}
+        for field_name in fields:
+            columns.update(cls.Meta.field_columns.get(field_name, ()))
+        related = {column.split('__')[0] for column in columns if '__' in column}
+        queryset = queryset.select_related(None)
+        if related:
+            queryset = queryset.select_related(*sorted(related))
+        return queryset.prefetch_related(None).only(*sorted(columns))
+
+    def get_viewer(self):
+        request = self.context.get('request')
+        user = getattr(request, 'user', None)
+        return user if user is not None and user.is_authenticated else None
+
+    def get_serialized_instances(self):
+        if isinstance(self.parent, serializers.ListSerializer):
+            return self.parent.instance or ()
+        return [self.instance]
+
+    def get_viewer_state(self):
+        """
+        Ids of the recipes being serialized that the requesting user likes and
+        bookmarks, with one query per flag for the whole page.
+        """
+        if 'viewer_state' not in self.context:
+            user = self.get_viewer()
+            recipe_ids = [instance.pk for instance in self.get_serialized_instances()]
+            liked, bookmarked = set(), set()
+            if 'is_liked' in self.fields:
+                liked = set(RecipeLike.objects.filter(user=user, recipe_id__in=recipe_ids)
+                            .values_list('recipe_id', flat=True))
+                if like_buffer.is_enabled():
+                    for recipe_id, state in like_buffer.get_buffered_states(user.pk, recipe_ids).items():
+                        (liked.add if state else liked.discard)(recipe_id)
+            if 'is_bookmarked' in self.fields:
+                bookmarked = set(Profile.bookmarks.through.objects
+                                 .filter(profile__user=user, recipe_id__in=recipe_ids)
+                                 .values_list('recipe_id', flat=True))
+            self.context['viewer_state'] = {'liked': liked, 'bookmarked': bookmarked}
+        return self.context['viewer_state']
+
+    def get_is_liked(self, obj):
+        return obj.pk in self.get_viewer_state()['liked']
+
+    def get_is_bookmarked(self, obj):
+        return obj.pk in self.get_viewer_state()['bookmarked']
+
+    def get_picture_srcset(self, obj):
+        """
+        Map media types to srcset strings of the picture's renditions, None
+        until they have been made, see recipe.images.
+        """
+        renditions = obj.picture_renditions
+        if not obj.picture or renditions.get('source') != obj.picture.name:
+            return None
+        request = self.context.get('request')
+        storage = obj.picture.storage
+        srcset = {}
+        for variant in renditions['variants']:
+            url = storage.url(variant['name'])
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            srcset.setdefault(variant['type'], []).append(f"{url} {variant['width']}w")
+        return {media_type: ', '.join(entries) for media_type, entries in srcset.items()}
+
+    def get_like_deltas(self):
+        """
+        Buffered like count changes of every recipe being serialized,
+        fetched once per response, see recipe.like_buffer.
+        """
+        if 'like_deltas' not in self.context:
+            self.context['like_deltas'] = like_buffer.get_count_deltas(
+                [instance.pk for instance in self.get_serialized_instances()])
+        return self.context['like_deltas']
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        if 'total_number_of_likes' in data and like_buffer.is_enabled():
+            delta = self.get_like_deltas().get(instance.pk, 0)
+            data['total_number_of_likes'] = max(data['total_number_of_likes'] + delta, 0)
+        return data
 
     def get_username(self, obj):
         return obj.author.username
@@ -29,34 +165,79 @@ class RecipeSerializer(serializers.ModelSerializer):
     def get_category_name(self, obj):
         return obj.category.name
 
-    def get_total_number_of_likes(self, obj):
-        return obj.get_total_number_of_likes()
-
-    def get_total_number_of_bookmarks(self, obj):
-        return obj.get_total_number_of_bookmarks()
-
     def create(self, validated_data):
         category = validated_data.pop('category')
-        category_instance, created = RecipeCategory.objects.get_or_create(
-            **category)
         recipe_instance = Recipe.objects.create(
-            **validated_data, category=category_instance)
+            **validated_data, category=categories.get_or_create_category(category['name']))
         return recipe_instance
 
     def update(self, instance, validated_data):
         if 'category' in validated_data:
-            nested_serializer = self.fields['category']
-            nested_instance = instance.category
-            nested_data = validated_data.pop('category')
-
-            nested_serializer.update(nested_instance, nested_data)
+            # Move the recipe rather than renaming a category other recipes share.
+            category = validated_data.pop('category')
+            instance.category = categories.get_or_create_category(category['name'])
 
         return super(RecipeSerializer, self).update(instance, validated_data)
 
 
+class RecipeBatchSerializer(RecipeSerializer):
+    """
+    One item of a batch write, see recipe.batch. Items with an `id` update
+    that recipe; pictures can't be sent in a JSON batch.
+    """
+    id = serializers.IntegerField(required=False, min_value=1)
+
+    class Meta(RecipeSerializer.Meta):
+        read_only_fields = ('picture',)
+
+
+class RecipePantrySerializer(RecipeSerializer):
+    """
+    Recipe with how well it is covered by the requested pantry ingredients.
+    """
+    matched_ingredients = serializers.IntegerField(read_only=True)
+    ingredient_count = serializers.IntegerField(read_only=True)
+    coverage = serializers.FloatField(read_only=True)
+
+    class Meta(RecipeSerializer.Meta):
+        fields = RecipeSerializer.Meta.fields + ('matched_ingredients', 'ingredient_count', 'coverage')
+        summary_fields = RecipeSerializer.Meta.summary_fields + (
+            'matched_ingredients', 'ingredient_count', 'coverage')
+        field_columns = dict(RecipeSerializer.Meta.field_columns, ingredient_count=('ingredient_count',))
+
+
 class RecipeLikeSerializer(serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(read_only=True)
 
     class Meta:
         model = RecipeLike
         fields = ('id', 'user', 'recipe')
+
+
+class UploadSlotSerializer(serializers.Serializer):
+    """
+    The file to reserve an upload slot for, see recipe.uploads.
+    """
+    size = serializers.IntegerField(min_value=1)
+    name = serializers.CharField(max_length=255)
+
+    def validate_size(self, value):
+        max_size = self.context['max_size']
+        if value > max_size:
+            raise serializers.ValidationError(f'Upload at most {max_size} bytes.')
+        return value
+
+
+class UploadAttachSerializer(serializers.Serializer):
+    """
+    A finished upload of the requesting user: {"upload": token}.
+    """
+    upload = serializers.CharField()
+
+    def validate_upload(self, value):
+        slot = uploads.load_slot(value)
+        if slot is None or slot['user'] != self.context['request'].user.pk:
+            raise serializers.ValidationError('Invalid or expired upload.')
+        if not uploads.is_complete(slot):
+            raise serializers.ValidationError('The upload is not complete.')
+        return slot
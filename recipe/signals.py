@@ -0,0 +1,118 @@
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import cache, categories, facets
+from .ingredients import release_recipe_ingredients, sync_recipe_ingredients
+from .models import Recipe, RecipeCategory, RecipeLike, get_default_recipe_category
+from .tasks import process_recipe_picture
+
+
+@receiver(post_save, sender=RecipeLike)
+def increment_likes_count(sender, instance, created, **kwargs):
+    if created:
+        Recipe.adjust_counter([instance.recipe_id], 'likes_count', 1)
+
+
+@receiver(post_delete, sender=RecipeLike)
+def decrement_likes_count(sender, instance, **kwargs):
+    Recipe.adjust_counter([instance.recipe_id], 'likes_count', -1)
+
+
+@receiver(post_save, sender=Recipe)
+def invalidate_saved_recipe(sender, instance, **kwargs):
+    # A new or re-categorised recipe can enter any list page.
+    cache.invalidate_recipes([instance.pk])
+    cache.invalidate_lists()
+
+
+@receiver(post_save, sender=Recipe)
+def sync_ingredients(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or 'ingredients' in update_fields:
+        sync_recipe_ingredients([instance])
+
+
+@receiver(pre_delete, sender=Recipe)
+def uncount_ingredients(sender, instance, **kwargs):
+    release_recipe_ingredients(instance)
+
+
+@receiver(post_delete, sender=Recipe)
+def invalidate_deleted_recipe(sender, instance, **kwargs):
+    cache.invalidate_recipes([instance.pk])
+
+
+@receiver(post_init, sender=Recipe)
+def remember_facet_key(sender, instance, **kwargs):
+    instance._facet_key = facets.get_key(instance)
+
+
+@receiver(pre_save, sender=Recipe)
+def load_facet_key(sender, instance, update_fields=None, **kwargs):
+    # Only for instances loaded without author or category.
+    if instance._facet_key is None and instance.pk is not None and not instance._state.adding:
+        if update_fields is None or {'category', 'category_id'} & set(update_fields):
+            instance._facet_key = (Recipe.objects.filter(pk=instance.pk)
+                                   .values_list('author_id', 'category_id').first())
+
+
+@receiver(post_save, sender=Recipe)
+def count_saved_recipe(sender, instance, created, **kwargs):
+    if created:
+        instance._facet_key = None
+    elif instance._facet_key is None:
+        # Neither loaded nor saved with a category, so it didn't change.
+        return
+    facets.apply_deltas(facets.count_changes([instance]))
+    instance._facet_key = facets.get_key(instance)
+
+
+@receiver(post_delete, sender=Recipe)
+def uncount_deleted_recipe(sender, instance, **kwargs):
+    if instance._facet_key is not None:
+        facets.apply_deltas({instance._facet_key: -1})
+
+
+@receiver(post_save, sender=RecipeCategory)
+@receiver(post_delete, sender=RecipeCategory)
+def invalidate_category(sender, instance, **kwargs):
+    cache.invalidate_lists()
+    categories.notify_changed()
+
+
+@receiver(post_init, sender=Recipe)
+def remember_picture(sender, instance, **kwargs):
+    # The stored file name, None if the picture wasn't loaded.
+    picture = instance.__dict__.get('picture')
+    instance._picture_name = getattr(picture, 'name', picture)
+
+
+@receiver(post_save, sender=Recipe)
+def process_new_picture(sender, instance, update_fields=None, **kwargs):
+    if 'picture' not in instance.__dict__ or (update_fields is not None and 'picture' not in update_fields):
+        return
+    name = instance.picture.name
+    if name and name != instance._picture_name:
+        # Renditions are made after the upload request has returned.
+        transaction.on_commit(lambda: process_recipe_picture.delay(instance.pk))
+    instance._picture_name = name
+
+
+@receiver(pre_delete, sender=RecipeCategory)
+def check_category_recipes(sender, instance, **kwargs):
+    instance._had_recipes = instance.recipe_list.exists()
+
+
+@receiver(post_delete, sender=RecipeCategory)
+def recount_default_category(sender, instance, **kwargs):
+    # The deleted category's recipes were moved by a bulk update.
+    if instance._had_recipes:
+        facets.reconcile_category(get_default_recipe_category().pk)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_author(sender, instance, created, update_fields=None, **kwargs):
+    # Recipes embed their author's username.
+    if not created and (update_fields is None or 'username' in update_fields):
+        cache.invalidate_recipes(list(instance.recipes.values_list('pk', flat=True)))
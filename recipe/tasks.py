@@ -1,10 +1,15 @@
 # recipe/tasks.py
-from celery import shared_task
+from celery import group, shared_task
 import logging
 import smtplib, ssl
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
 from django.core.mail import send_mail
 from django.utils import timezone
+from . import digests, facets, images, like_buffer, outbox, uploads
 from .models import Recipe, RecipeLike
+from .trending import rebuild_trending_scores, refresh_trending_scores
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 import os
@@ -31,27 +36,155 @@ def notify_author_about_likes():
     return 'Task completed!'
 
 @shared_task
-def send_daily_notifications():
-    today = timezone.now().date()
-    
-    # Get all recipes that received likes today
-    liked_recipes = Recipe.objects.filter(recipelike__created__date=today).distinct()
-    #liked_recipes = Recipe.objects.all()
-
-    for recipe in liked_recipes:
-        email = recipe.author.email
-        recipe_id = recipe.id
-        recipe_name = recipe.title
-        subject = 'Recipe Like Notification'
-        message = f'Your recipe "{recipe_name}" has received new likes today!'
-        from_email = 'manoj.venkateshgowda@campusuvce.in'  
-        recipient_list = [email]
-
-        try:
-            send_mail(subject, message, from_email, recipient_list)
-            logger.info(f'Email notification sent successfully for recipe ID {recipe_id}')
-        except Exception as e:
-            logger.error(f'Failed to send email notification for recipe ID {recipe_id}: {e}')
-    
-    return f'All notifications sent!,{liked_recipes}'
+def send_daily_notifications(day=None):
+    """
+    Send every author one digest of the likes their recipes received on
+    `day` (ISO date, yesterday by default), see recipe.digests.
+    """
+    like_digests = digests.get_like_digests(*digests.get_day_range(day))
+    size = settings.RECIPE_DIGEST_BATCH_SIZE
+    batches = [like_digests[i:i + size] for i in range(0, len(like_digests), size)]
+    # The batches run in parallel on however many workers are available.
+    group(send_like_digests.s(batch) for batch in batches).apply_async()
+    return f'Queued {len(like_digests)} like digests in {len(batches)} batches!'
 
+
+@shared_task
+def send_like_digests(like_digests):
+    """
+    Send a batch of like digests over one SMTP connection.
+    """
+    count = digests.send_digests(like_digests)
+    return f'Sent {count} of {len(like_digests)} like digests!'
+
+
+@shared_task
+def update_trending_scores(full=False):
+    """
+    Refresh the trending scores; `full` rebuilds them from the likes.
+    """
+    # Overlapping runs would add the same likes twice.
+    lock_key = 'recipe:trending:lock'
+    if not cache.add(lock_key, 1, 60 * 30):
+        logger.info('Trending scores are already being updated')
+        return 'Skipped'
+    try:
+        if full:
+            rebuild_trending_scores()
+        else:
+            refresh_trending_scores()
+    finally:
+        cache.delete(lock_key)
+    return 'Trending scores updated!'
+
+
+@shared_task
+def update_recipe_recommendations(full=False):
+    """
+    Recompute the "liked this also liked" neighbours of changed recipes;
+    `full` recomputes all of them.
+    """
+    # Imported here to keep numpy and scipy out of the web processes.
+    from .recommendations import update_recommendations
+
+    lock_key = 'recipe:recommendations:lock'
+    if not cache.add(lock_key, 1, 60 * 60 * 2):
+        logger.info('Recipe recommendations are already being updated')
+        return 'Skipped'
+    try:
+        count = update_recommendations(full=full)
+    finally:
+        cache.delete(lock_key)
+    return f'Recommendations updated for {count} recipes!'
+
+
+@shared_task
+def flush_like_buffer():
+    """
+    Write the likes buffered in Redis to the database, see recipe.like_buffer.
+    """
+    if not like_buffer.is_enabled():
+        return 'Like buffer disabled'
+    lock_key = 'recipe:likes:flush-lock'
+    if not cache.add(lock_key, 1, 60 * 5):
+        return 'Skipped'
+    try:
+        count = like_buffer.flush()
+    finally:
+        cache.delete(lock_key)
+    return f'Flushed {count} buffered likes!'
+
+
+@shared_task
+def reconcile_facet_counts():
+    """
+    Recount the category and author facet counts, see recipe.facets.
+    """
+    lock_key = 'recipe:facets:lock'
+    if not cache.add(lock_key, 1, 60 * 30):
+        logger.info('Facet counts are already being reconciled')
+        return 'Skipped'
+    try:
+        count = facets.reconcile()
+    finally:
+        cache.delete(lock_key)
+    return f'Facet counts reconciled, {count} categories had drifted!'
+
+
+@shared_task
+def process_recipe_picture(recipe_id):
+    """
+    Write the resized renditions of a recipe's picture, see recipe.images.
+    """
+    if images.process_picture(recipe_id):
+        return f'Picture of recipe {recipe_id} processed!'
+    return 'Skipped'
+
+
+@shared_task
+def process_recipe_pictures(recipe_ids):
+    """
+    process_recipe_picture for a batch of recipes, queued in parallel by the
+    process_recipe_pictures command.
+    """
+    count = sum(images.process_picture(recipe_id) for recipe_id in recipe_ids)
+    return f'Processed {count} of {len(recipe_ids)} recipe pictures!'
+
+
+@shared_task
+def attach_upload(slot, model_label, pk, field_name):
+    """
+    Move a finished upload into an image field of a recipe or profile, see
+    recipe.uploads.
+    """
+    if uploads.attach(slot, apps.get_model(model_label), pk, field_name):
+        return f"Upload {slot['id']} attached to {model_label} {pk}!"
+    return 'Skipped'
+
+
+@shared_task
+def delete_expired_uploads():
+    """
+    Delete the partial uploads of expired upload slots.
+    """
+    count = uploads.delete_expired()
+    return f'Deleted {count} expired uploads!'
+
+
+@shared_task
+def dispatch_outbox():
+    """
+    Deliver the due messages of the email outbox, see recipe.outbox. Routed
+    to the outbox queue.
+    """
+    sent, deferred, failed = outbox.dispatch()
+    return f'Sent {sent} emails, deferred {deferred}, {failed} failed!'
+
+
+@shared_task
+def purge_outbox():
+    """
+    Delete old delivered and failed messages from the email outbox.
+    """
+    count = outbox.purge()
+    return f'Purged {count} outbox emails!'
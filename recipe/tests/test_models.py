@@ -1,6 +1,30 @@
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+
+import hashlib
+import io
+import smtplib
+import time
+
+import numpy as np
 import pytest
-from recipe.models import Recipe, RecipeCategory, RecipeLike
+from django.core import mail
+from django.core.files.base import ContentFile
+from django.core.mail import BadHeaderError, EmailMultiAlternatives, send_mail
+from PIL import Image
+from scipy import sparse
+from django.core.management import call_command
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from recipe import categories, digests, facets, images, outbox, recommendations, tasks, trending, visibility
+from recipe.serializers import RecipeSerializer
+from recipe.ingredients import normalize_ingredient, parse_ingredients
+from recipe.models import (AuthorCategoryCount, Ingredient, OutboxEmail, Recipe, RecipeCategory, RecipeIngredient,
+                           RecipeLike, RecipeNeighbor)
+from recipe.recommendations import update_recommendations
+from recipe.trending import rebuild_trending_scores, refresh_trending_scores
 from django.contrib.auth import get_user_model
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -50,3 +74,691 @@ class TestRecipeModels:
         )
         RecipeLike.objects.create(user=self.user, recipe=recipe)
         assert recipe.likes.count() == 1
+
+
+@pytest.mark.django_db
+class TestRecipeCounters:
+    def setup_method(self):
+        self.user = User.objects.create_user(email='counter@example.com', username='counter', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipe = Recipe.objects.create(
+            title='Counted Recipe',
+            desc='Yummy recipe',
+            cook_time='00:40:00',
+            ingredients='chocolate, milk',
+            procedure='stir well',
+            category=self.category,
+            author=self.user
+        )
+
+    def test_likes_count_follows_likes(self):
+        like = RecipeLike.objects.create(user=self.user, recipe=self.recipe)
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == 1
+        like.delete()
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == 0
+
+    def test_bookmarks_count_follows_bookmarks(self):
+        self.user.profile.bookmarks.add(self.recipe)
+        self.user.profile.bookmarks.add(self.recipe)
+        self.recipe.refresh_from_db()
+        assert self.recipe.bookmarks_count == 1
+        self.user.profile.bookmarks.remove(self.recipe)
+        self.recipe.refresh_from_db()
+        assert self.recipe.bookmarks_count == 0
+
+    def test_export_command(self, tmp_path, settings):
+        settings.RECIPE_COMMIT_LAG = 0
+        output = tmp_path / 'recipes.csv'
+        stderr = StringIO()
+        call_command('export_recipes', format='csv', output=str(output), stderr=stderr)
+        assert output.read_text().splitlines()[1].startswith(f'{self.recipe.id},Counted Recipe,')
+        assert 'Exported 1 recipes' in stderr.getvalue()
+
+        stdout = StringIO()
+        call_command('export_recipes', updated_since=timezone.now().isoformat(), stdout=stdout, stderr=stderr)
+        assert stdout.getvalue() == ''
+
+    def test_reconcile_command_repairs_counters(self):
+        RecipeLike.objects.create(user=self.user, recipe=self.recipe)
+        self.user.profile.bookmarks.add(self.recipe)
+        Recipe.objects.filter(pk=self.recipe.pk).update(likes_count=7, bookmarks_count=0)
+        call_command('reconcile_recipe_counters', stdout=StringIO())
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == 1
+        assert self.recipe.bookmarks_count == 1
+
+
+@pytest.mark.django_db
+class TestRecipeSearchVector:
+    def test_search_vector_maintained_and_reindexed(self):
+        user = User.objects.create_user(email='vector@example.com', username='vector', password='testpass')
+        recipe = Recipe.objects.create(
+            title='Lemon tart',
+            desc='Tangy',
+            cook_time='00:40:00',
+            ingredients='lemons, butter',
+            procedure='bake',
+            category=RecipeCategory.objects.create(name='Dessert'),
+            author=user
+        )
+        assert Recipe.objects.filter(search_vector='lemon').get() == recipe
+
+        Recipe.objects.update(search_vector=None)
+        call_command('reindex_recipe_search', '--missing-only', stdout=StringIO())
+        assert Recipe.objects.filter(search_vector='butter').get() == recipe
+
+
+class TestIngredientParser:
+    def test_normalize_ingredient(self):
+        assert normalize_ingredient('2 cups Chopped Tomatoes (ripe)') == 'tomato'
+        assert normalize_ingredient('1 tbsp olive oil') == 'olive oil'
+        assert normalize_ingredient('3 large eggs') == 'egg'
+        assert normalize_ingredient('1/2 tsp') is None
+
+    def test_parse_ingredients(self):
+        assert parse_ingredients('sugar, flour\n2 eggs; Sugar') == {'sugar', 'flour', 'egg'}
+
+
+@pytest.mark.django_db
+class TestRecipeIngredientIndex:
+    def test_backfill_command(self):
+        user = User.objects.create_user(email='index@example.com', username='index', password='testpass')
+        recipe = Recipe.objects.create(
+            title='Porridge',
+            desc='Warm',
+            cook_time='00:10:00',
+            ingredients='oats, milk, honey',
+            procedure='simmer',
+            category=RecipeCategory.objects.create(name='Breakfast'),
+            author=user
+        )
+        RecipeIngredient.objects.all().delete()
+        Recipe.objects.update(ingredient_count=0)
+
+        call_command('backfill_recipe_ingredients', '--missing-only', stdout=StringIO())
+        recipe.refresh_from_db()
+        assert recipe.ingredient_count == 3
+        assert set(recipe.ingredient_links.values_list('ingredient__name', flat=True)) == {'oat', 'milk', 'honey'}
+        assert set(Ingredient.objects.values_list('name', 'recipe_count')) == {('oat', 1), ('milk', 1), ('honey', 1)}
+
+    def test_recipe_counts(self):
+        user = User.objects.create_user(email='counts@example.com', username='counts', password='testpass')
+        category = RecipeCategory.objects.create(name='Breakfast')
+        recipes = [Recipe.objects.create(title='Porridge', desc='Warm', cook_time='00:10:00', ingredients=ingredients,
+                                         procedure='simmer', category=category, author=user)
+                   for ingredients in ('oats, milk', 'milk, honey')]
+
+        def counts():
+            return dict(Ingredient.objects.values_list('name', 'recipe_count'))
+
+        assert counts() == {'oat': 1, 'milk': 2, 'honey': 1}
+        recipes[0].ingredients = 'oats, water'
+        recipes[0].save()
+        assert counts() == {'oat': 1, 'milk': 1, 'honey': 1, 'water': 1}
+        recipes[1].delete()
+        assert counts() == {'oat': 1, 'milk': 0, 'honey': 0, 'water': 1}
+
+
+@pytest.mark.django_db
+class TestRecipeTrending:
+    def setup_method(self):
+        self.now = timezone.now()
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.users = [User.objects.create_user(email=f'fan{i}@example.com', username=f'fan{i}', password='testpass')
+                      for i in range(3)]
+        self.recipe = Recipe.objects.create(
+            title='Trending Recipe',
+            desc='Popular',
+            cook_time='00:20:00',
+            ingredients='sugar',
+            procedure='bake',
+            category=self.category,
+            author=self.users[0]
+        )
+
+    def like(self, user, hours_ago):
+        like = RecipeLike.objects.create(user=user, recipe=self.recipe)
+        RecipeLike.objects.filter(pk=like.pk).update(created=self.now - timedelta(hours=hours_ago))
+
+    def stored_score(self):
+        self.recipe.refresh_from_db()
+        return self.recipe.trending_score
+
+    def test_likes_decay_with_age(self, settings):
+        settings.RECIPE_TRENDING_HALF_LIFE = 24
+        settings.RECIPE_COMMIT_LAG = 0
+        self.like(self.users[0], 0)
+        self.like(self.users[1], 24)
+        self.like(self.users[2], 24 * 30)
+        rebuild_trending_scores(self.now)
+        assert self.stored_score() == pytest.approx(1.5)
+
+    def test_refresh_matches_rebuild(self, settings):
+        settings.RECIPE_COMMIT_LAG = 0
+        self.like(self.users[0], 5)
+        rebuild_trending_scores(self.now - timedelta(hours=3))
+        self.like(self.users[1], 2)
+        refresh_trending_scores(self.now)
+        refreshed = trending.get_score(self.stored_score(), trending.get_state()['epoch'], self.now)
+
+        rebuild_trending_scores(self.now)
+        assert refreshed == pytest.approx(self.stored_score())
+
+    def test_refresh_only_writes_liked_recipes(self, settings):
+        settings.RECIPE_COMMIT_LAG = 0
+        self.like(self.users[0], 5)
+        rebuild_trending_scores(self.now - timedelta(hours=3))
+        stored = self.stored_score()
+        other = Recipe.objects.create(title='Other', desc='x', cook_time='00:20:00', ingredients='salt',
+                                      procedure='x', category=self.category, author=self.users[0])
+        RecipeLike.objects.filter(pk=RecipeLike.objects.create(user=self.users[1], recipe=other).pk).update(
+            created=self.now - timedelta(hours=1))
+        refresh_trending_scores(self.now)
+        # Not decayed in place; the shared epoch keeps the order.
+        assert self.stored_score() == stored
+        assert Recipe.objects.get(pk=other.pk).trending_score > stored
+
+    def test_refresh_counts_late_commits(self, settings):
+        settings.RECIPE_COMMIT_LAG = 60
+        rebuild_trending_scores(self.now)
+        # Stamped before the refresh above, committed after it.
+        self.like(self.users[0], 0)
+        refresh_trending_scores(self.now + timedelta(minutes=10))
+        assert self.stored_score() > 0
+
+    def test_open_transaction_holds_refresh_back(self, settings):
+        settings.RECIPE_COMMIT_LAG = 0
+        other = connections.create_connection('default')
+        try:
+            with other.cursor() as cursor:
+                cursor.execute('BEGIN')
+                cursor.execute('SELECT now()')
+                started = cursor.fetchone()[0]
+            assert visibility.get_visible_until() <= started
+        finally:
+            other.close()
+
+
+@pytest.mark.django_db
+class TestRecipeRecommendations:
+    def setup_method(self):
+        self.category = RecipeCategory.objects.create(name='Dinner')
+        self.users = [User.objects.create_user(email=f'cook{i}@example.com', username=f'cook{i}', password='testpass')
+                      for i in range(4)]
+        self.a, self.b, self.c = [
+            Recipe.objects.create(
+                title=title,
+                desc='Hearty',
+                cook_time='00:45:00',
+                ingredients='beans',
+                procedure='simmer',
+                category=self.category,
+                author=self.users[0]
+            ) for title in ('Chili', 'Cornbread', 'Nachos')]
+        # A/B share two fans, A/C three, B/C only one.
+        for user, recipe in ((0, self.a), (0, self.b), (1, self.a), (1, self.b), (2, self.a), (3, self.a), (3, self.c)):
+            RecipeLike.objects.create(user=self.users[user], recipe=recipe)
+        for user in (1, 2):
+            self.users[user].profile.bookmarks.add(self.c)
+        self.d = Recipe.objects.create(title='Salad', desc='Light', cook_time='00:05:00', ingredients='lettuce',
+                                       procedure='toss', category=self.category, author=self.users[0])
+        loner = User.objects.create_user(email='loner@example.com', username='loner', password='testpass')
+        RecipeLike.objects.create(user=loner, recipe=self.d)
+
+    def neighbors(self, recipe):
+        return list(RecipeNeighbor.objects.filter(recipe=recipe).order_by('-score')
+                    .values_list('neighbor_id', flat=True))
+
+    def test_full_update(self):
+        assert update_recommendations(full=True) == 4
+        assert self.neighbors(self.a) == [self.c.id, self.b.id]
+        assert self.neighbors(self.b) == [self.a.id]
+        assert self.neighbors(self.c) == [self.a.id]
+        score = RecipeNeighbor.objects.get(recipe=self.a, neighbor=self.c).score
+        assert score == pytest.approx(3 / (4 * 3) ** 0.5)
+
+    def test_incremental_update(self, settings):
+        settings.RECIPE_COMMIT_LAG = 0
+        update_recommendations(full=True)
+        RecipeLike.objects.get(user=self.users[0], recipe=self.b).delete()
+        # Only B changed, but A and C share fans with it; D is left alone.
+        assert update_recommendations() == 3
+        assert self.neighbors(self.a) == [self.c.id]
+        assert self.neighbors(self.b) == []
+        assert self.neighbors(self.c) == [self.a.id]
+
+    def test_fans_are_sampled(self):
+        matrix, recipe_ids = recommendations.load_interactions(max_fans=2)
+        fans = dict(zip(recipe_ids.tolist(), matrix.getnnz(axis=0).tolist()))
+        assert fans == {self.a.id: 2, self.b.id: 2, self.c.id: 2, self.d.id: 1}
+        # Every recipe keeps the fans with the smallest hashes.
+        fans = {}
+        for user_id, recipe_id in recommendations.load_pairs(max_fans=100).tolist():
+            fans.setdefault(recipe_id, []).append(user_id)
+        expected = {
+            (user_id, recipe_id) for recipe_id, user_ids in fans.items()
+            for user_id in sorted(user_ids, key=lambda user_id: hashlib.md5(str(user_id).encode()).hexdigest())[:2]}
+        assert set(map(tuple, recommendations.load_pairs(max_fans=2).tolist())) == expected
+
+    def test_blocks_bound_working_set(self):
+        matrix = sparse.random(200, 300, density=0.05, format='csr', random_state=0)
+        matrix.data[:] = 1
+        item_matrix = matrix.T.tocsr()
+        items = np.arange(300)
+        costs = recommendations.get_row_costs(matrix, item_matrix)
+        blocks = list(recommendations.iter_blocks(items, costs, max_entries=1000))
+        assert np.concatenate(blocks).tolist() == items.tolist()
+        assert len(blocks) > 1
+        for block in blocks:
+            assert len(block) == 1 or (item_matrix[block] @ matrix).nnz <= 1000
+
+
+@pytest.mark.django_db(transaction=True)
+class TestCategoryRegistry:
+    def setup_method(self):
+        categories.ensure_listener()
+        assert categories._listening.wait(5)
+        self.category = RecipeCategory.objects.create(name='Dessert')
+
+    def wait_until_cleared(self):
+        deadline = time.monotonic() + 5
+        while categories._state['registry'] is not None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return categories._state['registry'] is None
+
+    def test_lookups_hit_memory(self, django_assert_num_queries):
+        categories.get_registry()
+        with django_assert_num_queries(0):
+            assert categories.get_or_create_category('Dessert').pk == self.category.pk
+            assert categories.get_categories(['Dessert', 'Soups']) == {'Dessert': self.category}
+
+    def test_change_is_announced(self):
+        categories.get_registry()
+        RecipeCategory.objects.create(name='Soups')
+        assert categories._state['registry'] is None
+        assert 'Soups' in categories.get_registry()
+
+    def test_announcement_from_other_process(self):
+        categories.get_registry()
+        categories.get_redis().publish(categories.CHANNEL, 0)
+        assert self.wait_until_cleared()
+
+    def test_not_filled_inside_transaction(self):
+        with transaction.atomic():
+            RecipeCategory.objects.create(name='Soups')
+            assert categories.get_registry() is None
+            assert categories.get_or_create_category('Soups').name == 'Soups'
+            transaction.set_rollback(True)
+        assert 'Soups' not in categories.get_registry()
+
+    def test_names_are_unique(self):
+        with pytest.raises(IntegrityError):
+            RecipeCategory.objects.create(name='Dessert')
+
+
+@pytest.mark.django_db
+class TestRecipeFacetCounts:
+    def setup_method(self):
+        self.user = User.objects.create_user(email='facets@example.com', username='facets', password='testpass')
+        self.other = User.objects.create_user(email='other@example.com', username='other', password='testpass')
+        self.dessert = RecipeCategory.objects.create(name='Dessert')
+        self.soups = RecipeCategory.objects.create(name='Soups')
+
+    def create_recipe(self, category, author=None):
+        return Recipe.objects.create(title='Facet', desc='x', cook_time='00:30:00', ingredients='salt',
+                                     procedure='x', category=category, author=author or self.user)
+
+    def counts(self):
+        categories = dict(RecipeCategory.objects.values_list('name', 'recipes_count'))
+        authors = {(row.author.username, row.category.name): row.recipes_count
+                   for row in AuthorCategoryCount.objects.select_related('author', 'category')
+                   if row.recipes_count}
+        return categories, authors
+
+    def test_counts_follow_recipe_writes(self):
+        recipe = self.create_recipe(self.dessert)
+        self.create_recipe(self.dessert, self.other)
+        assert self.counts() == ({'Dessert': 2, 'Soups': 0},
+                                 {('facets', 'Dessert'): 1, ('other', 'Dessert'): 1})
+
+        recipe.category = self.soups
+        recipe.save()
+        recipe.save()
+        assert self.counts() == ({'Dessert': 1, 'Soups': 1},
+                                 {('facets', 'Soups'): 1, ('other', 'Dessert'): 1})
+
+        Recipe.objects.get(pk=recipe.pk).delete()
+        assert self.counts() == ({'Dessert': 1, 'Soups': 0}, {('other', 'Dessert'): 1})
+
+    def test_deferred_instance_moved(self):
+        recipe = self.create_recipe(self.dessert)
+        deferred = Recipe.objects.only('id', 'title').get(pk=recipe.pk)
+        deferred.category = self.soups
+        deferred.save()
+        assert self.counts() == ({'Dessert': 0, 'Soups': 1}, {('facets', 'Soups'): 1})
+
+    def test_deleted_category_moves_to_default(self):
+        self.create_recipe(self.dessert)
+        self.create_recipe(self.dessert, self.other)
+        self.dessert.delete()
+        assert self.counts() == ({'Others': 2, 'Soups': 0},
+                                 {('facets', 'Others'): 1, ('other', 'Others'): 1})
+
+    def test_reconcile_repairs_drift(self):
+        self.create_recipe(self.dessert)
+        self.create_recipe(self.soups, self.other)
+        RecipeCategory.objects.filter(pk=self.dessert.pk).update(recipes_count=7)
+        AuthorCategoryCount.objects.filter(category=self.soups).delete()
+        AuthorCategoryCount.objects.create(author=self.other, category=self.dessert, recipes_count=3)
+
+        assert facets.reconcile() == 2
+        assert self.counts() == ({'Dessert': 1, 'Soups': 1},
+                                 {('facets', 'Dessert'): 1, ('other', 'Soups'): 1})
+        assert facets.reconcile() == 0
+
+
+@pytest.mark.django_db
+class TestRecipePictures:
+    @pytest.fixture(autouse=True)
+    def media_root(self, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        settings.MEDIA_URL = '/media/'
+        self.media = tmp_path
+
+    def setup_method(self):
+        self.user = User.objects.create_user(email='pictures@example.com', username='pictures', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Dessert')
+
+    def make_jpeg(self, size=(2000, 1000), orientation=None):
+        image = Image.new('RGB', size, (200, 120, 40))
+        exif = Image.Exif()
+        exif[0x010F] = 'Camera maker'
+        if orientation:
+            exif[0x0112] = orientation
+        output = io.BytesIO()
+        image.save(output, 'JPEG', exif=exif.tobytes())
+        return ContentFile(output.getvalue(), name='cake.jpg')
+
+    def create_recipe(self, picture):
+        return Recipe.objects.create(title='Cake', desc='x', cook_time='00:30:00', ingredients='flour',
+                                     procedure='bake', category=self.category, author=self.user, picture=picture)
+
+    def test_renditions(self):
+        recipe = self.create_recipe(self.make_jpeg(orientation=6))
+        assert images.process_picture(recipe.pk)
+        recipe.refresh_from_db()
+        # Orientation 6 is a quarter turn, so the upright picture is portrait.
+        assert (recipe.picture_width, recipe.picture_height) == (1000, 2000)
+        variants = recipe.picture_renditions['variants']
+        assert [(v['type'], v['width'], v['height']) for v in variants] == [
+            ('image/webp', 320, 640), ('image/jpeg', 320, 640),
+            ('image/webp', 640, 1280), ('image/jpeg', 640, 1280),
+            ('image/webp', 1000, 2000), ('image/jpeg', 1000, 2000),
+        ]
+        with Image.open(self.media / variants[1]['name']) as rendition:
+            assert rendition.size == (320, 640)
+            assert not rendition.getexif()
+
+        data = RecipeSerializer(recipe).data
+        assert data['picture_srcset']['image/webp'].startswith(f"/media/{variants[0]['name']} 320w, ")
+
+    def test_replaced_picture(self):
+        recipe = self.create_recipe(self.make_jpeg())
+        images.process_picture(recipe.pk)
+        recipe.refresh_from_db()
+        old = [variant['name'] for variant in recipe.picture_renditions['variants']]
+
+        recipe.picture = self.make_jpeg(size=(400, 300))
+        recipe.save()
+        assert RecipeSerializer(recipe).data['picture_srcset'] is None
+        images.process_picture(recipe.pk)
+        recipe.refresh_from_db()
+        assert [v['width'] for v in recipe.picture_renditions['variants']] == [320, 320, 400, 400]
+        assert not any((self.media / name).exists() for name in old)
+
+    def test_unreadable_picture(self):
+        recipe = self.create_recipe(ContentFile(b'not an image', name='cake.jpg'))
+        assert not images.process_picture(recipe.pk)
+        recipe.refresh_from_db()
+        assert recipe.picture_width is None
+
+    def test_upload_queues_processing(self, monkeypatch, django_capture_on_commit_callbacks):
+        queued = []
+        monkeypatch.setattr(tasks.process_recipe_picture, 'delay', queued.append)
+        with django_capture_on_commit_callbacks(execute=True):
+            recipe = self.create_recipe(self.make_jpeg())
+        with django_capture_on_commit_callbacks(execute=True):
+            recipe.title = 'Renamed'
+            recipe.save()
+        assert queued == [recipe.pk]
+
+    def test_process_command(self):
+        recipe = self.create_recipe(self.make_jpeg(size=(300, 300)))
+        out = StringIO()
+        call_command('process_recipe_pictures', '--sync', '--missing-only', stdout=out)
+        assert 'Processed 1 of 1' in out.getvalue()
+        recipe.refresh_from_db()
+        assert recipe.picture_width == 300
+
+
+@pytest.mark.django_db
+class TestLikeDigests:
+    def setup_method(self):
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.day = timezone.localdate() - timedelta(days=1)
+        self.start, self.end = digests.get_day_range()
+
+    def create_author(self, i):
+        return User.objects.create_user(email=f'author{i}@example.com', username=f'author{i}', password='testpass')
+
+    def like(self, recipe, fans, when):
+        likes = RecipeLike.objects.bulk_create(RecipeLike(user=fan, recipe=recipe) for fan in fans)
+        RecipeLike.objects.filter(pk__in=[like.pk for like in likes]).update(created=when)
+
+    def create_recipe(self, author, title):
+        return Recipe.objects.create(title=title, desc='x', cook_time='00:30:00', ingredients='flour',
+                                     procedure='bake', category=self.category, author=author)
+
+    def test_digests(self, django_assert_num_queries):
+        author, other = self.create_author(1), self.create_author(2)
+        fans = [self.create_author(i) for i in range(10, 13)]
+        cake, pie = self.create_recipe(author, 'Cake'), self.create_recipe(author, 'Pie')
+        soup = self.create_recipe(other, 'Soup')
+        yesterday = self.start + timedelta(hours=12)
+        self.like(cake, fans[:1], yesterday)
+        self.like(pie, fans, yesterday)
+        self.like(cake, fans[1:], timezone.now())
+        self.like(soup, fans, self.start - timedelta(seconds=1))
+
+        assert (self.start.date(), self.end - self.start) == (self.day, timedelta(days=1))
+        with django_assert_num_queries(1):
+            like_digests = digests.get_like_digests(self.start, self.end)
+        assert like_digests == [{
+            'author': author.pk, 'email': 'author1@example.com', 'username': 'author1',
+            'day': self.day.isoformat(), 'likes': 4,
+            'recipes': [{'id': pie.pk, 'title': 'Pie', 'likes': 3}, {'id': cake.pk, 'title': 'Cake', 'likes': 1}],
+        }]
+        message = digests.build_message(like_digests[0])
+        assert message.to == ['author1@example.com']
+        assert '4 new likes' in message.body and '- Pie: 3 likes' in message.body
+
+    def test_batches_are_queued_as_a_group(self, monkeypatch, settings):
+        settings.RECIPE_DIGEST_BATCH_SIZE = 2
+        fan = self.create_author(0)
+        for i in range(1, 6):
+            self.like(self.create_recipe(self.create_author(i), f'Recipe {i}'), [fan], self.start)
+        queued = []
+
+        def group(signatures):
+            queued.extend(signatures)
+            return SimpleNamespace(apply_async=lambda: None)
+
+        monkeypatch.setattr(tasks, 'group', group)
+        assert tasks.send_daily_notifications() == 'Queued 5 like digests in 3 batches!'
+        assert [len(signature.args[0]) for signature in queued] == [2, 2, 1]
+
+    def test_throughput(self, smtp_sink):
+        like_digests = [
+            {'author': i, 'email': f'author{i}@example.com', 'username': f'author{i}',
+             'day': self.day.isoformat(), 'likes': 2, 'recipes': [{'id': i, 'title': 'Cake', 'likes': 2}]}
+            for i in range(500)
+        ]
+        started = time.perf_counter()
+        for i in range(0, len(like_digests), 100):
+            assert tasks.send_like_digests(like_digests[i:i + 100]) == 'Sent 100 of 100 like digests!'
+        elapsed = time.perf_counter() - started
+        assert len(smtp_sink.messages) == 500
+        # One connection per batch rather than per message.
+        assert smtp_sink.connections == 5
+        print(f'{len(like_digests) / elapsed:.0f} digests/s over {smtp_sink.connections} connections')
+
+
+@pytest.mark.django_db
+class TestEmailOutbox:
+    @pytest.fixture(autouse=True)
+    def outbox_settings(self, settings):
+        settings.EMAIL_BACKEND = 'recipe.outbox.EmailBackend'
+        settings.RECIPE_EMAIL_DELIVERY_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+        settings.DEFAULT_FROM_EMAIL = 'noreply@example.com'
+        outbox.close_connection()
+        yield
+        outbox.close_connection()
+
+    def test_queued_and_deduplicated(self):
+        assert send_mail('Hello', 'Body', None, ['cook@example.com']) == 1
+        # Identical to a pending message, so not queued or counted as sent.
+        assert send_mail('Hello', 'Body', None, ['cook@example.com']) == 0
+        message = EmailMultiAlternatives('Hello', 'Body', to=['cook@example.com'])
+        message.attach_alternative('<p>Body</p>', 'text/html')
+        message.send()
+        assert mail.outbox == []
+        assert OutboxEmail.objects.count() == 2
+
+        assert outbox.dispatch() == (2, 0, 0)
+        assert [m.to for m in mail.outbox] == [['cook@example.com'], ['cook@example.com']]
+        assert mail.outbox[1].alternatives == [('<p>Body</p>', 'text/html')]
+        assert mail.outbox[0].from_email == 'noreply@example.com'
+        assert set(OutboxEmail.objects.values_list('status', flat=True)) == {OutboxEmail.SENT}
+        assert outbox.dispatch() == (0, 0, 0)
+
+    def test_resent_once_not_pending(self, monkeypatch):
+        send_mail('Hello', 'Body', None, ['cook@example.com'])
+        outbox.dispatch()
+        assert send_mail('Hello', 'Body', None, ['cook@example.com']) == 1
+        assert mail.get_connection().send_messages([
+            EmailMultiAlternatives('Hello', 'Body', to=['cook@example.com']),
+            EmailMultiAlternatives('Hello', 'Body', to=['cook@example.com', 'cook@other.org']),
+        ]) == 1
+
+        def deliver(message):
+            raise smtplib.SMTPResponseException(550, 'No such user')
+
+        monkeypatch.setattr(outbox, 'deliver', deliver)
+        assert outbox.dispatch() == (0, 0, 2)
+        assert send_mail('Hello', 'Body', None, ['cook@example.com']) == 1
+        assert sorted(OutboxEmail.objects.values_list('status', flat=True)) == [
+            OutboxEmail.FAILED, OutboxEmail.FAILED, OutboxEmail.PENDING, OutboxEmail.SENT]
+
+    def test_broken_message(self):
+        with pytest.raises(BadHeaderError):
+            send_mail('bad\nsubject', 'Body', None, ['cook@example.com'])
+        assert not OutboxEmail.objects.exists()
+
+        # Queued some other way: given up on without holding up the batch.
+        send_mail('ok1', 'Body', None, ['cook@example.com'])
+        OutboxEmail.objects.create(domain='example.com', to=['cook@example.com'], subject='bad\nsubject',
+                                   dedupe_key='bad')
+        send_mail('ok2', 'Body', None, ['cook@example.com'])
+        assert outbox.dispatch() == (2, 0, 1)
+        assert [m.subject for m in mail.outbox] == ['ok1', 'ok2']
+        rows = dict(OutboxEmail.objects.values_list('subject', 'status'))
+        assert rows == {'ok1': OutboxEmail.SENT, 'bad\nsubject': OutboxEmail.FAILED, 'ok2': OutboxEmail.SENT}
+
+    def test_sent_marked_when_batch_fails(self, monkeypatch):
+        send_mail('ok1', 'Body', None, ['cook@example.com'])
+        send_mail('ok2', 'Body', None, ['cook@example.com'])
+
+        def record_failure(row, error, now, permanent):
+            raise DatabaseError('Connection lost')
+
+        monkeypatch.setattr(outbox, 'record_failure', record_failure)
+        OutboxEmail.objects.filter(subject='ok2').update(subject='bad\nsubject')
+        with pytest.raises(DatabaseError):
+            outbox.dispatch()
+        # The delivered message isn't sent again once the lease runs out.
+        assert OutboxEmail.objects.get(subject='ok1').status == OutboxEmail.SENT
+
+    def test_split_by_domain(self):
+        send_mail('Hello', 'Body', None, ['a@example.com', 'b@Other.org', 'c@example.com'])
+        rows = OutboxEmail.objects.order_by('domain')
+        assert [(row.domain, row.to) for row in rows] == [
+            ('example.com', ['a@example.com', 'c@example.com']), ('other.org', ['b@Other.org'])]
+
+    def test_domain_rate(self, settings):
+        settings.RECIPE_OUTBOX_DOMAIN_RATE = 2
+        for i in range(3):
+            send_mail(f'Hello {i}', 'Body', None, [f'cook{i}@example.com'])
+        send_mail('Hello', 'Body', None, ['cook@other.org'])
+        assert outbox.dispatch() == (3, 1, 0)
+        deferred = OutboxEmail.objects.get(status=OutboxEmail.PENDING)
+        assert deferred.domain == 'example.com' and deferred.attempts == 0
+        assert deferred.next_attempt_at > timezone.now()
+
+    def test_retries_with_backoff(self, monkeypatch):
+        errors = [smtplib.SMTPResponseException(451, 'Try later')]
+
+        def deliver(message):
+            raise errors[0]
+
+        monkeypatch.setattr(outbox, 'deliver', deliver)
+        send_mail('Hello', 'Body', None, ['cook@example.com'])
+        row = OutboxEmail.objects.get()
+        for attempt, delay in ((1, 60), (2, 120)):
+            before = timezone.now()
+            assert outbox.dispatch() == (0, 0, 1)
+            row.refresh_from_db()
+            assert (row.status, row.attempts, row.last_error) == (OutboxEmail.PENDING, attempt, str(errors[0]))
+            assert before + timedelta(seconds=delay) <= row.next_attempt_at <= timezone.now() + timedelta(
+                seconds=delay)
+            OutboxEmail.objects.update(next_attempt_at=timezone.now())
+
+        errors[0] = smtplib.SMTPResponseException(550, 'No such user')
+        outbox.dispatch()
+        row.refresh_from_db()
+        assert (row.status, row.attempts) == (OutboxEmail.FAILED, 3)
+
+    def test_connection_error_keeps_lease(self, monkeypatch):
+        def deliver(message):
+            raise smtplib.SMTPServerDisconnected('Connection unexpectedly closed')
+
+        monkeypatch.setattr(outbox, 'deliver', deliver)
+        send_mail('First', 'Body', None, ['cook@example.com'])
+        send_mail('Second', 'Body', None, ['cook@example.com'])
+        assert outbox.dispatch() == (0, 0, 1)
+        first, second = OutboxEmail.objects.order_by('subject')
+        assert (first.attempts, second.attempts) == (1, 0)
+        assert second.next_attempt_at > timezone.now() + timedelta(seconds=outbox.LEASE_SECONDS - 10)
+
+    def test_purge(self):
+        send_mail('Hello', 'Body', None, ['cook@example.com'])
+        outbox.dispatch()
+        assert outbox.purge() == 0
+        assert outbox.purge(now=timezone.now() + timedelta(days=8)) == 1
+        send_mail('Hello', 'Body', None, ['cook@example.com'])
+        assert OutboxEmail.objects.filter(status=OutboxEmail.PENDING).count() == 1
+
+    def test_throughput(self, smtp_sink, settings):
+        settings.EMAIL_BACKEND = 'recipe.outbox.EmailBackend'
+        settings.RECIPE_EMAIL_DELIVERY_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+        settings.RECIPE_OUTBOX_DOMAIN_RATE = 1000
+        mail.get_connection().send_messages([
+            EmailMultiAlternatives(f'Hello {i}', 'Body', to=[f'cook{i}@example{i % 5}.com']) for i in range(500)])
+        started = time.perf_counter()
+        assert outbox.dispatch(batch_size=100) == (500, 0, 0)
+        elapsed = time.perf_counter() - started
+        assert len(smtp_sink.messages) == 500
+        # One pooled connection for every batch.
+        assert smtp_sink.connections == 1
+        print(f'{500 / elapsed:.0f} emails/s over {smtp_sink.connections} connection')
@@ -1,9 +1,31 @@
+import csv
+import io
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from uuid import uuid4
+
 import pytest
+from django.core.files.base import ContentFile
+from django.http import Http404
+from django.test import RequestFactory
 from django.urls import reverse
-from rest_framework.test import APIClient
+from django.utils import timezone
+from PIL import Image
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
 from rest_framework import status
-from recipe.models import Recipe, RecipeCategory
+from recipe.models import Ingredient, Recipe, RecipeCategory, RecipeIngredient, RecipeLike, RecipeNeighbor
+from recipe import like_buffer, tasks, uploads
+from recipe.serializers import RecipeSerializer
+from recipe.views import RecipeAutocompleteAPIView, RecipePantryAPIView
+from recipe.tasks import update_trending_scores
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from config import media
+from users.models import Profile
+from users.storage import ContentAddressedStorage
 
 User = get_user_model()
 
@@ -28,8 +50,8 @@ class TestRecipeViews:
         url = reverse('recipe:recipe-list')
         response = self.client.get(url)
         assert response.status_code == status.HTTP_200_OK
-        assert len(response.data) == 1
-        assert response.data[0]['title'] == 'Test Recipe'
+        assert len(response.data['results']) == 1
+        assert response.data['results'][0]['title'] == 'Test Recipe'
 
     def test_create_recipe(self):
         url = reverse('recipe:recipe-create')
@@ -57,3 +79,1060 @@ class TestRecipeViews:
         response = self.client.delete(url)
         assert response.status_code == status.HTTP_204_NO_CONTENT
         assert Recipe.objects.count() == 0
+
+
+@pytest.mark.django_db
+class TestRecipePagination:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='pager@example.com', username='pager', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        for i in range(5):
+            Recipe.objects.create(
+                title=f'Recipe {i}',
+                desc='Delicious recipe',
+                cook_time='00:30:00',
+                ingredients='sugar, flour',
+                procedure='mix ingredients',
+                category=self.category,
+                author=self.user
+            )
+
+    def test_get_recipes_cursor_pagination(self):
+        url = reverse('recipe:recipe-list')
+        response = self.client.get(url, {'page_size': 2})
+        first_page = [recipe['id'] for recipe in response.data['results']]
+        assert response.data['previous'] is None
+
+        response = self.client.get(response.data['next'])
+        second_page = [recipe['id'] for recipe in response.data['results']]
+        assert len(second_page) == 2
+        assert set(first_page).isdisjoint(second_page)
+
+        response = self.client.get(response.data['previous'])
+        assert [recipe['id'] for recipe in response.data['results']] == first_page
+
+    def test_get_recipes_invalid_cursor(self):
+        url = reverse('recipe:recipe-list')
+        response = self.client.get(url, {'cursor': 'not-a-cursor'})
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestRecipeSparseFields:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='sparse@example.com', username='sparse', password='testpass')
+        self.client.force_authenticate(user=self.user)
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipe = Recipe.objects.create(
+            title='Test Recipe',
+            desc='Delicious recipe',
+            cook_time='00:30:00',
+            ingredients='sugar, flour',
+            procedure='mix ingredients',
+            category=self.category,
+            author=self.user
+        )
+
+    def test_list_defaults_to_summary(self):
+        response = self.client.get(reverse('recipe:recipe-list'))
+        recipe = response.data['results'][0]
+        assert set(recipe) == set(RecipeSerializer.Meta.summary_fields)
+
+    def test_list_fields_and_omit(self):
+        url = reverse('recipe:recipe-list')
+        response = self.client.get(url, {'fields': 'id,title,ingredients'})
+        assert response.data['results'][0] == {
+            'id': self.recipe.id, 'title': 'Test Recipe', 'ingredients': 'sugar, flour'}
+
+        response = self.client.get(url, {'omit': 'picture,username'})
+        assert 'picture' not in response.data['results'][0]
+        assert 'username' not in response.data['results'][0]
+
+    def test_detail_fields(self):
+        url = reverse('recipe:recipe-detail', kwargs={'pk': self.recipe.id})
+        response = self.client.get(url, {'fields': 'title,category'})
+        assert response.data == {
+            'title': 'Test Recipe', 'category': {'id': self.category.id, 'name': 'Dessert'}}
+
+    def test_update_returns_full_representation(self):
+        url = reverse('recipe:recipe-detail', kwargs={'pk': self.recipe.id})
+        response = self.client.patch(url, {'title': 'Renamed'}, format='json')
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['procedure'] == 'mix ingredients'
+
+
+@pytest.mark.django_db
+class TestRecipeResponseCache:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='cached@example.com', username='cached', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipe = Recipe.objects.create(
+            title='Test Recipe',
+            desc='Delicious recipe',
+            cook_time='00:30:00',
+            ingredients='sugar, flour',
+            procedure='mix ingredients',
+            category=self.category,
+            author=self.user
+        )
+
+    def test_list_is_cached_until_a_like(self, django_capture_on_commit_callbacks):
+        url = reverse('recipe:recipe-list')
+        assert self.client.get(url)['X-Cache'] == 'MISS'
+        assert self.client.get(url)['X-Cache'] == 'HIT'
+
+        with django_capture_on_commit_callbacks(execute=True):
+            RecipeLike.objects.create(user=self.user, recipe=self.recipe)
+        response = self.client.get(url)
+        assert response['X-Cache'] == 'MISS'
+        assert response.data['results'][0]['total_number_of_likes'] == 1
+
+    def test_new_recipe_expires_lists(self, django_capture_on_commit_callbacks):
+        url = reverse('recipe:recipe-list')
+        self.client.get(url)
+        with django_capture_on_commit_callbacks(execute=True):
+            Recipe.objects.create(
+                title='Newer Recipe',
+                desc='Delicious recipe',
+                cook_time='00:30:00',
+                ingredients='sugar, flour',
+                procedure='mix ingredients',
+                category=self.category,
+                author=self.user
+            )
+        response = self.client.get(url)
+        assert response['X-Cache'] == 'MISS'
+        assert len(response.data['results']) == 2
+
+    def test_authenticated_responses_are_per_user(self):
+        url = reverse('recipe:recipe-detail', kwargs={'pk': self.recipe.id})
+        other = User.objects.create_user(email='other@example.com', username='other', password='testpass')
+        self.client.force_authenticate(user=self.user)
+        self.client.get(url)
+        self.client.force_authenticate(user=other)
+        assert self.client.get(url)['X-Cache'] == 'MISS'
+
+
+@pytest.mark.django_db
+class TestRecipeConditionalGet:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='etag@example.com', username='etag', password='testpass')
+        self.client.force_authenticate(user=self.user)
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipe = Recipe.objects.create(
+            title='Test Recipe',
+            desc='Delicious recipe',
+            cook_time='00:30:00',
+            ingredients='sugar, flour',
+            procedure='mix ingredients',
+            category=self.category,
+            author=self.user
+        )
+
+    def test_detail_etag_and_last_modified(self):
+        url = reverse('recipe:recipe-detail', kwargs={'pk': self.recipe.id})
+        response = self.client.get(url)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+        RecipeLike.objects.create(user=self.user, recipe=self.recipe)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_200_OK
+        assert response['ETag'] != etag
+
+    def test_list_etag_follows_page_rows(self):
+        url = reverse('recipe:recipe-list')
+        etag = self.client.get(url)['ETag']
+        assert self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_304_NOT_MODIFIED
+        assert self.client.get(url, {'fields': 'id'}, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_200_OK
+
+        self.recipe.delete()
+        assert self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_200_OK
+
+
+@pytest.mark.django_db
+class TestRecipeSearch:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='search@example.com', username='search', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.cake = self.create_recipe('Chocolate cake', 'Rich and moist', 'flour, sugar, cocoa')
+        self.brownie = self.create_recipe('Brownies', 'Fudgy chocolate squares', 'butter, cocoa')
+        self.salad = self.create_recipe('Green salad', 'Fresh', 'lettuce, chocolate shavings')
+        self.create_recipe('Pancakes', 'Fluffy', 'flour, milk, eggs')
+
+    def create_recipe(self, title, desc, ingredients):
+        return Recipe.objects.create(
+            title=title,
+            desc=desc,
+            cook_time='00:30:00',
+            ingredients=ingredients,
+            procedure='mix ingredients',
+            category=self.category,
+            author=self.user
+        )
+
+    def test_search_ranks_title_over_description_over_ingredients(self):
+        response = self.client.get(reverse('recipe:recipe-search'), {'q': 'chocolate'})
+        assert response.status_code == status.HTTP_200_OK
+        ids = [recipe['id'] for recipe in response.data['results']]
+        assert ids == [self.cake.id, self.brownie.id, self.salad.id]
+
+    def test_search_prefix_and_pagination(self):
+        url = reverse('recipe:recipe-search')
+        response = self.client.get(url, {'q': 'choc', 'page_size': 2})
+        first_page = [recipe['id'] for recipe in response.data['results']]
+        response = self.client.get(response.data['next'])
+        assert first_page + [recipe['id'] for recipe in response.data['results']] == [
+            self.cake.id, self.brownie.id, self.salad.id]
+
+    def test_search_requires_terms(self):
+        response = self.client.get(reverse('recipe:recipe-search'), {'q': '  &! '})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestRecipePantry:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='pantry@example.com', username='pantry', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Breakfast')
+        self.omelette = self.create_recipe('Omelette', '3 Eggs, 1 tbsp butter, salt')
+        self.pancakes = self.create_recipe('Pancakes', '2 cups flour, 2 eggs, 1 cup milk, sugar')
+        self.toast = self.create_recipe('Toast', 'bread, butter')
+
+    def create_recipe(self, title, ingredients):
+        return Recipe.objects.create(
+            title=title,
+            desc='Quick',
+            cook_time='00:10:00',
+            ingredients=ingredients,
+            procedure='cook',
+            category=self.category,
+            author=self.user
+        )
+
+    def test_pantry_ranks_by_coverage(self):
+        url = reverse('recipe:recipe-pantry')
+        response = self.client.get(url, {'ingredients': 'egg,Butter,salt,milk'})
+        assert response.status_code == status.HTTP_200_OK
+        results = response.data['results']
+        # Pancakes and toast are both half covered; more matches rank first.
+        assert [recipe['id'] for recipe in results] == [self.omelette.id, self.pancakes.id, self.toast.id]
+        assert results[0]['coverage'] == 1.0
+        assert results[1]['matched_ingredients'] == 2
+
+    def test_pantry_pagination(self):
+        url = reverse('recipe:recipe-pantry')
+        response = self.client.get(url, {'ingredients': 'egg,butter,salt,milk', 'page_size': 2})
+        first_page = [recipe['id'] for recipe in response.data['results']]
+        response = self.client.get(response.data['next'])
+        assert first_page + [recipe['id'] for recipe in response.data['results']] == [
+            self.omelette.id, self.pancakes.id, self.toast.id]
+
+    def test_pantry_follows_ingredient_edits(self):
+        self.toast.ingredients = 'bread, jam'
+        self.toast.save()
+        response = self.client.get(reverse('recipe:recipe-pantry'), {'ingredients': 'butter'})
+        assert [recipe['id'] for recipe in response.data['results']] == [self.omelette.id]
+
+    def test_pantry_requires_ingredients(self):
+        response = self.client.get(reverse('recipe:recipe-pantry'))
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_pantry_candidates_are_bounded(self, monkeypatch):
+        saffron = self.create_recipe('Paella', 'rice, saffron, salt')
+        salted = [self.create_recipe(f'Salted {i}', 'salt, water') for i in range(3)]
+        monkeypatch.setattr(RecipePantryAPIView, 'max_candidates', 3)
+        response = self.client.get(reverse('recipe:recipe-pantry'), {'ingredients': 'salt,saffron'})
+        # Saffron is read first, the newest salty recipes fill the rest.
+        assert [recipe['id'] for recipe in response.data['results']] == [saffron.id, salted[2].id, salted[1].id]
+
+    def test_pantry_plan_reads_ingredient_index(self):
+        request = APIRequestFactory().get(reverse('recipe:recipe-pantry'), {'ingredients': 'egg,butter,salt'})
+        view = RecipePantryAPIView(request=Request(request), format_kwarg=None)
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = view.get_queryset().explain()
+        # One bounded read per ingredient, the others look up a candidate.
+        assert plan.count('Limit') == 3
+        assert plan.count('Index Only Scan Backward using ingredient_recipe_idx') == 3
+        assert plan.count('on recipe_recipeingredient') - 3 == plan.count('recipe_id = recipe_recipe.id')
+
+
+@pytest.mark.django_db
+class TestRecipeAutocomplete:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='typeahead@example.com', username='typeahead', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Chocolate Desserts')
+        self.cake = self.create_recipe('Chocolate Cake')
+        self.soup = self.create_recipe('Tomato Soup')
+
+    def create_recipe(self, title):
+        return Recipe.objects.create(
+            title=title,
+            desc='Tasty',
+            cook_time='00:30:00',
+            ingredients='water',
+            procedure='cook',
+            category=self.category,
+            author=self.user
+        )
+
+    def test_autocomplete_prefix(self):
+        response = self.client.get(reverse('recipe:recipe-autocomplete'), {'q': 'Cho'})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['recipes'] == [
+            {'id': self.cake.id, 'title': 'Chocolate Cake', 'category': 'Chocolate Desserts'}]
+        assert response.data['categories'] == [{'id': self.category.id, 'name': 'Chocolate Desserts'}]
+
+    def test_autocomplete_tolerates_typos(self):
+        response = self.client.get(reverse('recipe:recipe-autocomplete'), {'q': 'tomatto soup'})
+        assert [recipe['id'] for recipe in response.data['recipes']] == [self.soup.id]
+
+    def test_autocomplete_prefix_special_characters(self):
+        dotted = self.create_recipe('S.O.S. Sauce')
+        response = self.client.get(reverse('recipe:recipe-autocomplete'), {'q': 's.o'})
+        assert [recipe['id'] for recipe in response.data['recipes']] == [dotted.id]
+        response = self.client.get(reverse('recipe:recipe-autocomplete'), {'q': 'c.*'})
+        assert response.data['recipes'] == []
+
+    @pytest.mark.parametrize('term', ['ch', 'cho', 'chocolate cak'])
+    def test_autocomplete_plans_read_trigram_indexes(self, term):
+        view = RecipeAutocompleteAPIView()
+        with connection.cursor() as cursor:
+            # Leave bitmap scans as the only cheap access path, so the plan
+            # shows whether each condition can be served by an index.
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            cursor.execute('SET LOCAL enable_indexscan = off')
+        for queryset, index in [(view.get_recipes, 'recipe_title_trgm_idx'),
+                                (view.get_categories, 'category_name_trgm_idx')]:
+            with CaptureQueriesContext(connection) as queries:
+                queryset(term)
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN ' + queries[0]['sql'])
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            # Both branches of the OR are served by the trigram index.
+            assert plan.count(f'Bitmap Index Scan on {index}') == 2, plan
+            assert 'Seq Scan' not in plan, plan
+
+    def test_autocomplete_short_query(self):
+        response = self.client.get(reverse('recipe:recipe-autocomplete'), {'q': 'c'})
+        assert response.data == {'recipes': [], 'categories': []}
+
+    def test_autocomplete_cache_follows_edits(self, django_capture_on_commit_callbacks):
+        url = reverse('recipe:recipe-autocomplete')
+        self.client.get(url, {'q': 'choc'})
+        with django_capture_on_commit_callbacks(execute=True):
+            self.cake.title = 'Chocolate Fudge Cake'
+            self.cake.save()
+        response = self.client.get(url, {'q': 'choc'})
+        assert response.data['recipes'][0]['title'] == 'Chocolate Fudge Cake'
+
+
+@pytest.mark.django_db
+class TestRecipeTrendingFeed:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='trend@example.com', username='trend', password='testpass')
+        self.fan = User.objects.create_user(email='fan@example.com', username='fan', password='testpass')
+        self.dessert = RecipeCategory.objects.create(name='Dessert')
+        self.soups = RecipeCategory.objects.create(name='Soups')
+        self.cake = self.create_recipe('Cake', self.dessert)
+        self.pie = self.create_recipe('Pie', self.dessert)
+        self.soup = self.create_recipe('Soup', self.soups)
+        self.create_recipe('Unliked', self.dessert)
+        for user in (self.user, self.fan):
+            RecipeLike.objects.create(user=user, recipe=self.pie)
+        RecipeLike.objects.create(user=self.user, recipe=self.cake)
+        RecipeLike.objects.create(user=self.user, recipe=self.soup)
+        # Older than the commit lag, so the rebuild counts them.
+        RecipeLike.objects.update(created=timezone.now() - timedelta(minutes=5))
+        update_trending_scores(full=True)
+
+    def create_recipe(self, title, category):
+        return Recipe.objects.create(
+            title=title,
+            desc='Popular',
+            cook_time='00:20:00',
+            ingredients='water',
+            procedure='cook',
+            category=category,
+            author=self.user
+        )
+
+    def test_trending_feed(self):
+        response = self.client.get(reverse('recipe:recipe-trending'))
+        assert response.status_code == status.HTTP_200_OK
+        assert [recipe['id'] for recipe in response.data['results']] == [
+            self.pie.id, self.soup.id, self.cake.id]
+
+    def test_trending_per_category(self):
+        response = self.client.get(reverse('recipe:recipe-trending'), {'category': self.dessert.id})
+        assert [recipe['id'] for recipe in response.data['results']] == [self.pie.id, self.cake.id]
+
+
+@pytest.mark.django_db
+class TestRecipeSimilar:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='similar@example.com', username='similar', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Dinner')
+        self.a, self.b, self.c = [
+            Recipe.objects.create(
+                title=title,
+                desc='Hearty',
+                cook_time='00:45:00',
+                ingredients='beans',
+                procedure='simmer',
+                category=self.category,
+                author=self.user
+            ) for title in ('Chili', 'Cornbread', 'Nachos')]
+        RecipeNeighbor.objects.create(recipe=self.a, neighbor=self.b, score=0.5)
+        RecipeNeighbor.objects.create(recipe=self.a, neighbor=self.c, score=0.9)
+
+    def test_similar_recipes(self):
+        response = self.client.get(reverse('recipe:recipe-similar', kwargs={'pk': self.a.id}))
+        assert response.status_code == status.HTTP_200_OK
+        assert [recipe['id'] for recipe in response.data] == [self.c.id, self.b.id]
+        assert set(response.data[0]) == (set(RecipeSerializer.Meta.summary_fields)
+                                         - set(RecipeSerializer.Meta.viewer_fields))
+
+    def test_no_similar_recipes(self):
+        response = self.client.get(reverse('recipe:recipe-similar', kwargs={'pk': self.b.id}))
+        assert response.data == []
+
+
+@pytest.mark.django_db
+class TestRecipeBatch:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='partner@example.com', username='partner', password='testpass')
+        self.other = User.objects.create_user(email='other@example.com', username='other', password='testpass')
+        self.client.force_authenticate(user=self.user)
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipe = Recipe.objects.create(
+            title='Old Title',
+            desc='Sweet',
+            cook_time='00:30:00',
+            ingredients='sugar',
+            procedure='bake',
+            category=self.category,
+            author=self.user
+        )
+        self.url = reverse('recipe:recipe-batch')
+
+    def item(self, title, category='Dessert'):
+        return {
+            'title': title,
+            'desc': 'Batch recipe',
+            'cook_time': '00:15:00',
+            'ingredients': 'flour, 2 eggs',
+            'procedure': 'mix',
+            'category': {'name': category},
+        }
+
+    def test_batch_create(self, django_assert_max_num_queries):
+        items = [self.item(f'Recipe {i}', category=f'Category {i % 3}') for i in range(20)]
+        items.append({'title': 'Missing fields'})
+        # Including the ingredient recipe counts, still fixed per chunk.
+        with django_assert_max_num_queries(19):
+            response = self.client.post(self.url, items, format='json')
+        assert response.status_code == status.HTTP_200_OK
+        results = response.data['results']
+        assert [result['status'] for result in results] == ['created'] * 20 + ['error']
+        assert 'desc' in results[-1]['errors']
+        assert Recipe.objects.filter(author=self.user).count() == 21
+        assert RecipeCategory.objects.filter(name__startswith='Category').count() == 3
+        assert RecipeIngredient.objects.filter(recipe_id=results[0]['id']).count() == 2
+        assert Ingredient.objects.get(name='egg').recipe_count == 20
+        assert dict(RecipeCategory.objects.filter(name__startswith='Category')
+                    .values_list('name', 'recipes_count')) == {'Category 0': 7, 'Category 1': 7, 'Category 2': 6}
+
+    def test_batch_update_ndjson(self):
+        foreign = Recipe.objects.create(title='Foreign', desc='x', cook_time='00:10:00', ingredients='salt',
+                                        procedure='x', category=self.category, author=self.other)
+        body = '\n'.join(json.dumps(item) for item in [
+            {'id': self.recipe.id, 'title': 'New Title', 'ingredients': 'honey'},
+            {'id': foreign.id, 'title': 'Hijacked'},
+            self.item('Fresh'),
+        ])
+        response = self.client.post(self.url, body, content_type='application/x-ndjson')
+        assert [result['status'] for result in response.data['results']] == ['updated', 'error', 'created']
+        self.recipe.refresh_from_db()
+        foreign.refresh_from_db()
+        assert self.recipe.title == 'New Title'
+        assert self.recipe.ingredient_links.get().ingredient.name == 'honey'
+        assert foreign.title == 'Foreign'
+
+    def test_batch_max_size(self, settings):
+        settings.RECIPE_BATCH_MAX_SIZE = 2
+        response = self.client.post(self.url, [self.item('a'), self.item('b'), self.item('c')], format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert not Recipe.objects.filter(title__in=['a', 'b', 'c']).exists()
+
+    def test_batch_requires_authentication(self):
+        self.client.force_authenticate(user=None)
+        response = self.client.post(self.url, [self.item('a')], format='json')
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+@pytest.mark.django_db
+class TestRecipeExport:
+    def setup_method(self):
+        self.client = APIClient()
+        self.admin = User.objects.create_user(email='analyst@example.com', username='analyst', password='testpass',
+                                              is_staff=True)
+        self.client.force_authenticate(user=self.admin)
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipes = [Recipe.objects.create(
+            title=f'Exported {i}',
+            desc='Sweet',
+            cook_time='00:30:00',
+            ingredients='sugar,\nflour',
+            procedure='bake',
+            category=self.category,
+            author=self.admin
+        ) for i in range(3)]
+        # Older than the commit lag, so exports include them.
+        Recipe.objects.update(updated_at=timezone.now() - timedelta(minutes=5))
+        self.url = reverse('recipe:recipe-export')
+
+    def read(self, response):
+        return b''.join(response.streaming_content).decode('utf-8')
+
+    def test_export_ndjson(self):
+        response = self.client.get(self.url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response['Content-Type'].startswith('application/x-ndjson')
+        rows = [json.loads(line) for line in self.read(response).splitlines()]
+        assert [row['id'] for row in rows] == [recipe.id for recipe in self.recipes]
+        assert rows[0]['category_name'] == 'Dessert'
+        assert rows[0]['author_username'] == 'analyst'
+        assert rows[0]['total_number_of_likes'] == 0
+
+    def test_export_csv(self):
+        response = self.client.get(self.url, {'format': 'csv'})
+        assert response['Content-Type'].startswith('text/csv')
+        rows = list(csv.DictReader(io.StringIO(self.read(response))))
+        assert len(rows) == 3
+        assert rows[0]['ingredients'] == 'sugar,\nflour'
+
+    def test_incremental_export(self, settings):
+        settings.RECIPE_COMMIT_LAG = 0
+        until = self.client.get(self.url)['X-Export-Until']
+        self.recipes[1].title = 'Edited'
+        self.recipes[1].save()
+        response = self.client.get(self.url, {'updated_since': until})
+        rows = [json.loads(line) for line in self.read(response).splitlines()]
+        assert [row['title'] for row in rows] == ['Edited']
+
+    def test_recent_writes_are_left_for_next_export(self, settings):
+        settings.RECIPE_COMMIT_LAG = 60
+        # Written just now, possibly by a transaction committing later.
+        self.recipes[1].title = 'Edited'
+        self.recipes[1].save()
+        response = self.client.get(self.url)
+        rows = [json.loads(line) for line in self.read(response).splitlines()]
+        assert [row['id'] for row in rows] == [self.recipes[0].id, self.recipes[2].id]
+
+        settings.RECIPE_COMMIT_LAG = 0
+        response = self.client.get(self.url, {'updated_since': response['X-Export-Until']})
+        rows = [json.loads(line) for line in self.read(response).splitlines()]
+        assert [row['title'] for row in rows] == ['Edited']
+
+    def test_export_invalid_since(self):
+        response = self.client.get(self.url, {'updated_since': 'yesterday'})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_export_requires_staff(self):
+        self.client.force_authenticate(user=User.objects.create_user(
+            email='nosy@example.com', username='nosy', password='testpass'))
+        response = self.client.get(self.url)
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+
+
+@pytest.mark.django_db
+class TestRecipeLikeWrites:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='liker@example.com', username='liker', password='testpass')
+        self.client.force_authenticate(user=self.user)
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipe = Recipe.objects.create(
+            title='Likeable',
+            desc='Sweet',
+            cook_time='00:30:00',
+            ingredients='sugar',
+            procedure='bake',
+            category=self.category,
+            author=self.user
+        )
+        self.url = reverse('recipe:recipe-like', kwargs={'pk': self.recipe.id})
+
+    def test_like_and_unlike(self, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            assert self.client.post(self.url).status_code == status.HTTP_201_CREATED
+        assert self.client.post(self.url).status_code == status.HTTP_400_BAD_REQUEST
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == 1
+        assert RecipeLike.objects.filter(recipe=self.recipe).count() == 1
+
+        with django_assert_num_queries(1):
+            assert self.client.delete(self.url).status_code == status.HTTP_200_OK
+        assert self.client.delete(self.url).status_code == status.HTTP_400_BAD_REQUEST
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == 0
+
+    def test_like_missing_recipe(self):
+        url = reverse('recipe:recipe-like', kwargs={'pk': self.recipe.id + 1000})
+        assert self.client.post(url).status_code == status.HTTP_404_NOT_FOUND
+        assert self.client.delete(url).status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db(transaction=True)
+class TestRecipeLikeConcurrency:
+    def setup_method(self):
+        self.user = User.objects.create_user(email='hammer@example.com', username='hammer', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipe = Recipe.objects.create(
+            title='Hammered',
+            desc='Sweet',
+            cook_time='00:30:00',
+            ingredients='sugar',
+            procedure='bake',
+            category=self.category,
+            author=self.user
+        )
+        self.url = reverse('recipe:recipe-like', kwargs={'pk': self.recipe.id})
+
+    def request(self, method):
+        client = APIClient()
+        client.force_authenticate(user=self.user)
+        try:
+            return getattr(client, method)(self.url).status_code
+        finally:
+            connection.close()
+
+    def test_concurrent_likes(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            codes = list(pool.map(self.request, ['post'] * 32))
+        assert codes.count(status.HTTP_201_CREATED) == 1
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == 1
+        assert RecipeLike.objects.filter(recipe=self.recipe).count() == 1
+
+    def test_concurrent_likes_and_unlikes(self):
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(self.request, ['post', 'delete'] * 16))
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == RecipeLike.objects.filter(recipe=self.recipe).count()
+
+
+@pytest.mark.django_db
+class TestRecipeLikeBuffer:
+    @pytest.fixture(autouse=True)
+    def buffered_likes(self, settings):
+        settings.RECIPE_LIKE_BUFFER = True
+        settings.RECIPE_LIKE_BUFFER_PREFIX = f'test:likes:{uuid4().hex}'
+        yield
+        like_buffer.get_redis().delete(*like_buffer.get_keys().values())
+
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='viral@example.com', username='viral', password='testpass')
+        self.client.force_authenticate(user=self.user)
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipe = Recipe.objects.create(
+            title='Viral',
+            desc='Sweet',
+            cook_time='00:30:00',
+            ingredients='sugar',
+            procedure='bake',
+            category=self.category,
+            author=self.user
+        )
+        self.url = reverse('recipe:recipe-like', kwargs={'pk': self.recipe.id})
+
+    def get_total(self):
+        response = self.client.get(reverse('recipe:recipe-detail', kwargs={'pk': self.recipe.id}))
+        return response.data['total_number_of_likes']
+
+    def test_buffered_like_is_visible_before_flush(self):
+        assert self.client.post(self.url).status_code == status.HTTP_201_CREATED
+        assert self.client.post(self.url).status_code == status.HTTP_400_BAD_REQUEST
+        assert not RecipeLike.objects.exists()
+        assert self.client.get(self.url).data == {'liked': True}
+        assert self.get_total() == 1
+
+        assert like_buffer.flush() == 1
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == 1
+        assert RecipeLike.objects.filter(user=self.user, recipe=self.recipe).exists()
+        assert self.get_total() == 1
+
+    def test_like_then_unlike_collapses(self):
+        self.client.post(self.url)
+        assert self.client.delete(self.url).status_code == status.HTTP_200_OK
+        assert self.get_total() == 0
+        like_buffer.flush()
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == 0
+        assert not RecipeLike.objects.exists()
+
+    def test_buffered_unlike_of_stored_like(self):
+        RecipeLike.like(self.user.pk, self.recipe.pk)
+        assert self.client.delete(self.url).status_code == status.HTTP_200_OK
+        assert self.client.get(self.url).data == {'liked': False}
+        assert self.get_total() == 0
+        like_buffer.flush()
+        assert not RecipeLike.objects.exists()
+        assert self.get_total() == 0
+
+    def test_interrupted_flush_is_replayed(self):
+        self.client.post(self.url)
+        keys = like_buffer.get_keys()
+        client = like_buffer.get_redis()
+        # A flush that committed its chunk but died before clearing Redis.
+        client.eval(like_buffer.BEGIN_FLUSH_SCRIPT, 2, keys['pending'], keys['flushing'])
+        RecipeLike.bulk_like([(self.user.pk, self.recipe.pk)])
+        # Likes buffered meanwhile still see the flushing entry.
+        assert self.client.post(self.url).status_code == status.HTTP_400_BAD_REQUEST
+
+        assert like_buffer.flush() == 1
+        self.recipe.refresh_from_db()
+        assert self.recipe.likes_count == 1
+        assert self.get_total() == 1
+        assert not client.exists(keys['flushing'])
+
+    def test_missing_recipe(self):
+        url = reverse('recipe:recipe-like', kwargs={'pk': self.recipe.id + 1000})
+        assert self.client.post(url).status_code == status.HTTP_404_NOT_FOUND
+
+
+@pytest.mark.django_db
+class TestRecipeViewerFlags:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='viewer@example.com', username='viewer', password='testpass')
+        self.category = RecipeCategory.objects.create(name='Dessert')
+        self.recipes = [Recipe.objects.create(
+            title=f'Flagged {i}',
+            desc='Sweet',
+            cook_time='00:30:00',
+            ingredients='sugar',
+            procedure='bake',
+            category=self.category,
+            author=self.user
+        ) for i in range(5)]
+        RecipeLike.objects.create(user=self.user, recipe=self.recipes[0])
+        self.user.profile.bookmarks.add(self.recipes[1])
+
+    def flags(self, results):
+        return {recipe['id']: (recipe['is_liked'], recipe['is_bookmarked']) for recipe in results}
+
+    def test_list_flags(self, django_assert_max_num_queries):
+        self.client.force_authenticate(user=self.user)
+        with django_assert_max_num_queries(4):
+            response = self.client.get(reverse('recipe:recipe-list'))
+        flags = self.flags(response.data['results'])
+        assert flags[self.recipes[0].id] == (True, False)
+        assert flags[self.recipes[1].id] == (False, True)
+        assert flags[self.recipes[2].id] == (False, False)
+
+    def test_flag_queries_do_not_grow_with_page_size(self, django_assert_num_queries):
+        self.client.force_authenticate(user=self.user)
+        url = reverse('recipe:recipe-list')
+        with django_assert_num_queries(4):
+            self.client.get(url, {'page_size': 1, 'fields': 'id,is_liked,is_bookmarked'})
+        with django_assert_num_queries(4):
+            self.client.get(url, {'page_size': 5, 'fields': 'id,is_liked,is_bookmarked'})
+
+    def test_bookmark_list_flags(self):
+        self.client.force_authenticate(user=self.user)
+        response = self.client.get(reverse('users:user-bookmark', kwargs={'pk': self.user.id}))
+        assert self.flags(response.data['results']) == {self.recipes[1].id: (False, True)}
+
+    def test_anonymous_list_has_no_flags(self, django_assert_max_num_queries):
+        with django_assert_max_num_queries(2):
+            response = self.client.get(reverse('recipe:recipe-list'))
+        assert 'is_liked' not in response.data['results'][0]
+        assert 'is_bookmarked' not in response.data['results'][0]
+
+
+@pytest.mark.django_db
+class TestRecipeFacets:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='facets@example.com', username='facets', password='testpass')
+        self.other = User.objects.create_user(email='other@example.com', username='other', password='testpass')
+        self.dessert = RecipeCategory.objects.create(name='Dessert')
+        self.soups = RecipeCategory.objects.create(name='Soups')
+        RecipeCategory.objects.create(name='Empty')
+        for title, category, author in [('Chocolate cake', self.dessert, self.user),
+                                        ('Lemon tart', self.dessert, self.other),
+                                        ('Apple pie', self.dessert, self.other),
+                                        ('Tomato soup', self.soups, self.user)]:
+            Recipe.objects.create(title=title, desc='x', cook_time='00:30:00', ingredients='salt',
+                                  procedure='x', category=category, author=author)
+        self.url = reverse('recipe:recipe-facets')
+
+    def test_category_counts(self, django_assert_num_queries):
+        with django_assert_num_queries(1):
+            response = self.client.get(self.url)
+        assert response.data == {'categories': [
+            {'id': self.dessert.id, 'name': 'Dessert', 'count': 3},
+            {'id': self.soups.id, 'name': 'Soups', 'count': 1},
+        ]}
+
+    def test_author_filter(self):
+        response = self.client.get(self.url, {'author__username': 'other'})
+        assert response.data['categories'] == [{'id': self.dessert.id, 'name': 'Dessert', 'count': 2}]
+        response = self.client.get(self.url, {'author': self.user.id, 'category__name': 'Soups'})
+        assert response.data['categories'] == [{'id': self.soups.id, 'name': 'Soups', 'count': 1}]
+
+    def test_author_facet(self):
+        response = self.client.get(self.url, {'include': 'authors'})
+        assert response.data['authors'] == [{'id': self.user.id, 'username': 'facets', 'count': 2},
+                                            {'id': self.other.id, 'username': 'other', 'count': 2}]
+        response = self.client.get(self.url, {'include': 'authors', 'category__name': 'Dessert'})
+        assert response.data['authors'] == [{'id': self.other.id, 'username': 'other', 'count': 2},
+                                            {'id': self.user.id, 'username': 'facets', 'count': 1}]
+
+    def test_search_groups_matches(self):
+        response = self.client.get(self.url, {'q': 'cake soup', 'include': 'authors'})
+        assert response.data == {'categories': [], 'authors': []}
+        response = self.client.get(self.url, {'q': 'ta', 'include': 'authors'})
+        assert response.data == {'categories': [{'id': self.dessert.id, 'name': 'Dessert', 'count': 1}],
+                                 'authors': [{'id': self.other.id, 'username': 'other', 'count': 1}]}
+        assert self.client.get(self.url, {'q': '!!'}).status_code == status.HTTP_400_BAD_REQUEST
+        assert self.client.get(self.url, {'author': 'x'}).status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestRecipeUploads:
+    @pytest.fixture(autouse=True)
+    def upload_settings(self, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path / 'media')
+        settings.RECIPE_UPLOAD_ROOT = str(tmp_path / 'uploads')
+        settings.RECIPE_UPLOAD_CHUNK_SIZE = 100
+        settings.RECIPE_UPLOAD_MAX_SIZE = 10000
+        self.media = tmp_path / 'media'
+
+    @pytest.fixture(autouse=True)
+    def queued(self, monkeypatch):
+        self.queued = []
+        monkeypatch.setattr(tasks.attach_upload, 'delay', lambda *args: self.queued.append(args))
+
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='uploads@example.com', username='uploads', password='testpass')
+        self.other = User.objects.create_user(email='other@example.com', username='other', password='testpass')
+        self.recipe = Recipe.objects.create(title='Cake', desc='x', cook_time='00:30:00', ingredients='flour',
+                                            procedure='bake', author=self.user,
+                                            category=RecipeCategory.objects.create(name='Dessert'))
+        output = io.BytesIO()
+        # Noise doesn't compress, so the file takes a few chunks.
+        Image.frombytes('RGB', (16, 16), bytes(range(256)) * 3).save(output, 'PNG')
+        self.data = output.getvalue()
+        self.client.force_authenticate(self.user)
+
+    def create_slot(self, size=None):
+        response = self.client.post(reverse('recipe:recipe-upload-slot'),
+                                    {'size': size or len(self.data), 'name': 'Cake.PNG'}, format='json')
+        assert response.status_code == status.HTTP_201_CREATED
+        return response.data['upload'], response.data['url']
+
+    def send(self, url, offset, chunk):
+        return self.client.generic('PATCH', url, chunk, content_type='application/offset+octet-stream',
+                                   HTTP_UPLOAD_OFFSET=str(offset))
+
+    def upload(self, url):
+        for offset in range(0, len(self.data), 100):
+            assert self.send(url, offset, self.data[offset:offset + 100]).status_code == status.HTTP_204_NO_CONTENT
+
+    def test_resumable_upload(self):
+        token, url = self.create_slot()
+        # The signed URL needs no other credentials.
+        self.client.force_authenticate(None)
+        response = self.send(url, 0, self.data[:60])
+        assert response['Upload-Offset'] == '60'
+        response = self.client.head(url)
+        assert (response['Upload-Offset'], response['Upload-Length']) == ('60', str(len(self.data)))
+
+        response = self.send(url, 30, self.data[30:90])
+        assert response.status_code == status.HTTP_409_CONFLICT
+        assert response['Upload-Offset'] == '60'
+        for offset in range(60, len(self.data), 100):
+            self.send(url, offset, self.data[offset:offset + 100])
+        assert uploads.is_complete(uploads.load_slot(token))
+
+    def test_chunk_limits(self):
+        token, url = self.create_slot()
+        assert self.send(url, 0, self.data[:101]).status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        assert self.send(url, len(self.data) - 10, b'x' * 20).status_code == status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+        assert self.client.head(reverse('recipe:recipe-upload', args=[token + 'x'])).status_code == status.HTTP_404_NOT_FOUND
+        response = self.client.post(reverse('recipe:recipe-upload-slot'), {'size': 10001, 'name': 'a.png'})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_attach_picture(self, django_capture_on_commit_callbacks):
+        token, url = self.create_slot()
+        picture_url = reverse('recipe:recipe-picture', args=[self.recipe.pk])
+        # Not uploaded yet.
+        response = self.client.post(picture_url, {'upload': token}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+        self.upload(url)
+        self.client.force_authenticate(self.other)
+        response = self.client.post(picture_url, {'upload': token}, format='json')
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+        self.client.force_authenticate(self.user)
+        with django_capture_on_commit_callbacks(execute=True):
+            response = self.client.post(picture_url, {'upload': token}, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        assert self.queued == [(uploads.load_slot(token), 'recipe.Recipe', self.recipe.pk, 'picture')]
+        assert tasks.attach_upload(*self.queued[0]).startswith('Upload')
+        self.recipe.refresh_from_db()
+        assert self.recipe.picture.name.endswith('.png')
+        assert (self.media / self.recipe.picture.name).read_bytes() == self.data
+        assert not uploads.is_complete(uploads.load_slot(token))
+
+    def test_attach_avatar(self, django_capture_on_commit_callbacks):
+        token, url = self.create_slot()
+        self.upload(url)
+        avatar_url = reverse('users:user-avatar')
+        # Slots belong to the user who reserved them.
+        self.client.force_authenticate(self.other)
+        response = self.client.post(avatar_url, {'upload': token}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        self.client.force_authenticate(self.user)
+        with django_capture_on_commit_callbacks(execute=True):
+            response = self.client.post(avatar_url, {'upload': token}, format='json')
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        tasks.attach_upload(*self.queued[0])
+        profile = Profile.objects.get(user=self.user)
+        assert (self.media / profile.avatar.name).read_bytes() == self.data
+
+    def test_attach_rejects_other_files(self):
+        token, url = self.create_slot(size=5)
+        self.send(url, 0, b'hello')
+        slot = uploads.load_slot(token)
+        assert not uploads.attach(slot, Recipe, self.recipe.pk, 'picture')
+        self.recipe.refresh_from_db()
+        assert not self.recipe.picture
+
+    def test_nginx_receiver(self, settings, tmp_path):
+        settings.RECIPE_UPLOAD_RECEIVER = 'nginx'
+        settings.RECIPE_UPLOAD_INCOMING = str(tmp_path / 'incoming')
+        (tmp_path / 'incoming').mkdir()
+        token, url = self.create_slot()
+
+        def send(offset, chunk, name):
+            # What nginx forwards: no body, only the file it was written to.
+            body = tmp_path / 'incoming' / name
+            body.write_bytes(chunk)
+            response = self.client.generic('PATCH', url, HTTP_UPLOAD_OFFSET=str(offset), HTTP_X_UPLOAD_BODY=str(body))
+            # nginx deletes its file after the response.
+            body.unlink()
+            return response
+
+        # The whole file can come in one chunk.
+        response = self.client.post(reverse('recipe:recipe-upload-slot'), {'size': 10, 'name': 'a.png'})
+        assert response.data['chunk_size'] == 10000
+        response = send(0, self.data[:60], '0001')
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+        assert response['Upload-Offset'] == '60'
+        assert send(30, self.data[30:90], '0002').status_code == status.HTTP_409_CONFLICT
+        # Only files nginx wrote are taken, never a body sent past it.
+        secret = tmp_path / 'secret.png'
+        secret.write_bytes(self.data[60:])
+        response = self.client.generic('PATCH', url, HTTP_UPLOAD_OFFSET='60', HTTP_X_UPLOAD_BODY=str(secret))
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        response = self.client.generic('PATCH', url, self.data[60:], HTTP_UPLOAD_OFFSET='60')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert send(60, self.data[60:], '0003')['Upload-Offset'] == str(len(self.data))
+
+        slot = uploads.load_slot(token)
+        assert uploads.attach(slot, Recipe, self.recipe.pk, 'picture')
+        self.recipe.refresh_from_db()
+        assert (self.media / self.recipe.picture.name).read_bytes() == self.data
+
+    def test_attach_checks_size(self):
+        token, url = self.create_slot(size=len(self.data) + 1)
+        self.upload(url)
+        slot = uploads.load_slot(token)
+        # An image, but not the whole file.
+        assert not uploads.attach(slot, Recipe, self.recipe.pk, 'picture')
+        self.recipe.refresh_from_db()
+        assert not self.recipe.picture
+
+    def test_delete_expired(self, settings):
+        token, url = self.create_slot()
+        self.send(url, 0, self.data[:50])
+        assert uploads.delete_expired() == 0
+        later = timezone.now() + timedelta(seconds=settings.RECIPE_UPLOAD_SLOT_MAX_AGE + 1)
+        assert uploads.delete_expired(now=later) == 1
+
+
+class TestMediaServing:
+    @pytest.fixture(autouse=True)
+    def media_root(self, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        settings.RECIPE_MEDIA_SERVING = 'python'
+        self.data = bytes(range(256)) * 40
+        self.name = ContentAddressedStorage(location=str(tmp_path)).save('uploads/cake.jpg', ContentFile(self.data))
+        (tmp_path / 'legacy.jpg').write_bytes(self.data)
+        self.factory = RequestFactory()
+
+    def get(self, path, **headers):
+        response = media.serve(self.factory.get(f'/media/{path}', **headers), path)
+        response.content_bytes = b''.join(response)
+        return response
+
+    def test_whole_file(self):
+        response = self.get(self.name)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.content_bytes == self.data
+        assert response['Content-Type'] == 'image/jpeg'
+        assert response['Cache-Control'] == 'public, max-age=31536000, immutable'
+        assert self.get('legacy.jpg')['Cache-Control'] == 'public, no-cache'
+        response = self.get(self.name, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+
+    def test_ranges(self):
+        response = self.get(self.name, HTTP_RANGE='bytes=100-199')
+        assert response.status_code == status.HTTP_206_PARTIAL_CONTENT
+        assert response['Content-Range'] == f'bytes 100-199/{len(self.data)}'
+        assert response.content_bytes == self.data[100:200]
+        assert self.get(self.name, HTTP_RANGE='bytes=-10').content_bytes == self.data[-10:]
+        assert self.get(self.name, HTTP_RANGE='bytes=10000-').content_bytes == self.data[10000:]
+        response = self.get(self.name, HTTP_RANGE=f'bytes={len(self.data)}-')
+        assert response.status_code == status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE
+        # Several ranges, or a stale If-Range, get the whole file.
+        assert self.get(self.name, HTTP_RANGE='bytes=0-1,5-6').status_code == status.HTTP_200_OK
+        response = self.get(self.name, HTTP_RANGE='bytes=0-1', HTTP_IF_RANGE='Sat, 01 Jan 2000 00:00:00 GMT')
+        assert response.content_bytes == self.data
+
+    def test_proxy_modes(self, settings, tmp_path):
+        settings.RECIPE_MEDIA_SERVING = 'x-accel-redirect'
+        response = self.get(self.name)
+        assert response['X-Accel-Redirect'] == f'/protected-media/{self.name}'
+        assert response.content_bytes == b''
+        assert response['Cache-Control'] == 'public, max-age=31536000, immutable'
+        settings.RECIPE_MEDIA_SERVING = 'x-sendfile'
+        assert self.get(self.name)['X-Sendfile'] == str(tmp_path / self.name)
+
+    def test_outside_media_root(self):
+        for path in ('../secret.txt', 'missing.jpg', 'uploads'):
+            with pytest.raises(Http404):
+                self.get(path)
@@ -0,0 +1,106 @@
+"""
+Time-decayed like scores behind the trending feed.
+
+Every like is worth exp(-rate * age), so a recipe's score halves every
+RECIPE_TRENDING_HALF_LIFE hours unless it keeps getting liked. Decaying
+every score by the same factor doesn't change their order, so
+Recipe.trending_score stores the sum of exp(rate * (created - epoch)) for a
+fixed epoch instead: the score at any time, up to a factor shared by all
+recipes. A refresh then only adds the likes committed since the previous
+one to the recipes they were given to.
+
+New likes are read up to recipe.visibility.get_visible_until(), so likes
+whose transaction commits late are counted by a later refresh rather than
+skipped. A full rebuild from the likes of the last HORIZON_HALF_LIVES
+half-lives moves the epoch to now, which keeps the stored values small,
+and drops removed likes and recipes whose likes have all aged out.
+"""
+import math
+from datetime import timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F, FloatField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Exp, Extract
+from django.utils import timezone
+
+from .models import Recipe, RecipeLike
+from .visibility import get_visible_until
+
+STATE_KEY = 'recipe:trending:state'
+# Likes older than this many half-lives weigh less than 0.1% and are dropped.
+HORIZON_HALF_LIVES = 10
+# Rebuild rather than let the stored values grow past 2 ** this.
+MAX_EPOCH_HALF_LIVES = 100
+
+
+def get_half_life():
+    return timedelta(hours=getattr(settings, 'RECIPE_TRENDING_HALF_LIFE', 24))
+
+
+def get_decay_rate():
+    return math.log(2) / get_half_life().total_seconds()
+
+
+def get_state():
+    """
+    {'epoch': ..., 'until': ...}: the epoch of the stored scores and the
+    time up to which likes have been added, or None before a rebuild.
+    """
+    return cache.get(STATE_KEY)
+
+
+def get_score(stored, epoch, now):
+    """
+    The decayed score at `now` of a stored score.
+    """
+    return stored * math.exp(-get_decay_rate() * (now - epoch).total_seconds())
+
+
+def like_scores(likes, epoch):
+    """
+    Subquery of the summed like weights relative to `epoch` per recipe of
+    `likes`.
+    """
+    age = Value(epoch.timestamp()) - Extract('created', 'epoch', tzinfo=dt_timezone.utc)
+    weights = (likes.filter(recipe=OuterRef('pk'))
+               .order_by().values('recipe')
+               .annotate(score=Sum(Exp(age * -get_decay_rate(), output_field=FloatField())))
+               .values('score'))
+    return Coalesce(Subquery(weights, output_field=FloatField()), 0.0)
+
+
+def rebuild_trending_scores(now=None):
+    """
+    Recompute every score from the likes inside the horizon, with `now` as
+    the new epoch.
+    """
+    now = now or timezone.now()
+    until = get_visible_until(now)
+    likes = RecipeLike.objects.filter(created__gt=now - get_half_life() * HORIZON_HALF_LIVES,
+                                      created__lte=until)
+    liked = likes.values('recipe')
+    with transaction.atomic():
+        Recipe.objects.filter(trending_score__gt=0).exclude(pk__in=liked).update(trending_score=0)
+        Recipe.objects.filter(pk__in=liked).update(trending_score=like_scores(likes, now))
+    cache.set(STATE_KEY, {'epoch': now, 'until': until}, None)
+
+
+def refresh_trending_scores(now=None):
+    """
+    Add the likes committed since the previous refresh to their recipes.
+    Falls back to a rebuild if there was none or the epoch is too old.
+    """
+    now = now or timezone.now()
+    state = get_state()
+    if state is None or now - state['epoch'] > get_half_life() * MAX_EPOCH_HALF_LIVES:
+        return rebuild_trending_scores(now)
+
+    until = get_visible_until(now)
+    if until <= state['until']:
+        return
+    likes = RecipeLike.objects.filter(created__gt=state['until'], created__lte=until)
+    (Recipe.objects.filter(pk__in=likes.values('recipe'))
+     .update(trending_score=F('trending_score') + like_scores(likes, state['epoch'])))
+    cache.set(STATE_KEY, dict(state, until=until), None)
@@ -0,0 +1,246 @@
+"""
+Resumable uploads of recipe pictures and avatars, outside multipart requests.
+
+1. POST /api/recipe/uploads/ with {"size": bytes, "name": "cake.jpg"}
+   reserves a signed slot, valid for RECIPE_UPLOAD_SLOT_MAX_AGE seconds, and
+   returns its upload URL and the largest chunk accepted.
+2. The client PATCHes the file to that URL in one or more chunks, each with
+   an Upload-Offset header giving where it starts. After a dropped
+   connection, HEAD returns the offset to resume from.
+3. POSTing {"upload": token} to /api/recipe/<id>/picture/ or
+   /api/user/profile/avatar/ attaches the finished file;
+   recipe.tasks.attach_upload checks it and moves it into the field's
+   storage.
+
+The signed token holds everything about the slot, so no table is needed.
+Each chunk is a file of its own under RECIPE_UPLOAD_ROOT/<slot id>/, named
+after its offset, and the upload's offset is where its chunks stop being
+contiguous.
+
+RECIPE_UPLOAD_RECEIVER picks who reads the chunks off the network:
+
+- 'nginx': the front proxy writes the request body to a file under
+  RECIPE_UPLOAD_INCOMING (client_body_in_file_only) and only passes its
+  path on, in an X-Upload-Body header. The web worker checks the slot and
+  the offset and hard-links the file into the upload, which takes the same
+  time whatever the size of the chunk or the speed of the client, so the
+  whole file can be sent in one chunk.
+- 'python': the web worker reads the body itself, in chunks of at most
+  RECIPE_UPLOAD_CHUNK_SIZE bytes. For development without a proxy.
+"""
+import logging
+import os
+import re
+import shutil
+import tempfile
+from uuid import uuid4
+
+from django.conf import settings
+from django.core import signing
+from django.core.files import File
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+
+logger = logging.getLogger(__name__)
+
+SALT = 'recipe.uploads'
+COPY_SIZE = 64 * 1024
+EXTENSION_RE = re.compile(r'^\.[a-z0-9]{1,5}$')
+
+
+class OffsetConflict(Exception):
+    """
+    A chunk didn't start where the upload stands, or another chunk got
+    there first.
+    """
+    def __init__(self, offset):
+        super().__init__(f'The upload is at offset {offset}.')
+        self.offset = offset
+
+
+def create_slot(user_id, size, name):
+    """
+    Sign a new upload slot for a file of `size` bytes called `name`.
+    """
+    extension = os.path.splitext(name)[1].lower()
+    slot = {
+        'id': uuid4().hex,
+        'user': user_id,
+        'size': size,
+        'ext': extension if EXTENSION_RE.match(extension) else '',
+    }
+    return signing.dumps(slot, salt=SALT)
+
+
+def load_slot(token):
+    """
+    The slot a token was signed for, or None if it's invalid or expired.
+    """
+    try:
+        return signing.loads(token, salt=SALT, max_age=settings.RECIPE_UPLOAD_SLOT_MAX_AGE)
+    except signing.BadSignature:
+        return None
+
+
+def get_chunk_size():
+    """
+    The largest chunk accepted: a whole file when nginx receives them.
+    """
+    if settings.RECIPE_UPLOAD_RECEIVER == 'nginx':
+        return settings.RECIPE_UPLOAD_MAX_SIZE
+    return settings.RECIPE_UPLOAD_CHUNK_SIZE
+
+
+def get_path(slot):
+    return os.path.join(settings.RECIPE_UPLOAD_ROOT, slot['id'])
+
+
+def get_chunks(slot):
+    """
+    The (offset, path, size) of the contiguous chunks of an upload, in
+    order.
+    """
+    try:
+        entries = {int(entry.name): entry for entry in os.scandir(get_path(slot)) if entry.name.isdigit()}
+    except FileNotFoundError:
+        return []
+    chunks = []
+    offset = 0
+    while offset in entries:
+        size = entries[offset].stat().st_size
+        chunks.append((offset, entries[offset].path, size))
+        offset += size
+    return chunks
+
+
+def get_offset(slot):
+    chunks = get_chunks(slot)
+    if not chunks:
+        return 0
+    offset, path, size = chunks[-1]
+    return offset + size
+
+
+def is_complete(slot):
+    return get_offset(slot) == slot['size']
+
+
+def add_chunk(slot, offset, path):
+    """
+    Hard-link the file at `path` into the upload as the chunk starting at
+    `offset`, which must be the current end of the upload. Returns the new
+    offset. `path` must be on the filesystem of RECIPE_UPLOAD_ROOT.
+    """
+    current = get_offset(slot)
+    if offset != current:
+        raise OffsetConflict(current)
+    size = os.path.getsize(path)
+    if not size:
+        return offset
+    os.makedirs(get_path(slot), exist_ok=True)
+    try:
+        # Fails if a concurrent request added a chunk at this offset first.
+        os.link(path, os.path.join(get_path(slot), str(offset)))
+    except FileExistsError:
+        raise OffsetConflict(get_offset(slot))
+    return offset + size
+
+
+def get_body_path(header):
+    """
+    The file nginx wrote a request body to, from its X-Upload-Body header.
+    None unless it's a file under RECIPE_UPLOAD_INCOMING.
+    """
+    incoming = os.path.join(os.path.realpath(settings.RECIPE_UPLOAD_INCOMING), '')
+    path = os.path.realpath(header or '')
+    if not header or not path.startswith(incoming) or not os.path.isfile(path):
+        return None
+    return path
+
+
+def write_chunk(slot, offset, stream, length):
+    """
+    Write up to `length` bytes read from `stream` as the chunk starting at
+    `offset`. Returns the new offset; what was received of an interrupted
+    chunk is kept.
+    """
+    current = get_offset(slot)
+    if offset != current:
+        raise OffsetConflict(current)
+    os.makedirs(get_path(slot), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=get_path(slot), prefix='.') as chunk:
+        remaining = length
+        while remaining:
+            data = stream.read(min(remaining, COPY_SIZE))
+            if not data:
+                break
+            chunk.write(data)
+            remaining -= len(data)
+        chunk.flush()
+        return add_chunk(slot, offset, chunk.name)
+
+
+def verify(slot, upload):
+    """
+    Whether a finished upload has the size of its slot and is an image.
+    """
+    size = upload.seek(0, os.SEEK_END)
+    if size != slot['size']:
+        logger.warning(f"Upload {slot['id']} has {size} bytes, not {slot['size']}")
+        return False
+    upload.seek(0)
+    try:
+        with Image.open(upload) as image:
+            image.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        logger.warning(f"Upload {slot['id']} is not an image: {e}")
+        return False
+    upload.seek(0)
+    return True
+
+
+def attach(slot, model, pk, field_name):
+    """
+    Join the chunks of a finished upload, save them to the image field
+    `field_name` of a `model` instance and delete the upload. Returns False
+    if the instance or the upload is gone, or the upload is incomplete or
+    not an image.
+    """
+    instance = model.objects.filter(pk=pk).first()
+    chunks = get_chunks(slot)
+    if instance is None or not chunks:
+        return False
+    with tempfile.TemporaryFile() as upload:
+        for offset, path, size in chunks:
+            with open(path, 'rb') as chunk:
+                shutil.copyfileobj(chunk, upload, COPY_SIZE)
+        if not verify(slot, upload):
+            shutil.rmtree(get_path(slot), ignore_errors=True)
+            return False
+        getattr(instance, field_name).save(f"{slot['id']}{slot['ext']}", File(upload), save=False)
+    instance.save(update_fields=[field_name, 'updated_at'])
+    shutil.rmtree(get_path(slot), ignore_errors=True)
+    return True
+
+
+def delete_expired(now=None):
+    """
+    Delete partial uploads whose slot has expired. Returns the number of
+    uploads deleted.
+    """
+    cutoff = (now or timezone.now()).timestamp() - settings.RECIPE_UPLOAD_SLOT_MAX_AGE
+    try:
+        entries = list(os.scandir(settings.RECIPE_UPLOAD_ROOT))
+    except FileNotFoundError:
+        return 0
+    deleted = 0
+    for entry in entries:
+        # A slot can't be written to after it expires, so neither can its
+        # directory, whose mtime moves with every chunk.
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path)
+                deleted += 1
+        except FileNotFoundError:
+            pass
+    return deleted
@@ -8,6 +8,17 @@ urlpatterns = [
     path('', views.RecipeListAPIView.as_view(), name="recipe-list"),
     path('<int:pk>/', views.RecipeAPIView.as_view(), name="recipe-detail"),
     path('create/', views.RecipeCreateAPIView.as_view(), name="recipe-create"),
+    path('export/', views.RecipeExportAPIView.as_view(), name="recipe-export"),
+    path('uploads/', views.RecipeUploadSlotAPIView.as_view(), name="recipe-upload-slot"),
+    path('uploads/<str:token>/', views.RecipeUploadAPIView.as_view(), name="recipe-upload"),
+    path('batch/', views.RecipeBatchAPIView.as_view(), name="recipe-batch"),
+    path('trending/', views.RecipeTrendingAPIView.as_view(), name="recipe-trending"),
+    path('search/', views.RecipeSearchAPIView.as_view(), name="recipe-search"),
+    path('autocomplete/', views.RecipeAutocompleteAPIView.as_view(), name="recipe-autocomplete"),
+    path('facets/', views.RecipeFacetsAPIView.as_view(), name="recipe-facets"),
+    path('pantry/', views.RecipePantryAPIView.as_view(), name="recipe-pantry"),
+    path('<int:pk>/picture/', views.RecipePictureAPIView.as_view(), name="recipe-picture"),
+    path('<int:pk>/similar/', views.RecipeSimilarAPIView.as_view(), name="recipe-similar"),
     path('<int:pk>/like/', views.RecipeLikeAPIView.as_view(),
          name='recipe-like'),
 ]
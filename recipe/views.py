@@ -1,25 +1,307 @@
+import hashlib
+import os
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.http import Http404, StreamingHttpResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.contrib.postgres.search import SearchRank, TrigramWordSimilarity
+from django.db.models import Count, F, FloatField, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Cast, Greatest
 from rest_framework import generics, status
-from rest_framework.permissions import AllowAny, IsAuthenticated
+from rest_framework.exceptions import ValidationError
+from rest_framework.parsers import JSONParser
+from rest_framework.permissions import AllowAny, IsAdminUser, IsAuthenticated
 from django.shortcuts import get_object_or_404
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from django.core.mail import send_mail
-from .models import Recipe, RecipeLike
-from .serializers import RecipeLikeSerializer, RecipeSerializer
+from . import cache, export, like_buffer, uploads
+from .batch import save_recipe_batch
+from .ingredients import normalize_ingredient
+from .models import (AuthorCategoryCount, Ingredient, Recipe, RecipeCategory, RecipeIngredient, RecipeLike,
+                     get_recipe_search_query)
+from .parsers import NDJSONParser
+from .renderers import CSVRenderer, NDJSONRenderer
+from .serializers import (RecipeBatchSerializer, RecipeLikeSerializer, RecipePantrySerializer, RecipeSerializer,
+                          UploadAttachSerializer, UploadSlotSerializer)
 from .permissions import IsAuthorOrReadOnly
-from .tasks import notify_author_about_likes
+from .mixins import CachedResponseMixin, RecipeConditionalGetMixin, SparseFieldsMixin
+from .pagination import RecipePantryPagination, RecipeSearchPagination, RecipeTrendingPagination
+from .tasks import attach_upload, notify_author_about_likes
+from .visibility import get_visible_until
 import logging
 import smtplib, ssl
 
 logger = logging.getLogger(__name__)
 
-class RecipeListAPIView(generics.ListAPIView):
+class RecipeListAPIView(RecipeConditionalGetMixin, CachedResponseMixin, SparseFieldsMixin,
+                        generics.ListAPIView):
+    """
+    Get: a collection of recipes (summary fields unless ?fields= is given)
+    """
+    queryset = Recipe.objects.all().select_related('author', 'category')
+    serializer_class = RecipeSerializer
+    default_fields = RecipeSerializer.Meta.summary_fields
+    cache_scope = 'recipe-list'
+    permission_classes = (AllowAny,)
+    filterset_fields = ('category__name', 'author__username')
+
+
+class RecipeTrendingAPIView(SparseFieldsMixin, generics.ListAPIView):
+    """
+    Get: recipes with the most recent likes first, optionally per category
+    with ?category=<id> or ?category__name=.
+    """
+    queryset = Recipe.objects.filter(trending_score__gt=0).select_related('author', 'category')
+    serializer_class = RecipeSerializer
+    permission_classes = (AllowAny,)
+    pagination_class = RecipeTrendingPagination
+    filterset_fields = ('category', 'category__name')
+    default_fields = RecipeSerializer.Meta.summary_fields
+
+
+class RecipeSimilarAPIView(SparseFieldsMixin, generics.ListAPIView):
+    """
+    Get: recipes that people who liked or bookmarked this recipe also liked,
+    most similar first. Neighbours are precomputed by
+    recipe.tasks.update_recipe_recommendations.
+    """
+    serializer_class = RecipeSerializer
+    permission_classes = (AllowAny,)
+    pagination_class = None
+    default_fields = RecipeSerializer.Meta.summary_fields
+
+    def get_queryset(self):
+        return (Recipe.objects
+                .filter(neighbor_of_links__recipe_id=self.kwargs['pk'])
+                .select_related('author', 'category')
+                .order_by('-neighbor_of_links__score', '-id'))
+
+
+class RecipeSearchAPIView(SparseFieldsMixin, generics.ListAPIView):
     """
-    Get: a collection of recipes
+    Get: recipes matching ?q=, ranked by title, then description, then
+    ingredient matches. Every word is matched as a prefix.
     """
-    queryset = Recipe.objects.all().select_related('author').prefetch_related('category')
+    queryset = Recipe.objects.all().select_related('author', 'category')
     serializer_class = RecipeSerializer
     permission_classes = (AllowAny,)
+    pagination_class = RecipeSearchPagination
     filterset_fields = ('category__name', 'author__username')
+    default_fields = RecipeSerializer.Meta.summary_fields
+    max_terms = 10
+
+    def get_search_query(self):
+        return get_recipe_search_query(self.request.query_params.get('q', ''), self.max_terms)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        query = self.get_search_query()
+        if query is None:
+            return queryset.none()
+        return (queryset.filter(search_vector=query)
+                .annotate(rank=Cast(SearchRank(F('search_vector'), query), FloatField())))
+
+    def list(self, request, *args, **kwargs):
+        if self.get_search_query() is None:
+            raise ValidationError({'q': 'Enter at least one search term.'})
+        return super().list(request, *args, **kwargs)
+
+
+class RecipeAutocompleteAPIView(APIView):
+    """
+    Get: search-as-you-type suggestions for ?q= from recipe titles and
+    category names. Misspelled words still match through trigram word
+    similarity; prefix matches are returned for queries too short for it.
+    """
+    # Suggestions are public and identical for everyone; skipping
+    # authentication keeps the per-keystroke cost to the two index reads.
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+    min_length = 2
+    max_length = 100
+    limit = 8
+    category_limit = 3
+
+    def get_term(self):
+        return ' '.join(self.request.query_params.get('q', '').lower().split())[:self.max_length]
+
+    def get_cache_key(self, term):
+        return f'recipe:autocomplete:{hashlib.md5(term.encode("utf-8")).hexdigest()}'
+
+    def get_prefix_pattern(self, term):
+        # Not istartswith: its UPPER(title) LIKE can't use the trigram
+        # indexes, while ~* can, so both branches of the OR stay index reads.
+        return '^' + re.escape(term)
+
+    def get_recipes(self, term):
+        rows = (Recipe.objects
+                .filter(Q(title__trigram_word_similar=term) | Q(title__iregex=self.get_prefix_pattern(term)))
+                .annotate(similarity=TrigramWordSimilarity(term, 'title'))
+                .order_by('-similarity', '-likes_count', '-id')
+                .values('id', 'title', 'category__name')[:self.limit])
+        return [{'id': row['id'], 'title': row['title'], 'category': row['category__name']}
+                for row in rows]
+
+    def get_categories(self, term):
+        return list(RecipeCategory.objects
+                    .filter(Q(name__trigram_word_similar=term) | Q(name__iregex=self.get_prefix_pattern(term)))
+                    .annotate(similarity=TrigramWordSimilarity(term, 'name'))
+                    .order_by('-similarity', 'name')
+                    .values('id', 'name')[:self.category_limit])
+
+    def get(self, request):
+        term = self.get_term()
+        if len(term) < self.min_length:
+            return Response({'recipes': [], 'categories': []})
+
+        key = self.get_cache_key(term)
+        data = cache.get_cached_data(key)
+        if data is None:
+            data = {'recipes': self.get_recipes(term), 'categories': self.get_categories(term)}
+            cache.set_cached_data(key, data, [recipe['id'] for recipe in data['recipes']],
+                                  timeout=settings.RECIPE_AUTOCOMPLETE_CACHE_TIMEOUT)
+        return Response(data)
+
+
+class RecipeFacetsAPIView(APIView):
+    """
+    Get: recipe counts per category, optionally only for ?author=<id> or
+    ?author__username= and only for ?category__name=. ?include=authors adds
+    the authors with the most recipes. Counts are read from the aggregate
+    rows kept by recipe.facets; a ?q= search groups the matching recipes.
+    """
+    permission_classes = (AllowAny,)
+    author_limit = 20
+    max_terms = 10
+
+    def get_filters(self):
+        params = self.request.query_params
+        filters = {}
+        if 'author' in params:
+            try:
+                filters['author_id'] = int(params['author'])
+            except ValueError:
+                raise ValidationError({'author': 'Must be an integer.'})
+        if 'author__username' in params:
+            filters['author__username'] = params['author__username']
+        if 'category__name' in params:
+            filters['category__name'] = params['category__name']
+        return filters
+
+    def get_counted_categories(self, filters):
+        if 'author_id' in filters or 'author__username' in filters:
+            rows = (AuthorCategoryCount.objects.filter(recipes_count__gt=0, **filters)
+                    .values_list('category_id', 'category__name', 'recipes_count'))
+        else:
+            rows = RecipeCategory.objects.filter(recipes_count__gt=0)
+            if 'category__name' in filters:
+                rows = rows.filter(name=filters['category__name'])
+            rows = rows.values_list('id', 'name', 'recipes_count')
+        return rows.order_by('-recipes_count', 'id')
+
+    def get_counted_authors(self, filters):
+        rows = AuthorCategoryCount.objects.filter(recipes_count__gt=0, **filters)
+        if 'category__name' in filters:
+            # One row per author within a single category.
+            rows = rows.values_list('author_id', 'author__username', 'recipes_count')
+            return rows.order_by('-recipes_count', 'author_id')[:self.author_limit]
+        rows = rows.values_list('author_id', 'author__username').annotate(total=Sum('recipes_count'))
+        return rows.order_by('-total', 'author_id')[:self.author_limit]
+
+    def get(self, request):
+        filters = self.get_filters()
+        include_authors = 'authors' in request.query_params.get('include', '').split(',')
+        if 'q' in request.query_params:
+            query = get_recipe_search_query(request.query_params['q'], self.max_terms)
+            if query is None:
+                raise ValidationError({'q': 'Enter at least one search term.'})
+            recipes = Recipe.objects.filter(search_vector=query, **filters).order_by()
+            categories = (recipes.values_list('category_id', 'category__name')
+                          .annotate(total=Count('id')).order_by('-total', 'category_id'))
+            authors = (recipes.values_list('author_id', 'author__username')
+                       .annotate(total=Count('id')).order_by('-total', 'author_id')[:self.author_limit])
+        else:
+            categories = self.get_counted_categories(filters)
+            authors = self.get_counted_authors(filters) if include_authors else None
+
+        data = {'categories': [{'id': pk, 'name': name, 'count': count} for pk, name, count in categories]}
+        if include_authors:
+            data['authors'] = [{'id': pk, 'username': username, 'count': count}
+                               for pk, username, count in authors]
+        return Response(data)
+
+
+class RecipePantryAPIView(SparseFieldsMixin, generics.ListAPIView):
+    """
+    Get: recipes that can be cooked with ?ingredients=egg,flour,milk, ranked
+    by the share of each recipe's ingredients that the pantry covers.
+    """
+    queryset = Recipe.objects.all().select_related('author', 'category')
+    serializer_class = RecipePantrySerializer
+    permission_classes = (AllowAny,)
+    pagination_class = RecipePantryPagination
+    filterset_fields = ('category__name', 'author__username')
+    default_fields = RecipePantrySerializer.Meta.summary_fields
+    max_ingredients = 50
+    # Recipes ranked per request, whatever the pantry.
+    max_candidates = 2000
+
+    def get_ingredients(self):
+        """
+        (id, recipe_count) of the known pantry ingredients, rarest first.
+        """
+        if not hasattr(self, '_ingredients'):
+            raw = self.request.query_params.get('ingredients', '').split(',')[:self.max_ingredients]
+            names = {name for name in map(normalize_ingredient, raw) if name}
+            self._ingredients = list(Ingredient.objects.filter(name__in=names)
+                                     .order_by('recipe_count', 'id').values_list('id', 'recipe_count'))
+        return self._ingredients
+
+    def get_candidates(self, ingredients):
+        """
+        Ids of at most max_candidates recipes using a pantry ingredient, one
+        LIMIT-ed read of the (ingredient, recipe) index per ingredient. Rare
+        ingredients are read in full; common ones like salt share what is
+        left of the budget, newest recipes first.
+        """
+        budget = self.max_candidates
+        reads = []
+        for ingredient_id, recipe_count in ingredients:
+            limit = min(recipe_count, budget)
+            if limit:
+                reads.append(RecipeIngredient.objects.filter(ingredient_id=ingredient_id)
+                             .order_by('-recipe_id').values_list('recipe_id', flat=True)[:limit])
+                budget -= limit
+        if not reads:
+            return None
+        return reads[0].union(*reads[1:], all=True)
+
+    def get_queryset(self):
+        ingredients = self.get_ingredients()
+        candidates = self.get_candidates(ingredients)
+        if candidates is None:
+            return Recipe.objects.none()
+        # Counts the matches of each candidate on the (recipe, ingredient)
+        # index, so a page costs the same for "salt" as for "saffron".
+        matches = (RecipeIngredient.objects
+                   .filter(recipe=OuterRef('pk'), ingredient_id__in=[ingredient_id for ingredient_id, _ in ingredients])
+                   .order_by().values('recipe').annotate(count=Count('*')).values('count'))
+        return (super().get_queryset()
+                .filter(pk__in=candidates)
+                .annotate(matched_ingredients=Subquery(matches, output_field=IntegerField()))
+                .annotate(coverage=Cast(F('matched_ingredients'), FloatField())
+                          / Greatest(F('ingredient_count'), 1)))
+
+    def list(self, request, *args, **kwargs):
+        if not request.query_params.get('ingredients', '').strip(' ,'):
+            raise ValidationError({'ingredients': 'Enter at least one ingredient.'})
+        return super().list(request, *args, **kwargs)
 
 
 class RecipeCreateAPIView(generics.CreateAPIView):
@@ -34,33 +316,219 @@ class RecipeCreateAPIView(generics.CreateAPIView):
         serializer.save(author=self.request.user)
 
 
-class RecipeAPIView(generics.RetrieveUpdateDestroyAPIView):
+class RecipeUploadSlotAPIView(generics.CreateAPIView):
+    """
+    Post: reserve a signed, time-limited slot to upload a recipe picture or
+    an avatar to in chunks, see recipe.uploads
+    """
+    serializer_class = UploadSlotSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def get_serializer_context(self):
+        return dict(super().get_serializer_context(), max_size=settings.RECIPE_UPLOAD_MAX_SIZE)
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        token = uploads.create_slot(request.user.pk, **serializer.validated_data)
+        expires = timezone.now() + timedelta(seconds=settings.RECIPE_UPLOAD_SLOT_MAX_AGE)
+        return Response({
+            'upload': token,
+            'url': request.build_absolute_uri(reverse('recipe:recipe-upload', args=[token])),
+            'chunk_size': uploads.get_chunk_size(),
+            'expires': expires,
+        }, status=status.HTTP_201_CREATED)
+
+
+class RecipeUploadAPIView(APIView):
+    """
+    Head: the bytes received so far, as the Upload-Offset header
+    Patch: a chunk of the file, starting at its Upload-Offset header. Behind
+    nginx, the body arrives as a file named by the X-Upload-Body header.
+    The signed URL is the only credential needed, like a presigned URL.
+    """
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+
+    def get_slot(self, token):
+        slot = uploads.load_slot(token)
+        if slot is None:
+            raise Http404
+        return slot
+
+    def head(self, request, token):
+        slot = self.get_slot(token)
+        return Response(status=status.HTTP_204_NO_CONTENT, headers={
+            'Upload-Offset': str(uploads.get_offset(slot)),
+            'Upload-Length': str(slot['size']),
+            'Cache-Control': 'no-store',
+        })
+
+    def patch(self, request, token):
+        slot = self.get_slot(token)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            raise ValidationError({'Upload-Offset': 'Send the offset the chunk starts at.'})
+        if settings.RECIPE_UPLOAD_RECEIVER == 'nginx':
+            # nginx took the body; only its file is left to check and link.
+            path = uploads.get_body_path(request.headers.get('X-Upload-Body'))
+            if path is None:
+                raise ValidationError({'detail': 'The request body was not received.'})
+            length = os.path.getsize(path)
+        else:
+            path = None
+            try:
+                length = int(request.headers['Content-Length'])
+            except (KeyError, ValueError):
+                return Response(status=status.HTTP_411_LENGTH_REQUIRED)
+        chunk_size = uploads.get_chunk_size()
+        if length > chunk_size or offset + length > slot['size']:
+            return Response({'detail': f"Send chunks of at most {chunk_size} bytes "
+                                       f"within the {slot['size']} bytes of the upload."},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        try:
+            if path is not None:
+                offset = uploads.add_chunk(slot, offset, path)
+            else:
+                # Read straight from the request, never parsed or buffered whole.
+                offset = uploads.write_chunk(slot, offset, request.stream, length)
+        except uploads.OffsetConflict as e:
+            return Response({'detail': str(e)}, status=status.HTTP_409_CONFLICT,
+                            headers={'Upload-Offset': str(e.offset)})
+        return Response(status=status.HTTP_204_NO_CONTENT, headers={'Upload-Offset': str(offset)})
+
+
+class RecipeBatchAPIView(generics.GenericAPIView):
+    """
+    Post: create recipes, or update your own ones when an item has an `id`,
+    from a JSON array or an NDJSON (application/x-ndjson) stream. Returns one
+    result per item, in order.
+    """
+    serializer_class = RecipeBatchSerializer
+    permission_classes = (IsAuthenticated,)
+    parser_classes = (JSONParser, NDJSONParser)
+
+    @property
+    def max_batch_size(self):
+        return settings.RECIPE_BATCH_MAX_SIZE
+
+    def post(self, request):
+        items = request.data
+        if not isinstance(items, list) or not items:
+            raise ValidationError({'non_field_errors': ['Expected a non-empty list of recipes.']})
+        if len(items) > self.max_batch_size:
+            raise ValidationError(
+                {'non_field_errors': [f'Send at most {self.max_batch_size} recipes per batch.']})
+        return Response({'results': save_recipe_batch(request.user, items)})
+
+
+class RecipeExportAPIView(APIView):
+    """
+    Get: every recipe with its author, category and counts, streamed as
+    NDJSON (default) or CSV (?format=csv or Accept: text/csv), up to the
+    time in the X-Export-Until header. Pass that header as ?updated_since=
+    to the next export to only get the recipes changed since.
+    """
+    permission_classes = (IsAdminUser,)
+    renderer_classes = (NDJSONRenderer, CSVRenderer)
+
+    def get_updated_since(self):
+        value = self.request.query_params.get('updated_since')
+        if not value:
+            return None
+        try:
+            since = parse_datetime(value)
+        except ValueError:
+            since = None
+        if since is None:
+            raise ValidationError({'updated_since': 'Enter an ISO 8601 date and time.'})
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        return since
+
+    def get(self, request):
+        since = self.get_updated_since()
+        # Rows of transactions still open may be stamped before now; they
+        # are left for the next export rather than skipped by it.
+        until = get_visible_until()
+        renderer = request.accepted_renderer
+        rows = export.export_rows(since=since, until=until)
+        response = StreamingHttpResponse(export.WRITERS[renderer.format](rows),
+                                         content_type=f'{renderer.media_type}; charset={renderer.charset}')
+        response['Content-Disposition'] = f'attachment; filename="recipes.{renderer.format}"'
+        response['X-Export-Until'] = until.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        return response
+
+
+class RecipeAPIView(RecipeConditionalGetMixin, CachedResponseMixin, SparseFieldsMixin,
+                    generics.RetrieveUpdateDestroyAPIView):
     """
     Get, Update, Delete a recipe
     """
-    queryset = Recipe.objects.all().select_related('author').prefetch_related('category')
+    queryset = Recipe.objects.all().select_related('author', 'category')
     serializer_class = RecipeSerializer
     permission_classes = (IsAuthorOrReadOnly,)
+    cache_scope = 'recipe-detail'
+
+
+class RecipePictureAPIView(generics.GenericAPIView):
+    """
+    Post: attach a finished upload as the recipe's picture, {"upload": token}.
+    The picture is replaced in the background.
+    """
+    queryset = Recipe.objects.select_related('author').only('id', 'author')
+    serializer_class = UploadAttachSerializer
+    permission_classes = (IsAuthorOrReadOnly,)
+
+    def post(self, request, pk):
+        recipe = self.get_object()
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        slot = serializer.validated_data['upload']
+        transaction.on_commit(lambda: attach_upload.delay(slot, 'recipe.Recipe', recipe.pk, 'picture'))
+        return Response({'upload': slot['id']}, status=status.HTTP_202_ACCEPTED)
 
 
 class RecipeLikeAPIView(generics.CreateAPIView):
     """
+    Get: whether you like the recipe
     Like, Dislike a recipe
     """
     serializer_class = RecipeLikeSerializer
     permission_classes = (IsAuthenticated,)
 
+    def set_liked(self, recipe_id, liked):
+        """
+        Return False if the like state was already `liked`. With
+        RECIPE_LIKE_BUFFER the change goes to the Redis buffer first.
+        """
+        user_id = self.request.user.pk
+        if like_buffer.is_enabled():
+            try:
+                return like_buffer.record(user_id, recipe_id, liked)
+            except Recipe.DoesNotExist:
+                raise Http404
+        changed = RecipeLike.like(user_id, recipe_id) if liked else RecipeLike.unlike(user_id, recipe_id)
+        if not changed:
+            get_object_or_404(Recipe.objects.only('id'), id=recipe_id)
+        return changed
+
+    def get(self, request, pk):
+        recipe = get_object_or_404(Recipe.objects.only('id'), id=pk)
+        liked = None
+        if like_buffer.is_enabled():
+            liked = like_buffer.get_buffered_states(request.user.pk, [recipe.pk]).get(recipe.pk)
+        if liked is None:
+            liked = RecipeLike.objects.filter(user=request.user, recipe=recipe).exists()
+        return Response({'liked': liked})
+
     def post(self, request, pk):
-        recipe = get_object_or_404(Recipe.objects.select_related('author'), id=pk)
-        if not RecipeLike.objects.filter(user=request.user, recipe=recipe).exists():
-            RecipeLike.objects.create(user=request.user, recipe=recipe)
+        if self.set_liked(pk, True):
             return Response(status=status.HTTP_201_CREATED)
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
     def delete(self, request, pk):
-        recipe = get_object_or_404(Recipe.objects.select_related('author'), id=pk)
-        like = RecipeLike.objects.filter(user=request.user, recipe=recipe)
-        if like.exists():
-            like.delete()
+        if self.set_liked(pk, False):
             return Response(status=status.HTTP_200_OK)
         return Response(status=status.HTTP_400_BAD_REQUEST)
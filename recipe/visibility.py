@@ -0,0 +1,47 @@
+"""
+How far back rows stamped with a write time are known to be committed.
+
+Recipe.updated_at and RecipeLike.created are stamped when a row is written,
+not when its transaction commits. A reader asking for the rows stamped up
+to now can miss those of transactions still open, and if it then moves its
+cursor past now it misses them for good. Readers that work incrementally
+(the trending refresh, incremental exports) stop at get_visible_until()
+instead and pick the rest up on their next run.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+OLDEST_TRANSACTION_SQL = '''
+    SELECT min(xact_start) FROM pg_stat_activity
+    WHERE datname = current_database() AND backend_type = 'client backend'
+      AND pid <> pg_backend_pid() AND xact_start IS NOT NULL
+'''
+
+
+def get_oldest_transaction_start():
+    """
+    When the oldest transaction open on the database, other than this
+    connection's, started. None if there is none.
+    """
+    with connection.cursor() as cursor:
+        # Statistics views are read once per transaction otherwise.
+        cursor.execute('SELECT pg_stat_clear_snapshot()')
+        cursor.execute(OLDEST_TRANSACTION_SQL)
+        return cursor.fetchone()[0]
+
+
+def get_visible_until(now=None):
+    """
+    A time up to which every stamped row has been committed: `now`, or the
+    start of the oldest open transaction if earlier, less RECIPE_COMMIT_LAG
+    seconds. The lag covers rows stamped just before their transaction
+    began and clock differences between hosts.
+    """
+    until = now or timezone.now()
+    oldest = get_oldest_transaction_start()
+    if oldest is not None:
+        until = min(until, oldest)
+    return until - timedelta(seconds=settings.RECIPE_COMMIT_LAG)
@@ -0,0 +1,124 @@
+"""
+Avatar renditions and garbage collection of stored avatar files.
+
+Avatars are stored once per distinct image, see users.storage. After an
+upload, users.tasks.process_avatar writes square WebP renditions of
+AVATAR_SIZES through the same storage, so profiles sharing an image share
+its renditions too. Profile.avatar_renditions records which avatar they
+were made from.
+
+collect_garbage() deletes the files under the avatar directory that no
+profile refers to any more, once they are older than GARBAGE_GRACE_PERIOD.
+The grace period covers uploads whose profile row hasn't been saved yet.
+"""
+import io
+import logging
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.db.models import Q
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .models import Profile
+
+logger = logging.getLogger(__name__)
+
+AVATAR_DIR = 'avatar'
+AVATAR_SIZES = (64, 128, 256)
+WEBP_OPTIONS = {'quality': 80, 'method': 4}
+GARBAGE_GRACE_PERIOD = timedelta(days=1)
+
+
+def get_storage():
+    return Profile._meta.get_field('avatar').storage
+
+
+def render(image, size):
+    square = ImageOps.fit(image, (size, size), Image.LANCZOS)
+    output = io.BytesIO()
+    square.save(output, 'WEBP', **WEBP_OPTIONS)
+    return output.getvalue()
+
+
+def process_avatar(profile_id):
+    """
+    Write the renditions of the profile's current avatar and record them.
+    Returns False if there was nothing to do or the avatar can't be read.
+    """
+    profile = Profile.objects.filter(pk=profile_id).only('id', 'avatar').first()
+    if profile is None or not profile.avatar:
+        return False
+    name = profile.avatar.name
+    storage = profile.avatar.storage
+    try:
+        with storage.open(name, 'rb') as original:
+            with Image.open(original) as image:
+                image.draft('RGB', (AVATAR_SIZES[-1], AVATAR_SIZES[-1]))
+                image = ImageOps.exif_transpose(image)
+                if image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA' if image.has_transparency_data else 'RGB')
+                sizes = {
+                    str(size): storage.save(f'{AVATAR_DIR}/{size}.webp', ContentFile(render(image, size)))
+                    for size in AVATAR_SIZES
+                }
+    except FileNotFoundError:
+        logger.warning(f'Avatar {name} of profile {profile_id} is missing')
+        return False
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        logger.warning(f'Could not process avatar {name} of profile {profile_id}: {e}')
+        return False
+
+    # Skipped if the avatar was replaced meanwhile; its own task records it.
+    return bool(Profile.objects.filter(pk=profile_id, avatar=name).update(
+        avatar_renditions={'source': name, 'sizes': sizes}, updated_at=timezone.now()))
+
+
+def get_referenced_names():
+    names = set()
+    rows = Profile.objects.exclude(avatar='').values_list('avatar', 'avatar_renditions')
+    for name, renditions in rows.iterator(chunk_size=2000):
+        names.add(name)
+        if renditions.get('source') == name:
+            names.update(renditions['sizes'].values())
+    return names
+
+
+def is_referenced(name):
+    """
+    Whether a profile refers to `name` as its avatar or a rendition.
+    """
+    query = Q(avatar=name)
+    for size in AVATAR_SIZES:
+        query |= Q(avatar_renditions__sizes__contains={str(size): name})
+    return Profile.objects.filter(query).exists()
+
+
+def iter_files(storage, directory):
+    try:
+        directories, files = storage.listdir(directory)
+    except FileNotFoundError:
+        return
+    for filename in files:
+        yield f'{directory}/{filename}'
+    for subdirectory in directories:
+        yield from iter_files(storage, f'{directory}/{subdirectory}')
+
+
+def collect_garbage(now=None):
+    """
+    Delete unreferenced avatar files older than the grace period. Returns
+    the number of files deleted.
+    """
+    storage = get_storage()
+    cutoff = (now or timezone.now()) - GARBAGE_GRACE_PERIOD
+    referenced = get_referenced_names()
+    deleted = 0
+    for name in iter_files(storage, AVATAR_DIR):
+        if name in referenced:
+            continue
+        # Re-uploading a stored image refreshes its modification time, and
+        # both are checked again once the file can't be reused any more.
+        if storage.get_modified_time(name) < cutoff and storage.delete_stale(name, cutoff, is_referenced):
+            deleted += 1
+    return deleted
@@ -1,11 +1,14 @@
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import connection, models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
+from recipe import cache
 from recipe.models import Recipe
 
 from .managers import CustomUserManager
+from .storage import get_avatar_storage
 
 
 class CustomUser(AbstractUser):
@@ -24,8 +27,93 @@ class Profile(models.Model):
     user = models.OneToOneField(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     bookmarks = models.ManyToManyField(Recipe, related_name='bookmarked_by')
-    avatar = models.ImageField(upload_to='avatar', blank=True)
+    # Stored once per distinct image, see users.storage.
+    avatar = models.ImageField(upload_to='avatar', storage=get_avatar_storage, blank=True)
+    avatar_renditions = models.JSONField(default=dict, blank=True, editable=False)
     bio = models.CharField(max_length=200, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.user.username
+
+    @classmethod
+    def _tables(cls):
+        quote = connection.ops.quote_name
+        through = cls.bookmarks.through._meta
+        recipe_field = Recipe._meta.get_field
+        return {
+            'profile_table': quote(cls._meta.db_table),
+            'profile_id': quote(cls._meta.get_field('id').column),
+            'profile_user': quote(cls._meta.get_field('user').column),
+            'profile_updated_at': quote(cls._meta.get_field('updated_at').column),
+            'bookmark_table': quote(through.db_table),
+            'bookmark_profile': quote(through.get_field('profile').column),
+            'bookmark_recipe': quote(through.get_field('recipe').column),
+            'recipe_table': quote(Recipe._meta.db_table),
+            'recipe_id': quote(recipe_field('id').column),
+            'bookmarks_count': quote(recipe_field('bookmarks_count').column),
+            'recipe_updated_at': quote(recipe_field('updated_at').column),
+        }
+
+    @classmethod
+    def _write_bookmarks(cls, sql, user_id, recipe_ids):
+        recipe_ids = sorted(set(recipe_ids))
+        if not recipe_ids:
+            return []
+        now = timezone.now()
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [user_id, recipe_ids, now, now])
+            changed = [row[0] for row in cursor.fetchall()]
+        cache.invalidate_recipes(changed)
+        return changed
+
+    @classmethod
+    def add_bookmarks(cls, user_id, recipe_ids):
+        """
+        Bookmark many recipes for the user's profile in one statement, counting
+        them on the recipes and touching the profile. Recipes that are already
+        bookmarked or don't exist are skipped. Returns the ids of the recipes
+        that were bookmarked. No m2m_changed signals are sent.
+        """
+        sql = '''
+            WITH profile AS (
+                SELECT {profile_id} AS id FROM {profile_table} WHERE {profile_user} = %s
+            ), inserted AS (
+                INSERT INTO {bookmark_table} ({bookmark_profile}, {bookmark_recipe})
+                SELECT profile.id, {recipe_table}.{recipe_id}
+                FROM profile, {recipe_table}
+                WHERE {recipe_table}.{recipe_id} = ANY(%s::bigint[])
+                ON CONFLICT ({bookmark_profile}, {bookmark_recipe}) DO NOTHING
+                RETURNING {bookmark_recipe}
+            ), touched AS (
+                UPDATE {profile_table} SET {profile_updated_at} = %s
+                WHERE {profile_id} IN (SELECT id FROM profile) AND EXISTS (SELECT 1 FROM inserted)
+            )
+            UPDATE {recipe_table} SET {bookmarks_count} = {bookmarks_count} + 1, {recipe_updated_at} = %s
+            WHERE {recipe_id} IN (SELECT {bookmark_recipe} FROM inserted)
+            RETURNING {recipe_id}
+        '''.format(**cls._tables())
+        return cls._write_bookmarks(sql, user_id, recipe_ids)
+
+    @classmethod
+    def remove_bookmarks(cls, user_id, recipe_ids):
+        """
+        add_bookmarks() in reverse. Returns the ids of the recipes whose
+        bookmark was removed.
+        """
+        sql = '''
+            WITH deleted AS (
+                DELETE FROM {bookmark_table}
+                WHERE {bookmark_profile} = (SELECT {profile_id} FROM {profile_table} WHERE {profile_user} = %s)
+                  AND {bookmark_recipe} = ANY(%s::bigint[])
+                RETURNING {bookmark_profile}, {bookmark_recipe}
+            ), touched AS (
+                UPDATE {profile_table} SET {profile_updated_at} = %s
+                WHERE {profile_id} IN (SELECT {bookmark_profile} FROM deleted)
+            )
+            UPDATE {recipe_table} SET {bookmarks_count} = GREATEST({bookmarks_count} - 1, 0),
+                {recipe_updated_at} = %s
+            WHERE {recipe_id} IN (SELECT {bookmark_recipe} FROM deleted)
+            RETURNING {recipe_id}
+        '''.format(**cls._tables())
+        return cls._write_bookmarks(sql, user_id, recipe_ids)
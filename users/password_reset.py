@@ -0,0 +1,77 @@
+"""
+Password reset emails, sent by Celery workers instead of the request.
+
+POST /api/user/password/reset/ only validates the address and queues
+users.tasks.request_password_reset, so it answers in the same time and with
+the same response whether or not an account uses the address. The task
+creates (or reuses) the reset token the way django_rest_passwordreset does
+and sends reset_password_token_created; the receiver in users.signals
+queues users.tasks.send_password_reset_email with the token id, which
+renders and sends the email. Templates come from the cached loader, so a
+worker compiles them once.
+"""
+import unicodedata
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.mail import EmailMultiAlternatives
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from django_rest_passwordreset.models import (ResetPasswordToken, clear_expired, get_password_reset_lookup_field,
+                                              get_password_reset_token_expiry_time)
+from django_rest_passwordreset.signals import reset_password_token_created
+
+SUBJECT = 'Password Reset for Recipe app'
+
+
+def is_same_address(first, second):
+    return unicodedata.normalize('NFKC', first).casefold() == unicodedata.normalize('NFKC', second).casefold()
+
+
+def create_tokens(email, user_agent='', ip_address=''):
+    """
+    Create or reuse a reset token for every active account using `email`
+    and announce it. Returns the number of tokens.
+    """
+    clear_expired(timezone.now() - timedelta(hours=get_password_reset_token_expiry_time()))
+    lookup_field = get_password_reset_lookup_field()
+    users = get_user_model().objects.filter(**{f'{lookup_field}__iexact': email})
+    count = 0
+    for user in users:
+        if not user.eligible_for_reset() or not is_same_address(email, getattr(user, lookup_field)):
+            continue
+        token = user.password_reset_tokens.first()
+        if token is None:
+            token = ResetPasswordToken.objects.create(user=user, user_agent=user_agent, ip_address=ip_address)
+        reset_password_token_created.send(sender=create_tokens, instance=None, reset_password_token=token)
+        count += 1
+    return count
+
+
+def build_message(token):
+    user = token.user
+    context = {
+        'current_user': user,
+        'username': user.username,
+        'email': user.email,
+        'reset_password_url': '{}{}?token={}'.format(
+            settings.RECIPE_SITE_URL.rstrip('/'), reverse('password_reset:reset-password-confirm'), token.key),
+    }
+    message = EmailMultiAlternatives(
+        SUBJECT, render_to_string('users/user_reset_password.txt', context), to=[user.email])
+    message.attach_alternative(render_to_string('users/user_reset_password.html', context), 'text/html')
+    return message
+
+
+def send_email(token_id):
+    """
+    Send the email of a reset token. Returns False if the token was used or
+    cleared meanwhile.
+    """
+    token = ResetPasswordToken.objects.select_related('user').filter(pk=token_id).first()
+    if token is None:
+        return False
+    build_message(token).send()
+    return True
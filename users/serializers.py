@@ -43,20 +43,64 @@ class UserLoginSerializer(serializers.Serializer):
 
 class ProfileSerializer(CustomUserSerializer):
     """
-    Serializer class to serialize the user Profile model
+    Serializer class to serialize the user Profile model. The bookmarks
+    themselves are listed, paginated, by the bookmark endpoint.
     """
+    bookmarks_count = serializers.SerializerMethodField()
+
     class Meta:
         model = Profile
-        fields = ('bookmarks', 'bio')
+        fields = ('bookmarks_count', 'bio')
+
+    def get_bookmarks_count(self, obj):
+        # Counted on the through table alone, its (profile, recipe) index covers it.
+        return Profile.bookmarks.through.objects.filter(profile_id=obj.pk).count()
+
+
+class BookmarkSerializer(serializers.Serializer):
+    """
+    Recipe ids to bookmark or unbookmark: {"ids": [...]}, or {"id": n} for one.
+    """
+    id = serializers.IntegerField(required=False)
+    ids = serializers.ListField(child=serializers.IntegerField(), required=False, allow_empty=False)
+
+    def validate_ids(self, value):
+        max_size = self.context['max_batch_size']
+        if len(value) > max_size:
+            raise serializers.ValidationError(f'Send at most {max_size} recipe ids per request.')
+        return value
+
+    def validate(self, attrs):
+        if ('id' in attrs) == ('ids' in attrs):
+            raise serializers.ValidationError('Send either "id" or "ids".')
+        return attrs
 
 
 class ProfileAvatarSerializer(serializers.ModelSerializer):
     """
-    Serializer class to serialize the avatar
+    Serializer class to serialize the avatar and its square renditions
     """
+    avatar_sizes = serializers.SerializerMethodField()
+
     class Meta:
         model = Profile
-        fields = ('avatar',)
+        fields = ('avatar', 'avatar_sizes')
+
+    def get_avatar_sizes(self, obj):
+        """
+        Map sizes in pixels to the URLs of the avatar's renditions, None until
+        they have been made, see users.avatars.
+        """
+        renditions = obj.avatar_renditions
+        if not obj.avatar or renditions.get('source') != obj.avatar.name:
+            return None
+        request = self.context.get('request')
+        storage = obj.avatar.storage
+        sizes = {}
+        for size, name in renditions['sizes'].items():
+            url = storage.url(name)
+            sizes[size] = request.build_absolute_uri(url) if request is not None else url
+        return sizes
 
 
 class PasswordChangeSerializer(serializers.Serializer):
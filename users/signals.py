@@ -1,13 +1,15 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_init, post_save, pre_delete
 from django.contrib.auth import get_user_model
 from django.dispatch import receiver
-from django.core.mail import EmailMultiAlternatives
-from django.template.loader import render_to_string
-from django.urls import reverse
+from django.utils import timezone
 
 from django_rest_passwordreset.signals import reset_password_token_created
 
+from recipe.models import Recipe
+
 from .models import Profile
+from .tasks import process_avatar, send_password_reset_email
 
 
 User = get_user_model()
@@ -24,33 +26,82 @@ def save_profile(sender, instance, **kwargs):
     instance.profile.save()
 
 
+@receiver(m2m_changed, sender=Profile.bookmarks.through)
+def update_bookmarks_count(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_add' and pk_set:
+        # post_add only carries the ids that were actually inserted.
+        if reverse:
+            Recipe.adjust_counter([instance.pk], 'bookmarks_count', len(pk_set))
+        else:
+            Recipe.adjust_counter(pk_set, 'bookmarks_count', 1)
+    elif action in ('pre_remove', 'pre_clear'):
+        # pk_set holds the requested ids, so lock the rows that really exist;
+        # the delete runs right after this in the same transaction.
+        rows = sender.objects.select_for_update()
+        if reverse:
+            rows = rows.filter(recipe=instance)
+            if pk_set is not None:
+                rows = rows.filter(profile_id__in=pk_set)
+            Recipe.adjust_counter(
+                [instance.pk], 'bookmarks_count', -len(rows.values_list('pk', flat=True)))
+        else:
+            rows = rows.filter(profile=instance)
+            if pk_set is not None:
+                rows = rows.filter(recipe_id__in=pk_set)
+            Recipe.adjust_counter(list(rows.values_list('recipe_id', flat=True)), 'bookmarks_count', -1)
+
+
+def touch_profiles(profile_ids):
+    Profile.objects.filter(pk__in=profile_ids).update(updated_at=timezone.now())
+
+
+@receiver(m2m_changed, sender=Profile.bookmarks.through)
+def touch_bookmarking_profiles(sender, instance, action, reverse, pk_set, **kwargs):
+    # Keep Profile.updated_at usable as the profile's Last-Modified.
+    if reverse and action == 'pre_clear':
+        # post_clear doesn't say which profiles lost the recipe.
+        touch_profiles(sender.objects.filter(recipe=instance).values('profile_id'))
+    elif action in ('post_add', 'post_remove') and pk_set:
+        touch_profiles(pk_set if reverse else [instance.pk])
+    elif action == 'post_clear' and not reverse:
+        touch_profiles([instance.pk])
+
+
+@receiver(pre_delete, sender=Recipe)
+def touch_profiles_bookmarking_recipe(sender, instance, **kwargs):
+    # The through rows go with the recipe without m2m_changed, and
+    # bookmarks_count is part of the profile.
+    touch_profiles(Profile.bookmarks.through.objects.filter(recipe=instance).values('profile_id'))
+
+
+@receiver(pre_delete, sender=Profile)
+def release_profile_bookmarks(sender, instance, **kwargs):
+    # Cascaded deletes of the through rows don't send m2m_changed.
+    Recipe.adjust_counter(
+        list(instance.bookmarks.values_list('pk', flat=True)), 'bookmarks_count', -1)
+
+
+@receiver(post_init, sender=Profile)
+def remember_avatar(sender, instance, **kwargs):
+    # The stored file name, None if the avatar wasn't loaded.
+    avatar = instance.__dict__.get('avatar')
+    instance._avatar_name = getattr(avatar, 'name', avatar)
+
+
+@receiver(post_save, sender=Profile)
+def process_new_avatar(sender, instance, update_fields=None, **kwargs):
+    if 'avatar' not in instance.__dict__ or (update_fields is not None and 'avatar' not in update_fields):
+        return
+    name = instance.avatar.name
+    if name and name != instance._avatar_name:
+        # Renditions are made after the upload request has returned.
+        transaction.on_commit(lambda: process_avatar.delay(instance.pk))
+    instance._avatar_name = name
+
+
 # Password reset
 @receiver(reset_password_token_created)
 def password_reset_token_created(sender, instance, reset_password_token, *args, **kwargs):
-    context = {
-        'current_user': reset_password_token.user,
-        'username': reset_password_token.user.username,
-        'email': reset_password_token.user.email,
-        'reset_password_url': "{}?token={}".format(
-            instance.request.build_absolute_uri(
-                reverse('password_reset:reset-password-confirm')),
-            reset_password_token.key)
-    }
-
-    email_html_message = render_to_string(
-        'users/user_reset_password.html', context)
-    email_plaintext_message = render_to_string(
-        'users/user_reset_password.txt', context)
-
-    msg = EmailMultiAlternatives(
-        # title:
-        "Password Reset for {title}".format(title="Recipe app"),
-        # message:
-        email_plaintext_message,
-        # from:
-        "noreply@somehost.local",
-        # to:
-        [reset_password_token.user.email]
-    )
-    msg.attach_alternative(email_html_message, "text/html")
-    msg.send()
+    # Rendering and SMTP happen in a worker, see users.password_reset.
+    token_id = reset_password_token.pk
+    transaction.on_commit(lambda: send_password_reset_email.delay(token_id))
@@ -0,0 +1,116 @@
+"""
+Content-addressed file storage.
+
+Files are named after the SHA-256 of their content, under the directory the
+field's upload_to gives them: `avatar/3f/3fa1...e9.png`. Uploading a file
+that is already stored writes nothing and returns the existing name, so
+every distinct image is kept once however many profiles use it. Names
+never change meaning, which also makes them safe to cache forever.
+
+Stored files are never overwritten or deleted on upload; files nobody
+refers to any more are removed by users.avatars.collect_garbage(). Saving
+an existing blob refreshes its modification time, which the collector's
+grace period relies on to never delete a file that was just reused. The
+collector moves a file out of the way before its last checks, see
+delete_stale(), so a save racing with it either refreshes the file in
+time to be seen or finds it gone and writes it again.
+"""
+import hashlib
+import os
+import re
+from uuid import uuid4
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+CHUNK_SIZE = 64 * 1024
+EXTENSION_RE = re.compile(r'^\.[a-z0-9]{1,5}$')
+CONTENT_NAME_RE = re.compile(r'(?:^|/)([0-9a-f]{2})/(\1[0-9a-f]{62})(?:\.[a-z0-9]{1,5})?$')
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+
+    def get_content_name(self, name, content):
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks(CHUNK_SIZE):
+            digest.update(chunk)
+        content.seek(0)
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        if not EXTENSION_RE.match(extension):
+            extension = ''
+        hexdigest = digest.hexdigest()
+        return os.path.join(directory, hexdigest[:2], hexdigest + extension).replace('\\', '/')
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.get_content_name(name, content)
+        if self.exists(name):
+            # Same bytes as a stored file: reuse it, and keep it out of the
+            # garbage collector's reach for another grace period.
+            try:
+                os.utime(self.path(name))
+                return name
+            except FileNotFoundError:
+                # Taken by the collector meanwhile: store it again.
+                pass
+        return self._save(name, content)
+
+    def delete_stale(self, name, cutoff, is_referenced):
+        """
+        Delete `name` unless it was modified after `cutoff` or
+        is_referenced(name) is true, both checked once the file is out of
+        save()'s reach. Returns whether it was deleted.
+        """
+        full_path = self.path(name)
+        trash_path = f'{full_path}.{uuid4().hex}.trash'
+        try:
+            os.rename(full_path, trash_path)
+        except FileNotFoundError:
+            return False
+        # From here save() writes the bytes anew rather than reuse this file,
+        # and a reuse that got in first has refreshed its modification time.
+        modified = self._datetime_from_timestamp(os.stat(trash_path).st_mtime)
+        if modified >= cutoff or is_referenced(name):
+            os.replace(trash_path, full_path)
+            return False
+        os.remove(trash_path)
+        return True
+
+    def _save(self, name, content):
+        # Concurrent uploads of the same bytes race for the same name; each
+        # writes a temporary file and renames it into place, last one wins.
+        full_path = self.path(name)
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, mode=self.directory_permissions_mode or 0o777, exist_ok=True)
+        temporary_path = f'{full_path}.{uuid4().hex}.tmp'
+        fd = os.open(temporary_path, self.OS_OPEN_FLAGS, 0o666)
+        with os.fdopen(fd, 'wb') as temporary:
+            for chunk in content.chunks(CHUNK_SIZE):
+                temporary.write(chunk)
+        if self.file_permissions_mode is not None:
+            os.chmod(temporary_path, self.file_permissions_mode)
+        os.replace(temporary_path, full_path)
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # A content name is taken only by identical content.
+        return name
+
+
+def is_content_name(name):
+    """
+    Whether `name` was given by a ContentAddressedStorage, so its content
+    can never change.
+    """
+    return CONTENT_NAME_RE.search(name) is not None
+
+
+def get_avatar_storage():
+    return ContentAddressedStorage()
@@ -0,0 +1,54 @@
+import logging
+
+from celery import shared_task
+from django.core.cache import cache
+
+from . import avatars, password_reset
+
+logger = logging.getLogger(__name__)
+
+
+@shared_task
+def process_avatar(profile_id):
+    """
+    Write the square renditions of a profile's avatar, see users.avatars.
+    """
+    if avatars.process_avatar(profile_id):
+        return f'Avatar of profile {profile_id} processed!'
+    return 'Skipped'
+
+
+@shared_task
+def collect_avatar_garbage():
+    """
+    Delete the stored avatar files no profile refers to any more.
+    """
+    lock_key = 'users:avatar-gc:lock'
+    if not cache.add(lock_key, 1, 60 * 30):
+        logger.info('Avatar garbage is already being collected')
+        return 'Skipped'
+    try:
+        count = avatars.collect_garbage()
+    finally:
+        cache.delete(lock_key)
+    return f'Deleted {count} unused avatar files!'
+
+
+@shared_task
+def request_password_reset(email, user_agent='', ip_address=''):
+    """
+    Create the reset tokens of the accounts using `email`, see
+    users.password_reset.
+    """
+    count = password_reset.create_tokens(email, user_agent, ip_address)
+    return f'Created {count} password reset tokens!'
+
+
+@shared_task
+def send_password_reset_email(token_id):
+    """
+    Send the email of a password reset token.
+    """
+    if password_reset.send_email(token_id):
+        return f'Password reset email of token {token_id} sent!'
+    return 'Skipped'
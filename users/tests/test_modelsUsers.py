@@ -1,8 +1,17 @@
+import io
+import os
+from datetime import timedelta
+
 import pytest
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image
 from recipe.models import Recipe
+from users import avatars
 from users.models import CustomUser, Profile
+from users.serializers import ProfileAvatarSerializer
 
 User = get_user_model()
 
@@ -61,3 +70,126 @@ class TestProfileModel:
         self.profile.avatar = 'avatar/test_image.png'
         self.profile.save()
         assert self.profile.avatar.name == 'avatar/test_image.png'
+
+
+@pytest.mark.django_db
+class TestProfileAvatars:
+    @pytest.fixture(autouse=True)
+    def media_root(self, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        settings.MEDIA_URL = '/media/'
+        self.media = tmp_path
+
+    def setup_method(self):
+        self.first = User.objects.create_user(email='first@example.com', username='first', password='testpass')
+        self.second = User.objects.create_user(email='second@example.com', username='second', password='testpass')
+
+    def make_png(self, color=(200, 120, 40), size=(300, 200)):
+        output = io.BytesIO()
+        Image.new('RGB', size, color).save(output, 'PNG')
+        return ContentFile(output.getvalue(), name='Me.PNG')
+
+    def set_avatar(self, user, image):
+        profile = Profile.objects.get(user=user)
+        profile.avatar = image
+        profile.save()
+        return profile
+
+    def test_identical_uploads_are_stored_once(self):
+        first = self.set_avatar(self.first, self.make_png())
+        second = self.set_avatar(self.second, self.make_png())
+        assert first.avatar.name == second.avatar.name
+        assert first.avatar.name.startswith('avatar/') and first.avatar.name.endswith('.png')
+        assert len(list((self.media / 'avatar').rglob('*.png'))) == 1
+
+        third = self.set_avatar(self.second, self.make_png(color=(0, 0, 0)))
+        assert third.avatar.name != first.avatar.name
+
+    def test_renditions(self):
+        profile = self.set_avatar(self.first, self.make_png())
+        assert ProfileAvatarSerializer(profile).data['avatar_sizes'] is None
+        assert avatars.process_avatar(profile.pk)
+        profile.refresh_from_db()
+        sizes = profile.avatar_renditions['sizes']
+        assert list(sizes) == ['64', '128', '256']
+        with Image.open(self.media / sizes['64']) as rendition:
+            assert rendition.size == (64, 64)
+            assert rendition.format == 'WEBP'
+        assert ProfileAvatarSerializer(profile).data['avatar_sizes']['128'] == f"/media/{sizes['128']}"
+
+        # A second profile with the same image reuses the stored renditions.
+        other = self.set_avatar(self.second, self.make_png())
+        avatars.process_avatar(other.pk)
+        other.refresh_from_db()
+        assert other.avatar_renditions == profile.avatar_renditions
+
+    def test_unreadable_avatar(self):
+        profile = self.set_avatar(self.first, ContentFile(b'not an image', name='me.png'))
+        assert not avatars.process_avatar(profile.pk)
+
+    def test_collect_garbage(self):
+        profile = self.set_avatar(self.first, self.make_png())
+        avatars.process_avatar(profile.pk)
+        profile.refresh_from_db()
+        kept = [profile.avatar.name, *profile.avatar_renditions['sizes'].values()]
+        old = profile.avatar.name
+        profile = self.set_avatar(self.first, self.make_png(color=(0, 0, 0)))
+        avatars.process_avatar(profile.pk)
+        profile.refresh_from_db()
+
+        # Superseded files are kept for the grace period.
+        assert avatars.collect_garbage() == 0
+        later = timezone.now() + avatars.GARBAGE_GRACE_PERIOD + timedelta(minutes=1)
+        assert avatars.collect_garbage(now=later) == 4
+        assert not any((self.media / name).exists() for name in kept)
+        assert (self.media / profile.avatar.name).exists()
+        assert all((self.media / name).exists() for name in profile.avatar_renditions['sizes'].values())
+
+        # Uploading a collected image again stores it anew.
+        assert self.set_avatar(self.second, self.make_png()).avatar.name == old
+        assert (self.media / old).exists()
+
+    def make_stale(self, name):
+        stale = (timezone.now() - avatars.GARBAGE_GRACE_PERIOD * 2).timestamp()
+        os.utime(self.media / name, (stale, stale))
+
+    def test_collect_garbage_races_with_reuse(self, monkeypatch):
+        name = self.set_avatar(self.first, self.make_png()).avatar.name
+        self.set_avatar(self.first, self.make_png(color=(0, 0, 0)))
+        storage = avatars.get_storage()
+        get_modified_time = storage.get_modified_time
+
+        def reuse_after_read(file_name):
+            # The collector read the old time, then the image is uploaded
+            # again; its profile row is saved after the collector is done.
+            modified = get_modified_time(file_name)
+            if file_name == name:
+                assert storage.save('avatar/me.png', self.make_png()) == name
+            return modified
+
+        self.make_stale(name)
+        monkeypatch.setattr(storage, 'get_modified_time', reuse_after_read)
+        assert avatars.collect_garbage() == 0
+        assert (self.media / name).exists()
+        monkeypatch.undo()
+
+        def reuse_after_move(file_name):
+            # Uploaded again once the collector moved the file away.
+            if file_name == name:
+                self.set_avatar(self.second, self.make_png())
+            return is_referenced(file_name)
+
+        is_referenced = avatars.is_referenced
+        self.make_stale(name)
+        monkeypatch.setattr(avatars, 'is_referenced', reuse_after_move)
+        assert avatars.collect_garbage() == 0
+        assert (self.media / name).read_bytes() == self.make_png().read()
+
+        # A file collected between exists() and the refresh is written again.
+        Profile.objects.filter(user=self.second).update(avatar='')
+        self.make_stale(name)
+        monkeypatch.undo()
+        assert avatars.collect_garbage() == 1
+        monkeypatch.setattr(storage, 'exists', lambda file_name: True)
+        assert storage.save('avatar/me.png', self.make_png()) == name
+        assert (self.media / name).exists()
@@ -68,7 +68,7 @@ class TestProfileSerializer:
     def test_profile_serializer(self):
         serializer = ProfileSerializer(self.profile)
         data = serializer.data
-        assert data['bookmarks'] == []  # Assuming bookmarks is empty by default
+        assert data['bookmarks_count'] == 0
         assert data['bio'] == 'This is a bio'
 
 @pytest.mark.django_db
@@ -2,9 +2,13 @@ import pytest
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import get_user_model
+from django.core import mail
+from django.template.loader import get_template
+from django_rest_passwordreset.models import ResetPasswordToken
 from django.urls import reverse
 from rest_framework.test import APIClient
-from recipe.models import Recipe
+from recipe.models import Recipe, RecipeCategory
+from users import password_reset, tasks
 from users.models import Profile
 from users.serializers import CustomUserSerializer, UserRegisterationSerializer, UserLoginSerializer, ProfileSerializer, ProfileAvatarSerializer, PasswordChangeSerializer
 
@@ -177,3 +181,160 @@ class TestPasswordChangeAPIView:
         }
         response = self.client.patch(url, data, format='json')
         assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+@pytest.mark.django_db
+class TestUserProfileConditionalGet:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='etag@example.com', username='etag', password='testpass')
+        self.client.force_authenticate(user=self.user)
+        self.recipe = Recipe.objects.create(
+            title='Test Recipe',
+            desc='Delicious recipe',
+            cook_time='00:30:00',
+            ingredients='sugar, flour',
+            procedure='mix ingredients',
+            category=RecipeCategory.objects.create(name='Dessert'),
+            author=self.user
+        )
+
+    def test_profile_not_modified_until_bookmark(self):
+        url = reverse('users:user-profile')
+        etag = self.client.get(url)['ETag']
+        assert self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_304_NOT_MODIFIED
+
+        self.user.profile.bookmarks.add(self.recipe)
+        assert self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == status.HTTP_200_OK
+
+    @pytest.mark.parametrize('change', ['clear', 'delete'])
+    def test_profile_modified_by_recipe_side_changes(self, change):
+        self.user.profile.bookmarks.add(self.recipe)
+        url = reverse('users:user-profile')
+        etag = self.client.get(url)['ETag']
+        if change == 'clear':
+            self.recipe.bookmarked_by.clear()
+        else:
+            self.recipe.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.data['bookmarks_count'] == 0
+
+
+@pytest.mark.django_db
+class TestUserBookmarks:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='bookmarks@example.com', username='bookmarks', password='testpass')
+        self.client.force_authenticate(user=self.user)
+        category = RecipeCategory.objects.create(name='Dessert')
+        self.recipes = [Recipe.objects.create(
+            title=f'Bookmarked {i}',
+            desc='Sweet',
+            cook_time='00:30:00',
+            ingredients='sugar',
+            procedure='bake',
+            category=category,
+            author=self.user
+        ) for i in range(5)]
+        self.url = reverse('users:user-bookmark', kwargs={'pk': self.user.id})
+
+    def bookmarked_ids(self):
+        return set(self.user.profile.bookmarks.values_list('id', flat=True))
+
+    def test_bulk_add_and_remove(self, django_assert_num_queries):
+        ids = [recipe.id for recipe in self.recipes[:3]]
+        self.user.profile.bookmarks.add(self.recipes[0])
+        with django_assert_num_queries(1):
+            response = self.client.post(self.url, {'ids': ids + [ids[1], 999999]}, format='json')
+        assert response.status_code == status.HTTP_200_OK
+        assert sorted(response.data['ids']) == ids[1:]
+        assert self.bookmarked_ids() == set(ids)
+        counts = dict(Recipe.objects.values_list('id', 'bookmarks_count'))
+        assert [counts[recipe.id] for recipe in self.recipes] == [1, 1, 1, 0, 0]
+
+        response = self.client.delete(self.url, {'ids': ids[:2] + [self.recipes[4].id]}, format='json')
+        assert sorted(response.data['ids']) == ids[:2]
+        assert self.bookmarked_ids() == {ids[2]}
+        counts = dict(Recipe.objects.values_list('id', 'bookmarks_count'))
+        assert [counts[recipe.id] for recipe in self.recipes] == [0, 0, 1, 0, 0]
+
+    def test_bulk_write_touches_profile(self):
+        profile = self.user.profile
+        before = Profile.objects.get(pk=profile.pk).updated_at
+        self.client.post(self.url, {'ids': [self.recipes[0].id]}, format='json')
+        assert Profile.objects.get(pk=profile.pk).updated_at > before
+
+    def test_single_id_errors(self):
+        recipe_id = self.recipes[0].id
+        assert self.client.post(self.url, {'id': recipe_id}, format='json').status_code == status.HTTP_200_OK
+        assert self.client.post(self.url, {'id': recipe_id}, format='json').status_code == status.HTTP_400_BAD_REQUEST
+        assert self.client.post(self.url, {'id': 999999}, format='json').status_code == status.HTTP_404_NOT_FOUND
+        assert self.client.delete(self.url, {'id': recipe_id}, format='json').status_code == status.HTTP_200_OK
+        assert self.client.delete(self.url, {'id': recipe_id}, format='json').status_code == status.HTTP_400_BAD_REQUEST
+        assert self.client.post(self.url, {}, format='json').status_code == status.HTTP_400_BAD_REQUEST
+
+    def test_too_many_ids(self, settings):
+        settings.RECIPE_BOOKMARK_BATCH_MAX_SIZE = 2
+        response = self.client.post(self.url, {'ids': [recipe.id for recipe in self.recipes]}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert not self.bookmarked_ids()
+
+    def test_list_is_keyset_paginated(self):
+        self.user.profile.bookmarks.add(*self.recipes[:4])
+        response = self.client.get(self.url, {'page_size': 3})
+        ids = [recipe['id'] for recipe in response.data['results']]
+        response = self.client.get(response.data['next'])
+        ids += [recipe['id'] for recipe in response.data['results']]
+        assert ids == sorted((recipe.id for recipe in self.recipes[:4]), reverse=True)
+        assert response.data['next'] is None
+
+    def test_profile_carries_count(self):
+        self.user.profile.bookmarks.add(*self.recipes[:2])
+        response = self.client.get(reverse('users:user-profile'))
+        assert response.data['bookmarks_count'] == 2
+        assert 'bookmarks' not in response.data
+
+
+@pytest.mark.django_db
+class TestPasswordReset:
+    def setup_method(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='reset@example.com', username='reset', password='testpass')
+        self.url = reverse('users:password-reset-request')
+
+    def test_same_response_for_unknown_addresses(self, monkeypatch, django_assert_num_queries):
+        queued = []
+        monkeypatch.setattr(tasks.request_password_reset, 'delay', lambda *args: queued.append(args))
+        responses = []
+        for email in ('reset@example.com', 'nobody@example.com'):
+            # No lookup in the request, so nothing to time.
+            with django_assert_num_queries(0):
+                responses.append(self.client.post(self.url, {'email': email}, format='json'))
+        assert [(r.status_code, r.data) for r in responses] == [(200, {'status': 'OK'})] * 2
+        assert [args[0] for args in queued] == ['reset@example.com', 'nobody@example.com']
+        assert self.client.post(self.url, {'email': 'not an email'}, format='json').status_code == 400
+
+    def test_token_email_is_queued(self, monkeypatch, django_capture_on_commit_callbacks):
+        queued = []
+        monkeypatch.setattr(tasks.send_password_reset_email, 'delay', queued.append)
+        with django_capture_on_commit_callbacks(execute=True):
+            assert password_reset.create_tokens('Reset@Example.com') == 1
+        assert password_reset.create_tokens('nobody@example.com') == 0
+        token = ResetPasswordToken.objects.get(user=self.user)
+        assert queued == [token.pk]
+
+    def test_send_email(self, settings):
+        settings.RECIPE_SITE_URL = 'https://recipes.example.com/'
+        token = ResetPasswordToken.objects.create(user=self.user)
+        assert password_reset.send_email(token.pk)
+        message, = mail.outbox
+        assert message.to == ['reset@example.com']
+        assert f'https://recipes.example.com/api/user/password/reset/confirm/?token={token.key}' in message.body
+        assert message.alternatives[0][1] == 'text/html'
+        token.delete()
+        assert not password_reset.send_email(token.pk)
+
+    def test_templates_are_compiled_once(self):
+        first = get_template('users/user_reset_password.txt')
+        assert get_template('users/user_reset_password.txt').template is first.template
@@ -18,6 +18,9 @@ urlpatterns = [
          name='user-avatar'),
     path('profile/<int:pk>/bookmarks/', views.UserBookmarkAPIView.as_view(),
          name='user-bookmark'),
+    # Shadows the request view of django_rest_passwordreset.
+    path('password/reset/', views.PasswordResetRequestAPIView.as_view(),
+         name='password-reset-request'),
     path('password/change/', views.PasswordChangeAPIView.as_view(),
          name='change-password'),
 ]
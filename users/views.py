@@ -3,13 +3,20 @@ from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.generics import GenericAPIView, ListCreateAPIView, RetrieveUpdateAPIView, UpdateAPIView
 from rest_framework_simplejwt.tokens import RefreshToken
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 
+from recipe.mixins import ConditionalGetMixin, RecipeConditionalGetMixin
 from recipe.models import Recipe
+from recipe.pagination import RecipeBookmarkPagination
 from .models import Profile
-from recipe.serializers import RecipeSerializer
+from recipe.serializers import RecipeSerializer, UploadAttachSerializer
+from recipe.tasks import attach_upload
+from django_rest_passwordreset.serializers import EmailSerializer
 from . import serializers
+from .tasks import request_password_reset
 
 User = get_user_model()
 
@@ -81,7 +88,7 @@ class UserAPIView(RetrieveUpdateAPIView):
         return self.request.user
 
 
-class UserProfileAPIView(RetrieveUpdateAPIView):
+class UserProfileAPIView(ConditionalGetMixin, RetrieveUpdateAPIView):
     """
     Get, Update user profile
     """
@@ -92,10 +99,17 @@ class UserProfileAPIView(RetrieveUpdateAPIView):
     def get_object(self):
         return self.request.user.profile
 
+    def get_validators(self):
+        updated_at = Profile.objects.filter(user=self.request.user).values_list(
+            'updated_at', flat=True).first()
+        return updated_at, updated_at
+
 
 class UserAvatarAPIView(RetrieveUpdateAPIView):
     """
     Get, Update user avatar
+    Post: attach a finished upload as the avatar, {"upload": token}; the
+    avatar is replaced in the background, see recipe.uploads
     """
     queryset = Profile.objects.select_related('user')
     serializer_class = serializers.ProfileAvatarSerializer
@@ -104,34 +118,57 @@ class UserAvatarAPIView(RetrieveUpdateAPIView):
     def get_object(self):
         return self.request.user.profile
 
+    def post(self, request):
+        serializer = UploadAttachSerializer(data=request.data, context=self.get_serializer_context())
+        serializer.is_valid(raise_exception=True)
+        slot = serializer.validated_data['upload']
+        profile_id = Profile.objects.filter(user=request.user).values_list('pk', flat=True).get()
+        transaction.on_commit(lambda: attach_upload.delay(slot, 'users.Profile', profile_id, 'avatar'))
+        return Response({'upload': slot['id']}, status=status.HTTP_202_ACCEPTED)
+
 
-class UserBookmarkAPIView(ListCreateAPIView):
+class UserBookmarkAPIView(RecipeConditionalGetMixin, ListCreateAPIView):
     """
-    Get, Create, Delete favorite recipe
+    Get: the user's bookmarked recipes, newest recipe first
+    Post, Delete: bookmark or unbookmark {"ids": [...]} (or {"id": n})
     """
     serializer_class = RecipeSerializer
     permission_classes = (IsAuthenticated,)
+    pagination_class = RecipeBookmarkPagination
 
     def get_queryset(self):
-        user = get_object_or_404(User, id=self.kwargs['pk'])
-        user_profile = get_object_or_404(Profile.objects.select_related('user'), user=user)
-        return user_profile.bookmarks.all()
+        # Joins the bookmark table and the profile directly; an unknown user
+        # simply has no bookmarks.
+        return Recipe.objects.filter(bookmarked_by__user_id=self.kwargs['pk']).select_related(
+            'author', 'category')
+
+    def get_ids(self, request):
+        serializer = serializers.BookmarkSerializer(
+            data=request.data, context={'max_batch_size': settings.RECIPE_BOOKMARK_BATCH_MAX_SIZE})
+        serializer.is_valid(raise_exception=True)
+        return serializer.validated_data
+
+    def get_unchanged_response(self, pk, recipe_id, message):
+        # Only failed single-id writes pay for telling 404 from 400.
+        get_object_or_404(Profile.objects.only('id'), user_id=pk)
+        get_object_or_404(Recipe.objects.only('id'), id=recipe_id)
+        return Response({"detail": message}, status=status.HTTP_400_BAD_REQUEST)
 
     def post(self, request, pk):
-        user_profile = get_object_or_404(Profile.objects.select_related('user'), user_id=pk)
-        recipe = get_object_or_404(Recipe, id=request.data['id'])
-        if user_profile.bookmarks.filter(id=recipe.id).exists():
-            return Response({"detail": "Recipe already bookmarked."}, status=status.HTTP_400_BAD_REQUEST)
-        user_profile.bookmarks.add(recipe)
+        data = self.get_ids(request)
+        if 'ids' in data:
+            return Response({"ids": Profile.add_bookmarks(pk, data['ids'])}, status=status.HTTP_200_OK)
+        if not Profile.add_bookmarks(pk, [data['id']]):
+            return self.get_unchanged_response(pk, data['id'], "Recipe already bookmarked.")
         return Response({"detail": "Recipe bookmarked successfully."}, status=status.HTTP_200_OK)
 
     def delete(self, request, pk):
-        user_profile = get_object_or_404(Profile.objects.select_related('user'), user_id=pk)
-        recipe = get_object_or_404(Recipe, id=request.data['id'])
-        if user_profile.bookmarks.filter(id=recipe.id).exists():
-            user_profile.bookmarks.remove(recipe)
-            return Response({"detail": "Recipe removed from bookmarks."}, status=status.HTTP_200_OK)
-        return Response({"detail": "Recipe not found in bookmarks."}, status=status.HTTP_400_BAD_REQUEST)
+        data = self.get_ids(request)
+        if 'ids' in data:
+            return Response({"ids": Profile.remove_bookmarks(pk, data['ids'])}, status=status.HTTP_200_OK)
+        if not Profile.remove_bookmarks(pk, [data['id']]):
+            return self.get_unchanged_response(pk, data['id'], "Recipe not found in bookmarks.")
+        return Response({"detail": "Recipe removed from bookmarks."}, status=status.HTTP_200_OK)
 
 
 class PasswordChangeAPIView(UpdateAPIView):
@@ -143,3 +180,22 @@ class PasswordChangeAPIView(UpdateAPIView):
 
     def get_object(self):
         return self.request.user
+
+
+class PasswordResetRequestAPIView(GenericAPIView):
+    """
+    Post: email a password reset link to {"email": ...}. Always answers
+    {"status": "OK"} in the same time, see users.password_reset.
+    """
+    serializer_class = EmailSerializer
+    authentication_classes = ()
+    permission_classes = (AllowAny,)
+
+    def post(self, request):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        request_password_reset.delay(
+            serializer.validated_data['email'],
+            request.META.get('HTTP_USER_AGENT', ''),
+            request.META.get('REMOTE_ADDR', ''))
+        return Response({'status': 'OK'})